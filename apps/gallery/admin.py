@@ -1,7 +1,10 @@
 from django.contrib import admin
 
-from .models import GalleryPiece, Exhibition
+from .models import GalleryPiece, Exhibition, StorageQuota, DailyViewCount, Job
 
 # Register your models here.
 admin.site.register(GalleryPiece)
 admin.site.register(Exhibition)
+admin.site.register(StorageQuota)
+admin.site.register(DailyViewCount)
+admin.site.register(Job)
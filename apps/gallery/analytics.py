@@ -0,0 +1,151 @@
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import DailyViewCount
+
+logger = logging.getLogger(__name__)
+
+UPSERT_BATCH_SIZE = 500
+
+
+class ViewCounter:
+    """
+    View counts buffered in process memory, keyed by (kind, object id, day). Recording a view is a
+    dictionary increment; the counts are written as batched upserts into DailyViewCount at most
+    every GALLERY_VIEWCOUNT_FLUSH_INTERVAL seconds (or sooner once GALLERY_VIEWCOUNT_MAX_PENDING
+    keys are waiting), so hot rows are updated once per flush rather than once per view. Call
+    flush() when a worker shuts down; a worker that dies loses at most one interval of counts.
+
+    Served workers call start() to flush from a background thread, so counts are written even
+    while a worker sits idle. Without it, due counts are flushed as the next request starts.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def record(self, kind, object_id):
+        key = (kind, object_id, timezone.localdate())
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + 1
+            full = len(self.pending) >= settings.GALLERY_VIEWCOUNT_MAX_PENDING
+        if full:
+            self.wake.set()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Flush from a daemon thread every GALLERY_VIEWCOUNT_FLUSH_INTERVAL seconds from now on."""
+        with self.lock:
+            if self.running:
+                return
+            self.thread = threading.Thread(target=self._run, name="gallery-viewcounts", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wake.wait(settings.GALLERY_VIEWCOUNT_FLUSH_INTERVAL)
+            self.wake.clear()
+            if self.flush():
+                # the thread's own connection, which would otherwise sit open between flushes
+                connection.close()
+
+    def due(self):
+        with self.lock:
+            return len(self.pending) >= settings.GALLERY_VIEWCOUNT_MAX_PENDING or (
+                bool(self.pending)
+                and time.monotonic() - self.last_flush >= settings.GALLERY_VIEWCOUNT_FLUSH_INTERVAL)
+
+    def flush(self):
+        """Write out the buffered counts. Returns the number of rows upserted."""
+        with self.lock:
+            counts, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if not counts:
+            return 0
+
+        try:
+            upsert_counts(counts)
+        except Exception:
+            logger.exception("Could not write %s view counts; keeping them for the next flush", len(counts))
+            with self.lock:
+                for key, views in counts.items():
+                    self.pending[key] = self.pending.get(key, 0) + views
+            return 0
+        return len(counts)
+
+
+def upsert_counts(counts):
+    """Add {(kind, object_id, date): views} onto the rollup rows, creating missing ones."""
+    rows = [(kind, object_id, connection.ops.adapt_datefield_value(date), views)
+            for (kind, object_id, date), views in sorted(counts.items())]
+    with transaction.atomic():
+        for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+            _upsert(rows[i:i + UPSERT_BATCH_SIZE])
+
+
+def _upsert(rows):
+    vendor = connection.vendor
+    if vendor not in ("mysql", "sqlite", "postgresql"):
+        # portable fallback: one statement per row instead of one per batch
+        DailyViewCount.objects.bulk_create(
+            [DailyViewCount(kind=k, object_id=o, date=d) for k, o, d, _ in rows], ignore_conflicts=True)
+        for kind, object_id, date, views in rows:
+            DailyViewCount.objects.filter(kind=kind, object_id=object_id, date=date).update(views=F("views") + views)
+        return
+
+    qn = connection.ops.quote_name
+    names = {'table': qn(DailyViewCount._meta.db_table), 'kind': qn("kind"), 'object_id': qn("object_id"),
+             'date': qn("date"), 'views': qn("views")}
+    sql = "INSERT INTO {table} ({kind}, {object_id}, {date}, {views}) VALUES ".format(**names) \
+        + ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+    if vendor == "mysql":
+        sql += " ON DUPLICATE KEY UPDATE {views} = {views} + VALUES({views})".format(**names)
+    else:
+        sql += " ON CONFLICT ({kind}, {object_id}, {date}) DO UPDATE SET {views} = {table}.{views} + excluded.{views}" \
+            .format(**names)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [value for row in rows for value in row])
+
+
+_counter = ViewCounter()
+
+
+def record_view(kind, object_id):
+    _counter.record(kind, object_id)
+
+
+def flush_views():
+    return _counter.flush()
+
+
+def start_flushing():
+    _counter.start()
+
+
+@receiver(request_started)
+def flush_due_views(**kwargs):
+    # connected after close_old_connections, so this uses the connection the request goes on to use
+    if not _counter.running and _counter.due():
+        _counter.flush()
+
+
+def recent_views(kind, object_ids, days=30):
+    """Total views per object over the last ``days`` days, from the daily rollups."""
+    since = timezone.localdate() - datetime.timedelta(days=days - 1)
+    return dict(DailyViewCount.objects.filter(kind=kind, object_id__in=object_ids, date__gte=since)
+                .values("object_id").annotate(total=Sum("views")).values_list("object_id", "total"))
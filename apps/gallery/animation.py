@@ -0,0 +1,149 @@
+import io
+import logging
+import mimetypes
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .jobs import enqueue, task
+from .models import GalleryPiece
+from .public import piece_key, purge
+
+logger = logging.getLogger(__name__)
+
+ANIMATED_EXTENSIONS = (".gif",)
+# what browsers use for GIF frames that give no delay
+DEFAULT_FRAME_DURATION = 100
+MP4_CRF = 28
+
+# older Pythons do not know .webp, which storages need to set the right Content-Type
+mimetypes.add_type("image/webp", ".webp")
+
+
+def transcode_webp(data, quality):
+    """Animated WebP of an animated image, or None if it is not animated. Frames are encoded one at a time."""
+    from PIL import Image, ImageSequence, features
+
+    if not features.check_module("webp"):
+        return None
+    with Image.open(io.BytesIO(data)) as src:
+        if not getattr(src, "is_animated", False):
+            return None
+        durations = [frame.info.get("duration") or DEFAULT_FRAME_DURATION for frame in ImageSequence.Iterator(src)]
+        src.seek(0)
+        out = io.BytesIO()
+        src.save(out, "WEBP", save_all=True, duration=durations, loop=src.info.get("loop", 0),
+                 quality=quality, method=4)
+        return out.getvalue()
+
+
+def transcode_mp4(data, ffmpeg, timeout):
+    """
+    H.264 MP4 of an animated image made with ffmpeg, or None if ffmpeg is not installed or the
+    image has transparency, which MP4 cannot carry.
+    """
+    from PIL import Image
+
+    ffmpeg = shutil.which(ffmpeg)
+    if ffmpeg is None:
+        return None
+    with Image.open(io.BytesIO(data)) as src:
+        if "transparency" in src.info:
+            return None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source, target = os.path.join(tmp, "source"), os.path.join(tmp, "animation.mp4")
+        with open(source, "wb") as f:
+            f.write(data)
+        # yuv420p needs even dimensions; faststart lets playback begin before the download ends
+        subprocess.run([ffmpeg, "-nostdin", "-loglevel", "error", "-i", source, "-an",
+                        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", "-c:v", "libx264", "-crf", str(MP4_CRF),
+                        "-pix_fmt", "yuv420p", "-movflags", "+faststart", target],
+                       check=True, capture_output=True, timeout=timeout)
+        with open(target, "rb") as f:
+            return f.read()
+
+
+def _save(piece, field, name, data):
+    file = getattr(piece, field)
+    return file.storage.save(file.field.generate_filename(piece, name), ContentFile(data))
+
+
+@task(priority=-1)
+def transcode_animation(piece_id, source_name):
+    """
+    Make the animated renditions of an animated original. Each is only kept if it is smaller than
+    the one it would be served instead of: the WebP than the GIF, the MP4 than the WebP.
+    """
+    piece = GalleryPiece.objects.filter(id=piece_id, image=source_name).first()
+    if piece is None:
+        # deleted, or given another image since
+        return
+    with piece.image.open("rb") as f:
+        data = f.read()
+
+    webp = transcode_webp(data, settings.GALLERY_ANIMATION_QUALITY)
+    if webp is None or len(webp) >= len(data):
+        return
+    try:
+        mp4 = transcode_mp4(data, settings.GALLERY_FFMPEG, settings.GALLERY_ANIMATION_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Could not make an MP4 of piece %s: %s", piece_id, e)
+        mp4 = None
+
+    stem = os.path.splitext(os.path.basename(source_name))[0]
+    files = {"animated_webp": _save(piece, "animated_webp", stem + ".webp", webp)}
+    if mp4 is not None and len(mp4) < len(webp):
+        files["animated_mp4"] = _save(piece, "animated_mp4", stem + ".mp4", mp4)
+
+    if GalleryPiece.objects.filter(id=piece_id, image=source_name).update(**files):
+        purge([piece_key(piece_id)])
+    else:
+        for name in files.values():
+            default_storage.delete(name)
+
+
+@task(priority=-1)
+def remove_animation(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+@receiver(post_init, sender=GalleryPiece)
+def remember_animation_source(sender, instance, **kwargs):
+    instance._animation_source = instance.__dict__.get("image") and str(instance.__dict__["image"])
+
+
+@receiver(post_save, sender=GalleryPiece)
+def schedule_animation(sender, instance, created, **kwargs):
+    old = None if created else getattr(instance, "_animation_source", None)
+    new = instance.image.name or None
+    instance._animation_source = new
+    if old == new:
+        return
+
+    if old:
+        # the renditions may have been written since this instance was loaded
+        stale = [n for n in GalleryPiece.objects.filter(id=instance.id)
+                 .values_list("animated_webp", "animated_mp4").first() or () if n]
+        if stale:
+            GalleryPiece.objects.filter(id=instance.id).update(animated_webp="", animated_mp4="")
+            transaction.on_commit(lambda: enqueue(remove_animation, stale))
+        instance.animated_webp = instance.animated_mp4 = None
+    if new and new.lower().endswith(ANIMATED_EXTENSIONS) and settings.GALLERY_ANIMATIONS:
+        transaction.on_commit(lambda: enqueue(transcode_animation, instance.id, new))
+
+
+@receiver(post_delete, sender=GalleryPiece)
+def remove_deleted_animation(sender, instance, **kwargs):
+    names = [f.name for f in (instance.animated_webp, instance.animated_mp4) if f]
+    if names:
+        transaction.on_commit(lambda: enqueue(remove_animation, names))
@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class GalleryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gallery'
+
+    def ready(self):
+        # connect the rendition cache invalidation, storage quota, public page purge, snapshot,
+        # piece index, deep zoom and animation signals
+        from . import renditions  # noqa: F401
+        from . import quota  # noqa: F401
+        from . import public  # noqa: F401
+        from . import snapshot  # noqa: F401
+        from . import similarity  # noqa: F401
+        from . import colors  # noqa: F401
+        from . import deepzoom  # noqa: F401
+        from . import animation  # noqa: F401
@@ -0,0 +1,149 @@
+import functools
+import re
+
+from django.conf import settings
+
+from .indexes import PieceIndexCache
+from .models import GalleryPiece
+from .processing import PALETTE_SIZE
+
+COLOR_RE = re.compile(r"^#?([0-9a-fA-F]{6})$")
+ENTRY_LEN = 8
+
+# palette colours are indexed by 4 bits per channel, so distances to a query colour are worked
+# out once per bin (4096) rather than per piece
+BIN_BITS = 4
+BIN_LEVELS = 1 << BIN_BITS
+
+# when ranking, a colour covering none of a piece counts as this much further away (delta E)
+COVERAGE_PENALTY = 10
+
+
+def parse_color(value):
+    """An (r, g, b) tuple from '#aabbcc' or 'aabbcc', or None if the value is not a colour."""
+    match = COLOR_RE.match(value.strip())
+    if not match:
+        return None
+    digits = match.group(1)
+    return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def parse_palette(palette):
+    """The ((r, g, b), share) pairs of a stored palette, share being between 0 and 1."""
+    entries = []
+    for i in range(0, len(palette) - ENTRY_LEN + 1, ENTRY_LEN):
+        entry = palette[i:i + ENTRY_LEN]
+        entries.append((parse_color(entry[:6]), int(entry[6:], 16) / 255))
+    return entries
+
+
+def rgb_to_lab(rgb):
+    """CIELAB (D65) coordinates for an array of sRGB colours with channels 0-255."""
+    import numpy as np
+
+    c = np.asarray(rgb, dtype=np.float64) / 255
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.2126, 0.0193],
+                        [0.3576, 0.7152, 0.1192],
+                        [0.1805, 0.0722, 0.9505]]) / np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def color_bin(rgb):
+    r, g, b = (channel >> (8 - BIN_BITS) for channel in rgb)
+    return (r * BIN_LEVELS + g) * BIN_LEVELS + b
+
+
+@functools.lru_cache(maxsize=None)
+def bin_lab():
+    """CIELAB coordinates of the centre of every colour bin."""
+    import numpy as np
+
+    levels = (np.arange(BIN_LEVELS) + 0.5) * (256 / BIN_LEVELS)
+    r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+    return rgb_to_lab(np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)).astype(np.float32)
+
+
+def _encode(palette):
+    import numpy as np
+
+    bins = np.zeros(PALETTE_SIZE, dtype=np.uint16)
+    shares = np.zeros(PALETTE_SIZE, dtype=np.float32)
+    for i, (rgb, share) in enumerate(parse_palette(palette)[:PALETTE_SIZE]):
+        bins[i] = color_bin(rgb)
+        shares[i] = share
+    return bins, shares
+
+
+class ColorIndex:
+    """
+    One user's palettes as quantized colour bins: an (n, PALETTE_SIZE) array of bin numbers and
+    one of the share of the piece each colour covers (0 for unused slots). A query never looks at
+    an image, only at these arrays.
+
+    The arrays are held as one (ids, bins, shares) tuple that ``update`` replaces whole and never
+    modifies, so that searches, which take no lock, always see matching rows.
+    """
+
+    def __init__(self, ids, bins, shares):
+        import numpy as np
+
+        self.arrays = (np.asarray(ids, dtype=np.int64),
+                       np.asarray(bins, dtype=np.uint16).reshape(-1, PALETTE_SIZE),
+                       np.asarray(shares, dtype=np.float32).reshape(-1, PALETTE_SIZE))
+
+    @classmethod
+    def for_user(cls, user_id):
+        rows = GalleryPiece.objects.filter(user_id=user_id).exclude(palette="") \
+            .order_by().values_list("id", "palette")
+        encoded = [_encode(palette) for _, palette in rows]
+        return cls([piece_id for piece_id, _ in rows], [b for b, _ in encoded], [s for _, s in encoded])
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def search(self, rgb, max_distance):
+        """
+        (piece id, delta E) pairs for the pieces with a palette colour within ``max_distance`` of
+        ``rgb``. Close colours that cover more of the piece rank first.
+        """
+        import numpy as np
+
+        ids, bins, shares = self.arrays
+        to_bins = np.sqrt(((bin_lab() - rgb_to_lab(rgb).astype(np.float32)) ** 2).sum(axis=1))
+        distances = to_bins[bins]
+        distances[shares == 0] = np.inf
+        scores = distances + (1 - shares) * COVERAGE_PENALTY
+
+        best = scores.argmin(axis=1)
+        rows = np.arange(len(ids))
+        best_distances = distances[rows, best]
+        found = np.flatnonzero(best_distances <= max_distance)
+        found = found[np.argsort(scores[found, best[found]], kind="stable")]
+        return [(int(ids[i]), float(best_distances[i])) for i in found]
+
+    def update(self, piece_id, palette):
+        import numpy as np
+
+        ids, bins, shares = self.arrays
+        keep = ids != piece_id
+        ids, bins, shares = ids[keep], bins[keep], shares[keep]
+        if palette:
+            piece_bins, piece_shares = _encode(palette)
+            ids = np.append(ids, np.int64(piece_id))
+            bins = np.vstack([bins, piece_bins])
+            shares = np.vstack([shares, piece_shares])
+        self.arrays = (ids, bins, shares)
+
+
+indexes = PieceIndexCache("colors", ColorIndex, "palette")
+
+
+def find_by_color(user_id, rgb):
+    """The user's pieces containing a colour close to ``rgb``, best match first."""
+    matches = indexes.get(user_id).search(rgb, settings.GALLERY_COLOR_DISTANCE)
+    pieces = GalleryPiece.objects.in_bulk([piece_id for piece_id, _ in matches])
+    return [pieces[piece_id] for piece_id, _ in matches if piece_id in pieces]
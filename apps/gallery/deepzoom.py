@@ -0,0 +1,177 @@
+import io
+import math
+import os
+import re
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .jobs import enqueue, task
+from .media_urls import get_resolver
+from .models import GalleryPiece
+from .processing import flatten
+
+DEEP_ZOOM_DIR = "deepzoom/"
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+TILE_FORMAT = "jpg"
+TILE_QUALITY = 85
+
+DESCRIPTOR = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{}" Overlap="{}" TileSize="{}">'
+              '<Size Width="{}" Height="{}"/></Image>\n')
+DESCRIPTOR_SIZE_RE = re.compile(r'<Size Width="(\d+)" Height="(\d+)"')
+
+
+def pyramid_base(source_name):
+    """
+    Storage name, without extension, of the pyramid of an original image. It follows the Deep Zoom
+    (DZI) layout: a descriptor at <base>.dzi and tiles at <base>_files/<level>/<col>_<row>.jpg.
+    """
+    return DEEP_ZOOM_DIR + os.path.splitext(source_name)[0]
+
+
+def descriptor_name(source_name):
+    return pyramid_base(source_name) + ".dzi"
+
+
+def tile_name(source_name, level, col, row):
+    return "{}_files/{}/{}_{}.{}".format(pyramid_base(source_name), level, col, row, TILE_FORMAT)
+
+
+def max_level(width, height):
+    """Level of the full size image; level 0 is 1x1 and every level in between halves it."""
+    return math.ceil(math.log2(max(width, height)))
+
+
+def tile_box(level_width, level_height, col, row):
+    """The crop box of a tile: TILE_SIZE pixels square plus TILE_OVERLAP shared with each neighbour."""
+    left = col * TILE_SIZE - (TILE_OVERLAP if col else 0)
+    top = row * TILE_SIZE - (TILE_OVERLAP if row else 0)
+    right = min(level_width, (col + 1) * TILE_SIZE + TILE_OVERLAP)
+    bottom = min(level_height, (row + 1) * TILE_SIZE + TILE_OVERLAP)
+    return left, top, right, bottom
+
+
+def tile_names(source_name, width, height):
+    for level in range(max_level(width, height), -1, -1):
+        scale = 2 ** (max_level(width, height) - level)
+        level_width, level_height = math.ceil(width / scale), math.ceil(height / scale)
+        for col in range(math.ceil(level_width / TILE_SIZE)):
+            for row in range(math.ceil(level_height / TILE_SIZE)):
+                yield tile_name(source_name, level, col, row)
+
+
+def write_pyramid(img, source_name, storage):
+    """
+    Cut an image into the tiles of every level, from full size down to 1x1, saving each tile as
+    soon as it is encoded. Only the level being cut is held in memory; the next one is made from
+    it with a 2x2 box filter (``Image.reduce``).
+    """
+    width, height = img.size
+    level_img = img
+    for level in range(max_level(width, height), -1, -1):
+        level_width, level_height = level_img.size
+        for col in range(math.ceil(level_width / TILE_SIZE)):
+            for row in range(math.ceil(level_height / TILE_SIZE)):
+                out = io.BytesIO()
+                level_img.crop(tile_box(level_width, level_height, col, row)) \
+                    .save(out, "JPEG", quality=TILE_QUALITY)
+                storage.save(tile_name(source_name, level, col, row), ContentFile(out.getvalue()))
+        if level:
+            level_img = level_img.reduce(2)
+
+    descriptor = DESCRIPTOR.format(TILE_FORMAT, TILE_OVERLAP, TILE_SIZE, width, height)
+    storage.save(descriptor_name(source_name), ContentFile(descriptor.encode()))
+
+
+def delete_pyramid(source_name, storage):
+    """Delete a pyramid, finding its tiles from the size recorded in its descriptor."""
+    try:
+        with storage.open(descriptor_name(source_name), "rb") as f:
+            width, height = map(int, DESCRIPTOR_SIZE_RE.search(f.read().decode()).groups())
+    except (FileNotFoundError, OSError, AttributeError):
+        return False
+    for name in tile_names(source_name, width, height):
+        storage.delete(name)
+    storage.delete(descriptor_name(source_name))
+    return True
+
+
+@task(priority=-2)
+def build_deep_zoom(piece_id, source_name):
+    """Build the pyramid of a piece's original image, if it is larger than GALLERY_DEEP_ZOOM_MIN_EDGE."""
+    from PIL import Image, ImageOps
+
+    piece = GalleryPiece.objects.filter(id=piece_id, image=source_name).first()
+    if piece is None:
+        # deleted, or given another image since
+        return
+    storage = piece.image.storage
+
+    with piece.image.open("rb") as f, Image.open(f) as src:
+        if max(src.size) <= settings.GALLERY_DEEP_ZOOM_MIN_EDGE:
+            return
+        img = flatten(ImageOps.exif_transpose(src))
+
+        # what an interrupted build left behind would make the storage pick other names
+        if storage.exists(tile_name(source_name, max_level(*img.size), 0, 0)):
+            for name in tile_names(source_name, *img.size):
+                storage.delete(name)
+        write_pyramid(img, source_name, storage)
+
+    if not GalleryPiece.objects.filter(id=piece_id, image=source_name) \
+            .update(deep_zoom_width=img.width, deep_zoom_height=img.height):
+        delete_pyramid(source_name, storage)
+
+
+@task(priority=-2)
+def remove_deep_zoom(source_name):
+    delete_pyramid(source_name, default_storage)
+
+
+def viewer_options(piece, tile_url=True):
+    """
+    What the piece page's viewer needs to request tiles, or None if the piece has no pyramid.
+    ``tile_url`` is the URL the viewer fetches <level>/<col>_<row>.jpg from directly, if the media
+    URL mode allows one for the whole pyramid; otherwise it goes through the piece_tile view.
+    """
+    if not piece.deep_zoom_width or not piece.deep_zoom_height:
+        return None
+    if tile_url:
+        tile_url = get_resolver().resolve_prefix(pyramid_base(piece.image.name) + "_files/")
+    return {"width": piece.deep_zoom_width, "height": piece.deep_zoom_height,
+            "tile_size": TILE_SIZE, "overlap": TILE_OVERLAP, "format": TILE_FORMAT,
+            "tile_url": tile_url or None}
+
+
+@receiver(post_init, sender=GalleryPiece)
+def remember_deep_zoom_source(sender, instance, **kwargs):
+    instance._deep_zoom_source = instance.__dict__.get("image") and str(instance.__dict__["image"])
+
+
+@receiver(post_save, sender=GalleryPiece)
+def schedule_deep_zoom(sender, instance, created, **kwargs):
+    old = None if created else getattr(instance, "_deep_zoom_source", None)
+    new = instance.image.name or None
+    instance._deep_zoom_source = new
+    if old == new:
+        return
+
+    if old:
+        transaction.on_commit(lambda: enqueue(remove_deep_zoom, old))
+        GalleryPiece.objects.filter(id=instance.id).update(deep_zoom_width=None, deep_zoom_height=None)
+        instance.deep_zoom_width = instance.deep_zoom_height = None
+    if new and settings.GALLERY_DEEP_ZOOM:
+        transaction.on_commit(lambda: enqueue(build_deep_zoom, instance.id, new))
+
+
+@receiver(post_delete, sender=GalleryPiece)
+def remove_deleted_deep_zoom(sender, instance, **kwargs):
+    source = getattr(instance, "_deep_zoom_source", None)
+    if source:
+        transaction.on_commit(lambda: enqueue(remove_deep_zoom, source))
@@ -0,0 +1,210 @@
+import json
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import GalleryPiece, Exhibition
+
+EXPORT_CHUNK_SIZE = 1024 * 1024
+EXPORT_PREFETCH_OBJECTS = 4
+EXPORT_QUEUE_DEPTH = 4
+MANIFEST_NAME = "manifest.json"
+IMAGES_DIR = "images/"
+
+_END = object()
+
+
+class _ArchiveSink:
+    """Write-only, unseekable file object that buffers zip output until it is drained."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def iter_storage_chunks(storage, name, chunk_size=EXPORT_CHUNK_SIZE, client=None):
+    """
+    Yield the contents of a stored file in chunks. On S3 each chunk is its own ranged GET so
+    the object is never spooled to a temp file.
+    """
+    if client is not None:
+        key = storage._normalize_name(name)
+        start = 0
+        while True:
+            obj = client.get_object(Bucket=storage.bucket_name, Key=key,
+                                    Range="bytes={}-{}".format(start, start + chunk_size - 1))
+            data = obj["Body"].read()
+            if data:
+                yield data
+            start += len(data)
+            total = int(obj.get("ContentRange", "/0").rsplit("/", 1)[-1] or 0)
+            if not data or start >= total:
+                return
+
+    with storage.open(name, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+def _s3_client(storage):
+    # Only boto3-backed storages expose a connection; resolve the client once so every
+    # prefetch thread shares it instead of building its own session.
+    connection = getattr(storage, "connection", None)
+    if connection is None:
+        return None
+    return connection.meta.client
+
+
+class _Prefetcher:
+    """
+    Read the next few storage objects concurrently, each into a small bounded queue, while the
+    caller consumes the current one. Memory stays bounded by prefetch * depth * chunk_size.
+    """
+
+    def __init__(self, storage, names, chunk_size, prefetch, depth):
+        self.storage = storage
+        self.client = _s3_client(storage)
+        self.names = iter(names)
+        self.chunk_size = chunk_size
+        self.prefetch = max(1, prefetch)
+        self.depth = max(1, depth)
+        self.stop = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.prefetch,
+                                           thread_name_prefix="gallery-export")
+        self.pending = deque()
+
+    def _put(self, q, item):
+        """Queue an item unless the consumer went away first; returns whether it was queued."""
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, name, q):
+        try:
+            for chunk in iter_storage_chunks(self.storage, name, self.chunk_size, self.client):
+                if not self._put(q, chunk):
+                    return
+        except Exception as e:
+            self._put(q, e)
+            return
+        self._put(q, _END)
+
+    def _fill(self):
+        while len(self.pending) < self.prefetch:
+            try:
+                name = next(self.names)
+            except StopIteration:
+                return
+            q = queue.Queue(maxsize=self.depth)
+            self.executor.submit(self._read, name, q)
+            self.pending.append((name, q))
+
+    def __iter__(self):
+        try:
+            self._fill()
+            while self.pending:
+                name, q = self.pending.popleft()
+                yield name, self._chunks(q)
+                self._fill()
+        finally:
+            self.close()
+
+    def _chunks(self, q):
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self.stop.set()
+        self.executor.shutdown(wait=False)
+
+
+def archive_name(piece):
+    return IMAGES_DIR + "{}-{}".format(piece.id, os.path.basename(piece.image.name))
+
+
+def build_manifest(user, pieces):
+    exhibs = Exhibition.objects.filter(user=user).order_by("id")
+    memberships = GalleryPiece.galleries.through.objects \
+        .filter(gallerypiece__user=user) \
+        .order_by("gallerypiece_id", "exhibition_id") \
+        .values_list("gallerypiece_id", "exhibition_id")
+
+    return {
+        "user": user.username,
+        "exported_at": timezone.now().isoformat(),
+        "pieces": [{"id": p.id,
+                    "title": p.title,
+                    "description": p.description,
+                    "pub_date": p.pub_date.isoformat(),
+                    "image": archive_name(p) if p.image else None}
+                   for p in pieces],
+        "exhibitions": [{"id": e.id,
+                         "title": e.title,
+                         "description": e.description}
+                        for e in exhibs],
+        "memberships": [{"piece": piece_id, "exhibition": exhib_id}
+                        for piece_id, exhib_id in memberships],
+    }
+
+
+def stream_user_archive(user, storage=None, chunk_size=EXPORT_CHUNK_SIZE,
+                        prefetch=EXPORT_PREFETCH_OBJECTS, depth=EXPORT_QUEUE_DEPTH):
+    """
+    Generate a ZIP archive of all of a user's piece images plus a JSON manifest of pieces,
+    exhibitions and memberships. The archive is written on the fly, chunk by chunk.
+    """
+    import zipfile  # only needed by exports, so kept off the worker boot path
+
+    storage = storage or default_storage
+    pieces = list(GalleryPiece.objects.filter(user=user).order_by("id"))
+    with_images = [p for p in pieces if p.image]
+    names = {p.image.name: archive_name(p) for p in with_images}
+
+    sink = _ArchiveSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        manifest = json.dumps(build_manifest(user, pieces), indent=2)
+        zf.writestr(MANIFEST_NAME, manifest)
+        yield sink.drain()
+
+        date_time = timezone.now().timetuple()[:6]
+        prefetcher = _Prefetcher(storage, [p.image.name for p in with_images],
+                                 chunk_size, prefetch, depth)
+        for name, chunks in prefetcher:
+            info = zipfile.ZipInfo(names[name], date_time=date_time)
+            with zf.open(info, mode="w", force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+
+    yield sink.drain()
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import GalleryPiece
+
+_registry = []
+
+
+class PieceIndexCache:
+    """
+    Per-process cache of in-memory, per-user indexes over one GalleryPiece field, kept for the
+    GALLERY_INDEX_MAX_USERS most recently used users. A version number per user in
+    GALLERY_INDEX_CACHE, bumped after every committed change to the field, tells each process
+    when its copy is stale; the process that made the change patches its copy in place instead.
+    With several workers that cache must be shared, or a worker would never see the others'
+    changes; the settings enforce this.
+
+    ``index_class`` provides ``for_user(user_id)`` to build an index and ``update(piece_id, value)``
+    to apply a change (None, or an empty value, removes the piece).
+    """
+
+    def __init__(self, name, index_class, field):
+        self.index_class = index_class
+        self.field = field
+        self.version_key = "index:{}:v:".format(name)
+        self.attr = "_indexed_" + field
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        post_init.connect(self.remember, sender=GalleryPiece, weak=False, dispatch_uid=self.version_key)
+        post_save.connect(self.saved, sender=GalleryPiece, weak=False, dispatch_uid=self.version_key)
+        post_delete.connect(self.deleted, sender=GalleryPiece, weak=False, dispatch_uid=self.version_key)
+        _registry.append(self)
+
+    def _cache(self):
+        return caches[settings.GALLERY_INDEX_CACHE]
+
+    def get(self, user_id):
+        version = self._cache().get(self.version_key + str(user_id), 0)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+
+        index = self.index_class.for_user(user_id)
+        with self.lock:
+            self.entries[user_id] = (version, index)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > settings.GALLERY_INDEX_MAX_USERS:
+                self.entries.popitem(last=False)
+        return index
+
+    def changed(self, user_id, piece_id, value):
+        key = self.version_key + str(user_id)
+        try:
+            version = self._cache().incr(key)
+        except ValueError:
+            self._cache().set(key, 1, None)
+            version = 1
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return
+            if entry[0] == version - 1:
+                # nobody else changed the index meanwhile: patch this process's copy instead of rebuilding
+                entry[1].update(piece_id, value)
+                self.entries[user_id] = (version, entry[1])
+            else:
+                del self.entries[user_id]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def remember(self, sender, instance, **kwargs):
+        setattr(instance, self.attr, instance.__dict__.get(self.field))
+
+    def saved(self, sender, instance, created, update_fields=None, **kwargs):
+        if update_fields is not None and self.field not in update_fields:
+            return
+        value = getattr(instance, self.field)
+        if created or value != getattr(instance, self.attr, None):
+            setattr(instance, self.attr, value)
+            user_id, piece_id = instance.user_id, instance.id
+            transaction.on_commit(lambda: self.changed(user_id, piece_id, value))
+
+    def deleted(self, sender, instance, **kwargs):
+        user_id, piece_id = instance.user_id, instance.id
+        transaction.on_commit(lambda: self.changed(user_id, piece_id, None))
+
+
+@receiver(setting_changed)
+def reset_indexes(setting, **kwargs):
+    if setting in ('GALLERY_INDEX_CACHE', 'CACHES'):
+        for index_cache in _registry:
+            index_cache.clear()
@@ -0,0 +1,236 @@
+import contextlib
+import datetime
+import importlib
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# jobs looked at per claim attempt where rows cannot be locked (SQLite)
+CLAIM_CANDIDATES = 10
+
+_tasks = {}
+
+
+class UnknownTask(Exception):
+    pass
+
+
+def task(fn=None, *, priority=0, max_attempts=5):
+    """
+    Register a function as a background task, named by its dotted path. Its arguments must be
+    JSON serializable. Queue it with enqueue(); ``manage.py runworker`` runs it.
+    """
+    def register(fn):
+        fn.task_name = "{}.{}".format(fn.__module__, fn.__qualname__)
+        fn.task_priority = priority
+        fn.task_max_attempts = max_attempts
+        _tasks[fn.task_name] = fn
+        return fn
+    return register(fn) if fn is not None else register
+
+
+def get_task(name):
+    """The task registered under ``name``, importing its module if needed. Unregistered functions never run."""
+    if name not in _tasks:
+        module = name.rpartition(".")[0]
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    if name not in _tasks:
+        raise UnknownTask(name)
+    return _tasks[name]
+
+
+def enqueue(fn, *args, priority=None, delay=0, dedupe_key=None, max_attempts=None, **kwargs):
+    """
+    Queue a call of a task, to run after ``delay`` seconds. If a job with the same ``dedupe_key``
+    is already waiting to run, nothing is queued and that job is returned instead.
+    """
+    job = Job(task=fn.task_name, args=list(args), kwargs=kwargs,
+              priority=fn.task_priority if priority is None else priority,
+              max_attempts=max_attempts or fn.task_max_attempts,
+              run_at=timezone.now() + datetime.timedelta(seconds=delay),
+              dedupe_key=dedupe_key, retry_key=dedupe_key or "")
+    if dedupe_key is None:
+        job.save()
+        return job
+
+    while True:
+        try:
+            with transaction.atomic():
+                job.save()
+            return job
+        except IntegrityError:
+            existing = Job.objects.filter(dedupe_key=dedupe_key).first()
+            if existing is not None:
+                return existing
+            # the waiting job was claimed meanwhile, which released the key; another job may take
+            # it again before this one does, so go round until one of the two wins
+
+
+def claim(worker):
+    """
+    Mark the next due job as running on ``worker`` and return it, or None if there is none. Rows
+    are locked with SELECT ... FOR UPDATE SKIP LOCKED where the database supports it (MySQL 8,
+    PostgreSQL), so workers never wait on each other; elsewhere (SQLite, which locks the whole
+    database for writes anyway) a conditional UPDATE decides which worker gets a job.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by("-priority", "run_at", "id")
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job_id = due.select_for_update(skip_locked=True).values_list("id", flat=True).first()
+            if job_id is None:
+                return None
+            _mark_running(job_id, worker, now)
+        return Job.objects.get(id=job_id)
+
+    for job_id in due.values_list("id", flat=True)[:CLAIM_CANDIDATES]:
+        if _mark_running(job_id, worker, now):
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def _mark_running(job_id, worker, now):
+    # a running job releases its dedupe key: changes made from now on need another run
+    return Job.objects.filter(id=job_id, status=Job.QUEUED).update(
+        status=Job.RUNNING, locked_by=worker, locked_at=now, attempts=F("attempts") + 1, dedupe_key=None)
+
+
+def _lease(job):
+    """The job's row, as long as the worker running this attempt still holds it."""
+    return Job.objects.filter(id=job.id, status=Job.RUNNING, locked_by=job.locked_by, attempts=job.attempts)
+
+
+@contextlib.contextmanager
+def heartbeat(job):
+    """
+    Renew a running job's lease (its locked_at) every GALLERY_JOB_HEARTBEAT seconds from a
+    background thread, so that requeue_stale() only takes back the jobs of dead workers, however
+    long a job runs.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.GALLERY_JOB_HEARTBEAT):
+                try:
+                    if not _lease(job).update(locked_at=timezone.now()):
+                        logger.warning("Job %s (%s) lost its lease", job.id, job.task)
+                        return
+                except DatabaseError as e:
+                    logger.warning("Could not renew the lease of job %s: %s", job.id, e)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name="job-{}-heartbeat".format(job.id), daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter: about GALLERY_JOB_RETRY_DELAY * 2^(attempts - 1) seconds."""
+    delay = min(settings.GALLERY_JOB_RETRY_DELAY * 2 ** (attempts - 1), settings.GALLERY_JOB_MAX_RETRY_DELAY)
+    return delay * random.uniform(0.75, 1.0)
+
+
+def run_job(job):
+    """Run a claimed job and record the outcome. Returns True if it succeeded."""
+    try:
+        fn = get_task(job.task)
+        with heartbeat(job):
+            fn(*job.args, **job.kwargs)
+    except Exception as e:
+        logger.warning("Job %s (%s) failed on attempt %s: %s", job.id, job.task, job.attempts, e)
+        fail(job, traceback.format_exc(), retry=not isinstance(e, UnknownTask))
+        return False
+
+    # if the lease was lost, the job was requeued and its outcome is up to the attempt that took it
+    _lease(job).update(status=Job.DONE, finished_at=timezone.now(), last_error="")
+    return True
+
+
+def _queue_again(rows, key, error, **fields):
+    """
+    Put a running job back in the queue, taking back its dedupe key. If a newer job has been
+    queued under that key meanwhile, it will do the same work, so this one is failed instead.
+    Returns the number of jobs queued again.
+    """
+    fields.update(status=Job.QUEUED, last_error=error)
+    if not key:
+        return rows.update(**fields)
+    try:
+        with transaction.atomic():
+            return rows.update(dedupe_key=key, **fields)
+    except IntegrityError:
+        rows.update(status=Job.FAILED, finished_at=timezone.now(),
+                    last_error=error + "\nNot retried: a newer job is queued with the same dedupe key.")
+        return 0
+
+
+def fail(job, error, retry=True):
+    now = timezone.now()
+    if retry and job.attempts < job.max_attempts:
+        _queue_again(_lease(job), job.retry_key, error,
+                     run_at=now + datetime.timedelta(seconds=retry_delay(job.attempts)))
+    else:
+        _lease(job).update(status=Job.FAILED, last_error=error, finished_at=now)
+
+
+def requeue_stale():
+    """
+    Put back jobs whose worker went away: running jobs whose lease has not been renewed (see
+    heartbeat()) for GALLERY_JOB_TIMEOUT seconds.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.GALLERY_JOB_TIMEOUT)
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff)
+    failed = stale.filter(attempts__gte=F("max_attempts")).update(
+        status=Job.FAILED, last_error="Timed out", finished_at=timezone.now())
+    requeued = stale.filter(retry_key="").update(status=Job.QUEUED, last_error="Timed out")
+    for job_id, key in stale.values_list("id", "retry_key"):
+        requeued += _queue_again(stale.filter(id=job_id), key, "Timed out")
+    return requeued + failed
+
+
+def prune():
+    """Delete jobs that finished successfully more than GALLERY_JOB_RETENTION days ago."""
+    cutoff = timezone.now() - datetime.timedelta(days=settings.GALLERY_JOB_RETENTION)
+    deleted, _ = Job.objects.filter(status=Job.DONE, finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def worker_name(n):
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), n)
+
+
+def work(name, stop, poll_interval, burst=False):
+    """
+    Claim and run jobs until ``stop`` (a threading or multiprocessing Event) is set; a job that has
+    started always finishes. With ``burst``, return as soon as no job is due.
+    """
+    while not stop.is_set():
+        job = claim(name)
+        if job is None:
+            if burst:
+                break
+            stop.wait(poll_interval)
+            continue
+        run_job(job)
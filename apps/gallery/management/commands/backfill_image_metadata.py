@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from gallery.models import GalleryPiece
+from gallery.processing import analyze_stored_image, run_in_pool
+
+DEFAULT_WORKERS = 8
+
+
+def read_file(field):
+    with field.open("rb") as f:
+        return f.read()
+
+
+def analyze_piece(piece):
+    original = read_file(piece.image)
+    display = read_file(piece.optimized) if piece.optimized else None
+    return run_in_pool(analyze_stored_image, original, display)
+
+
+class Command(BaseCommand):
+    help = "Compute stored image metadata (dimensions, placeholder, palette, size, format, hashes) " \
+           "for pieces that are missing it."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Recompute metadata for every piece")
+        parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                            help="Number of pieces fetched and analyzed concurrently")
+
+    def handle(self, *args, **options):
+        pieces = GalleryPiece.objects.exclude(image="").exclude(image=None)
+        if not options["all"]:
+            pieces = pieces.filter(Q(placeholder="") | Q(width=None) | Q(height=None) |
+                                   Q(image_size=None) | Q(image_hash="") | Q(perceptual_hash=None) |
+                                   Q(palette=""))
+
+        workers = max(1, options["workers"])
+        done = 0
+        failed = 0
+
+        # Storage reads and decoding happen on the worker threads (decoding is further handed off
+        # to the image process pool); results are saved here so only this thread touches the DB.
+        # At most 2 * workers pieces are in flight at once.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+            remaining = pieces.iterator(chunk_size=500)
+
+            while True:
+                for piece in remaining:
+                    in_flight[executor.submit(analyze_piece, piece)] = piece
+                    if len(in_flight) >= 2 * workers:
+                        break
+
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    piece = in_flight.pop(future)
+                    try:
+                        metadata = future.result()
+                    except Exception as e:
+                        self.stderr.write("Piece {}: {}".format(piece.id, e))
+                        failed += 1
+                        continue
+
+                    metadata.pop("optimized", None)
+                    piece.save(update_fields=piece.apply_image_metadata(metadata))
+                    done += 1
+
+        self.stdout.write(self.style.SUCCESS("Updated {} pieces ({} failed)".format(done, failed)))
@@ -0,0 +1,67 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from gallery.models import Exhibition
+
+MESSAGE_STORAGES = {
+    'session': 'django.contrib.messages.storage.session.SessionStorage',
+    'cookie': 'django.contrib.messages.storage.cookie.CookieStorage',
+}
+
+
+class Command(BaseCommand):
+    help = "Measure per-request overhead of authenticated gallery requests for each session backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--requests", type=int, default=200)
+        parser.add_argument("--host", default=settings.ALLOWED_HOSTS[0])
+
+    def handle(self, *args, **options):
+        n = options["requests"]
+
+        self.stdout.write("{:<16}{:<10}{:<8}{:>14}{:>14}".format(
+            "session", "messages", "path", "us/request", "queries/req"))
+
+        # Everything runs inside a transaction that is rolled back, so the benchmark user and its
+        # sessions never reach the database.
+        with transaction.atomic():
+            user = User.objects.create_user(username="__bench_sessions__", password="bench")
+            exhib = Exhibition.objects.create(title="Bench", description="", user=user)
+
+            for backend, engine in settings.SESSION_ENGINES.items():
+                for storage_name, storage in MESSAGE_STORAGES.items():
+                    with override_settings(SESSION_ENGINE=engine, MESSAGE_STORAGE=storage):
+                        cache.clear()
+                        client = Client(SERVER_NAME=options["host"])
+                        client.force_login(user)
+
+                        read = self.measure(n, lambda: client.get("/gallery/pieces/"))
+                        flash = self.measure(n, lambda: client.post(
+                            "/gallery/exhibitions/{}/edit/".format(exhib.id),
+                            {"exhibTitle": exhib.title, "exhibDesc": exhib.description},
+                            follow=True))
+
+                    for path, (us, queries) in [("read", read), ("flash", flash)]:
+                        self.stdout.write("{:<16}{:<10}{:<8}{:>14.1f}{:>14.2f}".format(
+                            backend, storage_name, path, us, queries))
+
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def measure(n, request):
+        request()
+
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            for _ in range(n):
+                request()
+            elapsed = time.perf_counter() - start
+
+        return elapsed / n * 1e6, len(ctx.captured_queries) / n
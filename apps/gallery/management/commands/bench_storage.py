@@ -0,0 +1,75 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from joshuasgallery_server.storage import GalleryS3Storage, MB
+
+# boto3's TransferConfig and botocore's defaults, which the stock storage uses
+STOCK_TRANSFER = {
+    "multipart_threshold": 8 * MB,
+    "multipart_chunksize": 8 * MB,
+    "max_concurrency": 10,
+    "max_pool_connections": 10,
+}
+
+
+class Command(BaseCommand):
+    help = "Compare upload throughput of the stock S3 storage and GalleryS3Storage against an " \
+           "S3-compatible endpoint (e.g. a local MinIO or moto server). 'shared' differs from " \
+           "'stock' only in sharing one client between threads; 'tuned' adds the AWS_S3_* " \
+           "transfer and pool settings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--endpoint-url", default=os.environ.get("AWS_S3_ENDPOINT_URL", "http://localhost:9000"))
+        parser.add_argument("--bucket", default="bench-storage")
+        parser.add_argument("--sizes", default="0.1,1,10,50", help="Comma separated upload sizes in MB")
+        parser.add_argument("-n", "--uploads", type=int, default=8, help="Uploads per round")
+        parser.add_argument("--rounds", type=int, default=3,
+                            help="Rounds per size, each from new threads as a recycled worker would have")
+        parser.add_argument("--threads", type=int, default=4, help="Concurrent uploading threads")
+
+    def handle(self, *args, **options):
+        common = {
+            "endpoint_url": options["endpoint_url"],
+            "bucket_name": options["bucket"],
+            "access_key": os.environ.get("AWS_ACCESS_KEY_ID", "bench"),
+            "secret_key": os.environ.get("AWS_SECRET_ACCESS_KEY", "benchbench"),
+            "region_name": "us-east-1",
+            "use_ssl": options["endpoint_url"].startswith("https"),
+        }
+        storages = [("stock", S3Boto3Storage(**common)),
+                    ("shared", GalleryS3Storage(**common, **STOCK_TRANSFER)),
+                    ("tuned", GalleryS3Storage(**common))]
+
+        client = storages[0][1].connection.meta.client
+        try:
+            client.create_bucket(Bucket=options["bucket"])
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+        self.stdout.write("{:<8}{:>10}{:>12}{:>12}".format("storage", "size MB", "seconds", "MB/s"))
+        for size in [float(s) for s in options["sizes"].split(",")]:
+            payload = os.urandom(int(size * MB))
+            for label, storage in storages:
+                names = []
+
+                def upload(_):
+                    name = "bench/{}/{}.bin".format(label, uuid.uuid4().hex)
+                    names.append(storage.save(name, ContentFile(payload)))
+
+                start = time.perf_counter()
+                for _ in range(options["rounds"]):
+                    with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+                        list(executor.map(upload, range(options["uploads"])))
+                elapsed = time.perf_counter() - start
+
+                self.stdout.write("{:<8}{:>10g}{:>12.2f}{:>12.1f}".format(
+                    label, size, elapsed, size * options["uploads"] * options["rounds"] / elapsed))
+
+                for name in names:
+                    storage.delete(name)
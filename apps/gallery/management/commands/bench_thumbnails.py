@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes."""
+    try:
+        # unlike ru_maxrss, VmHWM starts afresh when a process execs, so it is not the parent's
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux but in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def measure(path, fast, width, height, iterations):
+    """Seconds per thumbnail and peak RSS growth in bytes; run in a fresh process so the peak is its own."""
+    from PIL import Image
+    from pilkit.processors import ResizeToFill
+
+    from gallery.processors import FastResizeToFill
+
+    processor = (FastResizeToFill if fast else ResizeToFill)(width, height)
+    before = peak_rss()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with Image.open(path) as img:
+            processor.process(img).load()
+    elapsed = time.perf_counter() - start
+    return elapsed / iterations, peak_rss() - before
+
+
+def run(*args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(measure, *args).result()
+
+
+class Command(BaseCommand):
+    help = "Compare time and peak memory of the stock ResizeToFill and FastResizeToFill (JPEG draft " \
+           "decoding plus reduce()) when making thumbnails of the images in a directory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", default=os.path.join(settings.BASE_DIR, "test", "images"))
+        parser.add_argument("--size", default="100x50", help="Thumbnail size, WIDTHxHEIGHT")
+        parser.add_argument("-n", "--iterations", type=int, default=10, help="Thumbnails per image and processor")
+        parser.add_argument("--upscale", type=int, default=1,
+                            help="Enlarge each image by this factor first, to stand in for high-resolution scans")
+
+    def handle(self, *args, **options):
+        from PIL import Image
+
+        try:
+            width, height = (int(v) for v in options["size"].lower().split("x"))
+        except ValueError:
+            raise CommandError("--size must look like 100x50")
+
+        names = sorted(f for f in os.listdir(options["images"]) if not f.startswith("."))
+        self.stdout.write("{:<16}{:>12}{:>11}{:>11}{:>9}{:>11}{:>11}".format(
+            "image", "pixels", "stock ms", "fast ms", "speedup", "stock MB", "fast MB"))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in names:
+                path = os.path.join(options["images"], name)
+                try:
+                    with Image.open(path) as img:
+                        size, fmt = img.size, img.format
+                        if options["upscale"] > 1:
+                            size = (size[0] * options["upscale"], size[1] * options["upscale"])
+                            path = os.path.join(tmp, name)
+                            img.resize(size, Image.BICUBIC).save(path, fmt)
+                except OSError:
+                    continue
+
+                stock_time, stock_mem = run(path, False, width, height, options["iterations"])
+                fast_time, fast_mem = run(path, True, width, height, options["iterations"])
+                self.stdout.write("{:<16}{:>12}{:>11.1f}{:>11.1f}{:>8.1f}x{:>11.1f}{:>11.1f}".format(
+                    name[:15], "{}x{}".format(*size), stock_time * 1000, fast_time * 1000,
+                    stock_time / fast_time, stock_mem / 2 ** 20, fast_mem / 2 ** 20))
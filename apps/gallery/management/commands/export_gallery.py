@@ -0,0 +1,32 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from gallery.export import stream_user_archive, EXPORT_CHUNK_SIZE, EXPORT_PREFETCH_OBJECTS
+
+
+class Command(BaseCommand):
+    help = "Write a ZIP backup of a user's pieces, exhibitions and images."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("-o", "--output", help="Archive path (default: <username>-gallery.zip)")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument("--prefetch", type=int, default=EXPORT_PREFETCH_OBJECTS,
+                            help="Number of storage objects to read ahead concurrently")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError("User '{}' does not exist".format(options["username"]))
+
+        output = options["output"] or "{}-gallery.zip".format(user.username)
+        written = 0
+        with open(output, "wb") as f:
+            for data in stream_user_archive(user,
+                                            chunk_size=options["chunk_size"],
+                                            prefetch=options["prefetch"]):
+                f.write(data)
+                written += len(data)
+
+        self.stdout.write(self.style.SUCCESS("Wrote {} bytes to {}".format(written, output)))
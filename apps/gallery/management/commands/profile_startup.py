@@ -0,0 +1,103 @@
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Boots the project in a fresh interpreter the way a WSGI worker does (including wsgi.py's preload
+# warm-up when enabled), serves two requests and reports timings (in microseconds) as JSON on the
+# last line of stdout.
+CHILD_SCRIPT = """
+import io, json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.conf import settings
+from django.utils.module_loading import import_string
+application = import_string(settings.WSGI_APPLICATION)
+loaded = time.perf_counter()
+
+def request(path):
+    status = []
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'wsgi.url_scheme': 'http',
+               'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr}
+    body = application(environ, lambda s, headers, exc_info=None: status.append(s))
+    for _ in body:
+        pass
+    body.close()
+    return status[0]
+
+status = request(sys.argv[1])
+first = time.perf_counter()
+request(sys.argv[1])
+second = time.perf_counter()
+
+us = lambda a, b: int((b - a) * 1e6)
+print(json.dumps({'setup': us(start, setup), 'application': us(setup, loaded),
+                  'first_request': us(loaded, first), 'second_request': us(first, second),
+                  'status': status}))
+"""
+
+
+def parse_importtime(lines):
+    """Parse ``-X importtime`` output into (module, self us, cumulative us, depth) tuples."""
+    entries = []
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative), depth))
+    return entries
+
+
+def aggregate(entries):
+    """Total self import time and module count per top-level package, most expensive first."""
+    totals = defaultdict(lambda: [0, 0])
+    for name, self_us, _, _ in entries:
+        package = totals[name.split(".")[0]]
+        package[0] += self_us
+        package[1] += 1
+    return sorted(((p, us, n) for p, (us, n) in totals.items()), key=lambda t: t[1], reverse=True)
+
+
+class Command(BaseCommand):
+    help = "Report import cost per package and time to first request for a fresh worker process."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default="/", help="Path of the first request")
+        parser.add_argument("--top", type=int, default=20, help="Number of packages and modules to list")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            "DJANGO_SETTINGS_MODULE", "joshuasgallery_server.settings"))
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD_SCRIPT, options["path"]],
+                                capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            raise CommandError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else
+                               "Startup failed")
+
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        entries = parse_importtime(result.stderr.splitlines())
+        top = options["top"]
+
+        self.stdout.write("{:<40}{:>12}{:>10}".format("package", "self ms", "modules"))
+        for package, self_us, count in aggregate(entries)[:top]:
+            self.stdout.write("{:<40}{:>12.1f}{:>10}".format(package, self_us / 1000, count))
+
+        self.stdout.write("")
+        self.stdout.write("{:<40}{:>12}".format("top-level import", "cumul. ms"))
+        roots = sorted((e for e in entries if e[3] == 0), key=lambda e: e[2], reverse=True)
+        for name, _, cumulative, _ in roots[:top]:
+            self.stdout.write("{:<40}{:>12.1f}".format(name, cumulative / 1000))
+
+        self.stdout.write("")
+        self.stdout.write("imports:        {:>10.1f} ms ({} modules)".format(
+            sum(e[1] for e in entries) / 1000, len(entries)))
+        for key in ("setup", "application", "first_request", "second_request"):
+            self.stdout.write("{:<16}{:>10.1f} ms".format(key + ":", timings[key] / 1000))
+        self.stdout.write("first response:  {}".format(timings["status"]))
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from gallery.models import GalleryPiece, StorageQuota
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_WORKERS = 4
+
+
+def reconcile_batch(user_ids):
+    """
+    Recompute the totals for a batch of users from the pieces' recorded image sizes. The sum and
+    the write happen in one UPDATE per batch, so uploads made meanwhile are not lost.
+    """
+    StorageQuota.objects.bulk_create([StorageQuota(user_id=u) for u in user_ids], ignore_conflicts=True)
+    totals = GalleryPiece.objects.filter(user_id=OuterRef("user_id")) \
+        .order_by().values("user_id").annotate(total=Sum("image_size")).values("total")
+    return StorageQuota.objects.filter(user_id__in=user_ids) \
+        .update(used_bytes=Coalesce(Subquery(totals), Value(0)))
+
+
+def reconcile_batch_in_thread(user_ids):
+    try:
+        return reconcile_batch(user_ids)
+    finally:
+        # each worker thread gets its own database connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Recompute every user's storage quota usage from the sizes recorded on their pieces."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Number of users updated per statement")
+        parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                            help="Number of batches updated concurrently (1 to run in this thread)")
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options["batch_size"])
+        user_ids = list(User.objects.order_by("id").values_list("id", flat=True))
+        batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+
+        if options["workers"] <= 1:
+            updated = sum(reconcile_batch(b) for b in batches)
+        else:
+            with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                updated = sum(executor.map(reconcile_batch_in_thread, batches))
+
+        missing = GalleryPiece.objects.exclude(image="").filter(image_size=None).count()
+        if missing:
+            self.stderr.write("{} pieces have no recorded size; run backfill_image_metadata first".format(missing))
+        self.stdout.write(self.style.SUCCESS("Reconciled {} quotas".format(updated)))
@@ -0,0 +1,91 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections
+
+from gallery.jobs import prune, requeue_stale, work, worker_name
+
+MODES = ['thread', 'process']
+MAINTENANCE_INTERVAL = 60
+
+
+def work_in_thread(n, stop, poll_interval, burst):
+    try:
+        work(worker_name(n), stop, poll_interval, burst)
+    finally:
+        # each worker thread has its own database connection
+        connection.close()
+
+
+def work_in_process(n, stop, poll_interval, burst):
+    # the parent forwards shutdown through ``stop``; don't die mid-job on a terminal's Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    work_in_thread(n, stop, poll_interval, burst)
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the database queue until interrupted (SIGINT/SIGTERM finish " \
+           "the running jobs, then exit)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.GALLERY_JOB_CONCURRENCY,
+                            help="Number of jobs run at once")
+        parser.add_argument("--mode", choices=MODES, default=settings.GALLERY_JOB_MODE,
+                            help="Run jobs on threads, or on processes for CPU-bound tasks")
+        parser.add_argument("--poll-interval", type=float, default=settings.GALLERY_JOB_POLL_INTERVAL,
+                            help="Seconds an idle worker waits before looking for jobs again")
+        parser.add_argument("--burst", action="store_true", help="Exit once no jobs are due")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        if concurrency < 1:
+            raise CommandError("--concurrency must be at least 1")
+
+        if options["mode"] == "process":
+            # children are forked and must not share the parent's database connections
+            connections.close_all()
+            context = multiprocessing.get_context("fork")
+            stop = context.Event()
+            workers = [context.Process(target=work_in_process, daemon=True,
+                                       args=(n, stop, options["poll_interval"], options["burst"]))
+                       for n in range(concurrency)]
+        else:
+            stop = threading.Event()
+            workers = [threading.Thread(target=work_in_thread, name="jobs-{}".format(n), daemon=True,
+                                        args=(n, stop, options["poll_interval"], options["burst"]))
+                       for n in range(concurrency)]
+
+        def shutdown(signum, frame):
+            if not stop.is_set():
+                self.stdout.write("Stopping after the running jobs finish...")
+                stop.set()
+
+        previous = {sig: signal.signal(sig, shutdown) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self.stdout.write("Running {} {} workers".format(concurrency, options["mode"]))
+            for w in workers:
+                w.start()
+
+            # this thread requeues jobs of dead workers and prunes old ones while the workers run
+            while any(w.is_alive() for w in workers):
+                try:
+                    requeued, pruned = requeue_stale(), prune()
+                except DatabaseError as e:
+                    # e.g. the database is busy with the workers' writes; try again next time
+                    self.stderr.write("Skipped maintenance: {}".format(e))
+                else:
+                    if requeued or pruned:
+                        self.stdout.write("Requeued {} stale jobs, pruned {} finished jobs".format(requeued, pruned))
+                deadline = time.monotonic() + MAINTENANCE_INTERVAL
+                for w in workers:
+                    w.join(max(0, deadline - time.monotonic()))
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            connection.close()
+        self.stdout.write(self.style.SUCCESS("Workers stopped"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from gallery.models import Exhibition
+from gallery.snapshot import build_snapshot, remove_snapshot
+
+
+class Command(BaseCommand):
+    help = "Write the static snapshot bundles of public exhibitions, re-rendering only what changed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--exhibition", type=int, action="append", dest="exhibitions",
+                            help="Only snapshot this exhibition (may be repeated)")
+        parser.add_argument("--full", action="store_true",
+                            help="Discard the existing bundles and render everything again")
+
+    def handle(self, *args, **options):
+        exhibitions = Exhibition.objects.filter(public_token__isnull=False).order_by("id")
+        if options["exhibitions"]:
+            exhibitions = exhibitions.filter(id__in=options["exhibitions"])
+
+        totals = {"rendered": 0, "reused": 0, "removed": 0}
+        for exhib in exhibitions:
+            if options["full"]:
+                remove_snapshot(exhib.public_token)
+            stats = build_snapshot(exhib)
+            for k in totals:
+                totals[k] += stats[k]
+            self.stdout.write("{}: {rendered} rendered, {reused} reused, {removed} removed".format(
+                exhib.public_token, **stats))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Snapshots written: {rendered} pieces rendered, {reused} reused, {removed} removed".format(**totals)))
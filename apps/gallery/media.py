@@ -0,0 +1,106 @@
+import os
+import re
+
+from django.conf import settings
+from django.db.models import Q
+
+from .deepzoom import DEEP_ZOOM_DIR
+from .models import Exhibition, GalleryPiece
+from .snapshot import SNAPSHOT_DIR
+
+SENDFILE_DJANGO = 'django'
+SENDFILE_X_ACCEL = 'x-accel'
+SENDFILE_X_SENDFILE = 'x-sendfile'
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _source_query(stem):
+    # exactly <stem>.<ext>: a prefix match would also take piece-images/a.x.jpg for the stem
+    # piece-images/a, handing one user's renditions to another
+    return Q(image__regex=r"^{}\.[^./]+$".format(re.escape(stem)))
+
+
+def owner_query(name):
+    """
+    Q matching the piece a stored media file belongs to: its original, its optimized master, one
+    of its imagekit renditions (CACHE/images/<source without extension>/<hash>.<ext>) or its deep
+    zoom pyramid (deepzoom/<source without extension>.dzi and <...>_files/<level>/<tile>).
+    """
+    query = Q(image=name) | Q(optimized=name) | Q(animated_webp=name) | Q(animated_mp4=name)
+
+    if name.startswith(DEEP_ZOOM_DIR):
+        base = name[len(DEEP_ZOOM_DIR):]
+        source_stem = base.rpartition("_files/")[0] if "_files/" in base else os.path.splitext(base)[0]
+        if source_stem:
+            query |= _source_query(source_stem)
+
+    cache_dir = settings.IMAGEKIT_CACHEFILE_DIR.rstrip("/") + "/"
+    if name.startswith(cache_dir):
+        source_stem = os.path.dirname(name[len(cache_dir):])
+        if source_stem:
+            query |= _source_query(source_stem)
+    return query
+
+
+def media_visible_to(user, name):
+    """
+    Whether the user owns the piece a media file belongs to, or the piece is in a public exhibition.
+    Static snapshot bundles are visible to anyone while their exhibition is public.
+    """
+    if name.startswith(SNAPSHOT_DIR):
+        token = name[len(SNAPSHOT_DIR):].partition("/")[0]
+        return bool(token) and Exhibition.objects.filter(public_token=token).exists()
+    return GalleryPiece.objects.filter(owner_query(name)) \
+        .filter(Q(user_id=user.id) | Q(galleries__public_token__isnull=False)).exists()
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range ``Range`` header into an inclusive (start, end) pair. Returns None if the
+    header should be ignored and the whole file served, or raises ValueError if unsatisfiable.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+class RangeFile:
+    """
+    Read-only view of ``length`` bytes of an open file starting at its current position. It keeps
+    ``fileno()`` so servers with ``wsgi.file_wrapper`` support (e.g. gunicorn) can still sendfile
+    the range straight from the OS, bounded by the response's Content-Length.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,141 @@
+import threading
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+MODE_STORAGE = 'storage'
+MODE_CDN = 'cdn'
+MODE_SIGNED = 'signed'
+
+SIGNED_URL_CACHE_MAX = 50000
+
+
+class MediaURLResolver:
+    """
+    Resolves URLs for many stored files at once.
+
+    'storage' asks the storage for each URL (fine for local files), 'cdn' joins names onto a CDN
+    base URL with no signing, and 'signed' presigns S3 GETs with one shared client, so the
+    credentials and derived signing key are reused, and caches each signed URL until shortly
+    before it expires.
+    """
+
+    def __init__(self, storage, mode, cdn_url="", expire=3600, margin=300):
+        self.storage = storage
+        self.mode = mode
+        self.cdn_url = cdn_url.rstrip("/")
+        self.expire = expire
+        self.margin = margin
+        self._signed = {}
+        self._lock = threading.Lock()
+        self._client = None
+
+    def resolve(self, names):
+        names = [n for n in dict.fromkeys(names) if n]
+        if self.mode == MODE_CDN:
+            return {n: "{}/{}".format(self.cdn_url, quote(n)) for n in names}
+        if self.mode == MODE_SIGNED:
+            return self._resolve_signed(names)
+        return {n: self.storage.url(n) for n in names}
+
+    def resolve_prefix(self, prefix):
+        """
+        A URL that the names of files under ``prefix`` can be appended to, so that clients can build
+        the URLs of many files (e.g. deep zoom tiles) themselves. None where every file needs a
+        URL of its own: in 'signed' mode, and for storages that sign their URLs.
+        """
+        if self.mode == MODE_CDN:
+            return "{}/{}".format(self.cdn_url, quote(prefix))
+        if self.mode == MODE_SIGNED or getattr(self.storage, "querystring_auth", False):
+            return None
+        return self.storage.url(prefix)
+
+    def _resolve_signed(self, names):
+        now = time.monotonic()
+        urls = {}
+        missing = []
+        with self._lock:
+            for n in names:
+                cached = self._signed.get(n)
+                if cached and cached[1] > now:
+                    urls[n] = cached[0]
+                else:
+                    missing.append(n)
+
+        if missing:
+            client = self._get_client()
+            reuse_until = now + self.expire - self.margin
+            signed = {n: client.generate_presigned_url(
+                          'get_object',
+                          Params={'Bucket': self.storage.bucket_name, 'Key': self.storage._normalize_name(n)},
+                          ExpiresIn=self.expire)
+                      for n in missing}
+
+            with self._lock:
+                if len(self._signed) + len(signed) > SIGNED_URL_CACHE_MAX:
+                    self._signed = {k: v for k, v in self._signed.items() if v[1] > now}
+                for n, url in signed.items():
+                    self._signed[n] = (url, reuse_until)
+            urls.update(signed)
+
+        return urls
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = self.storage.bucket.meta.client
+        return self._client
+
+
+_resolver = None
+
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        _resolver = MediaURLResolver(default_storage,
+                                     settings.GALLERY_MEDIA_URL_MODE,
+                                     cdn_url=settings.GALLERY_MEDIA_CDN_URL,
+                                     expire=getattr(settings, 'AWS_QUERYSTRING_EXPIRE', 3600),
+                                     margin=settings.GALLERY_SIGNED_URL_MARGIN)
+    return _resolver
+
+
+@receiver(setting_changed)
+def reset_resolver(setting, **kwargs):
+    global _resolver
+    if setting.startswith('GALLERY_MEDIA') or setting in ('GALLERY_SIGNED_URL_MARGIN', 'MEDIA_ROOT', 'MEDIA_URL'):
+        _resolver = None
+
+
+def attach_piece_urls(pieces, thumbnails=True):
+    """
+    Resolve display (and thumbnail) URLs for a list of pieces in one batch, setting
+    ``piece.display_url`` and ``piece.thumbnail_url`` for the templates. Animated pieces also get
+    ``piece.animation``, the URLs of their original GIF and its smaller WebP and MP4 renditions.
+    """
+    pieces = list(pieces)
+    with_images = [p for p in pieces if p.image]
+    names = []
+    for p in with_images:
+        names.append(p.display_image.name)
+        if p.animated_webp or p.animated_mp4:
+            names += [p.image.name, p.animated_webp.name, p.animated_mp4.name]
+        if thumbnails:
+            # make sure the rendition exists (a local index lookup once it has been generated)
+            p.thumbnail.generate()
+            names.append(p.thumbnail.name)
+
+    urls = get_resolver().resolve(names)
+    for p in with_images:
+        p.display_url = urls[p.display_image.name]
+        p.animation = None
+        if p.animated_webp or p.animated_mp4:
+            p.animation = {"gif": urls[p.image.name], "webp": urls.get(p.animated_webp.name),
+                           "mp4": urls.get(p.animated_mp4.name)}
+        if thumbnails:
+            p.thumbnail_url = urls[p.thumbnail.name]
+    return pieces
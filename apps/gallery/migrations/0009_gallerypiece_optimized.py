@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-19 02:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0008_rename_name_exhibition_title'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='optimized',
+            field=models.ImageField(blank=True, null=True, upload_to='piece-masters'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.5 on 2026-10-19 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0009_gallerypiece_optimized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='placeholder',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
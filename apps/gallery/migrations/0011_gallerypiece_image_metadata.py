@@ -0,0 +1,28 @@
+# Generated by Django 4.1.5 on 2026-10-19 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0010_gallerypiece_placeholder_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='image_format',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='image_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('gallery', '0011_gallerypiece_image_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageQuota',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('used_bytes', models.PositiveBigIntegerField(default=0)),
+                ('limit_bytes', models.PositiveBigIntegerField(blank=True, null=True)),
+            ],
+        ),
+    ]
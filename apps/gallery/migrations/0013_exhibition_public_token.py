@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0012_storagequota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exhibition',
+            name='public_token',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0013_exhibition_public_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='perceptual_hash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
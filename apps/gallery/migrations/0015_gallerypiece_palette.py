@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0014_gallerypiece_perceptual_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='palette',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
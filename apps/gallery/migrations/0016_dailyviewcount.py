@@ -0,0 +1,27 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0015_gallerypiece_palette'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyViewCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('piece', 'Piece'), ('exhibition', 'Exhibition')], max_length=10)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailyviewcount',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id', 'date'), name='unique_daily_view_count'),
+        ),
+    ]
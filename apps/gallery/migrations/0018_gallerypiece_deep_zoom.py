@@ -0,0 +1,23 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0017_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='deep_zoom_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='deep_zoom_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
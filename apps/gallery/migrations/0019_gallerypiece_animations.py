@@ -0,0 +1,23 @@
+# Generated by Django 4.1.5 on 2026-10-19 03:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0018_gallerypiece_deep_zoom'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='animated_mp4',
+            field=models.FileField(blank=True, null=True, upload_to='piece-animations'),
+        ),
+        migrations.AddField(
+            model_name='gallerypiece',
+            name='animated_webp',
+            field=models.FileField(blank=True, null=True, upload_to='piece-animations'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-19 04:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0019_gallerypiece_animations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='retry_key',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -1,13 +1,20 @@
 from django.db import models
 from django.contrib.auth.models import User
 from imagekit.models import ImageSpecField
-from imagekit.processors import ResizeToFill
+
+from .processors import FastResizeToFill
+
+# GalleryPiece fields that are filled in from image processing results
+IMAGE_METADATA_FIELDS = ['optimized', 'width', 'height', 'placeholder',
+                         'image_size', 'image_format', 'image_hash', 'perceptual_hash', 'palette']
 
 
 class Exhibition(models.Model):
     title = models.CharField(max_length=200)
     description = models.CharField(max_length=1000)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    # set when the owner shares the exhibition; anyone with /p/<public_token>/ can view it
+    public_token = models.CharField(max_length=32, null=True, blank=True, unique=True)
 
     def __str__(self):
         return self.title
@@ -20,8 +27,25 @@ class GalleryPiece(models.Model):
     galleries = models.ManyToManyField(Exhibition, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     image = models.ImageField(upload_to='piece-images', null=True)
+    optimized = models.ImageField(upload_to='piece-masters', null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    placeholder = models.TextField(blank=True)
+    image_size = models.PositiveBigIntegerField(null=True, blank=True)
+    image_format = models.CharField(max_length=10, blank=True)
+    image_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # 64-bit difference hash of the displayed image (see gallery.similarity), stored signed
+    perceptual_hash = models.BigIntegerField(null=True, blank=True)
+    # dominant colours, largest first, as 'rrggbbww' entries (see gallery.colors)
+    palette = models.CharField(max_length=40, blank=True)
+    # size of the deep zoom tile pyramid built from the original (see gallery.deepzoom), if any
+    deep_zoom_width = models.PositiveIntegerField(null=True, blank=True)
+    deep_zoom_height = models.PositiveIntegerField(null=True, blank=True)
+    # smaller renditions of an animated original (see gallery.animation), if any
+    animated_webp = models.FileField(upload_to='piece-animations', null=True, blank=True)
+    animated_mp4 = models.FileField(upload_to='piece-animations', null=True, blank=True)
     thumbnail = ImageSpecField(source='image',
-                               processors=[ResizeToFill(100, 50)],
+                               processors=[FastResizeToFill(100, 50)],
                                format='JPEG',
                                options={'quality': 60})
 
@@ -29,5 +53,92 @@ class GalleryPiece(models.Model):
         if self.title == "":
             self.title = "Untitled " + self.pub_date.__str__().split(" ")[0]
 
+    @property
+    def display_image(self):
+        return self.optimized or self.image
+
+    def apply_image_metadata(self, metadata):
+        """Copy processing results onto the matching fields. Returns the names of the fields set."""
+        fields = [f for f in IMAGE_METADATA_FIELDS if f in metadata]
+        for f in fields:
+            setattr(self, f, metadata[f])
+        return fields
+
     def __str__(self):
         return self.title
+
+
+class StorageQuota(models.Model):
+    """
+    Running total of the bytes of the original images a user has uploaded, kept up to date by
+    gallery.quota so usage never has to be worked out from the storage itself. Files the site
+    derives from them (optimized masters, renditions, deep zoom tiles, animations) are not
+    counted. A null limit means the site default.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    used_bytes = models.PositiveBigIntegerField(default=0)
+    limit_bytes = models.PositiveBigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return "{}: {} bytes".format(self.user, self.used_bytes)
+
+
+class DailyViewCount(models.Model):
+    """
+    Views of one piece or exhibition on one day. Rows are written in batches by gallery.analytics
+    from counts buffered in each process, never once per view.
+    """
+    PIECE = 'piece'
+    EXHIBITION = 'exhibition'
+    KIND_CHOICES = [(PIECE, 'Piece'), (EXHIBITION, 'Exhibition')]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    date = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id', 'date'], name='unique_daily_view_count'),
+        ]
+
+    def __str__(self):
+        return "{} {} on {}: {} views".format(self.kind, self.object_id, self.date, self.views)
+
+
+class Job(models.Model):
+    """
+    A unit of background work, run by ``manage.py runworker`` (see gallery.jobs). Higher priority
+    jobs run first. While a job is queued its dedupe_key, if any, is unique, so the same work is
+    not queued twice. A job gives up the key when it starts, since changes made while it runs
+    need another run, and takes it back (from retry_key) when it is queued again for a retry.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    dedupe_key = models.CharField(max_length=200, null=True, blank=True, unique=True)
+    retry_key = models.CharField(max_length=200, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'priority', 'run_at'], name='job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return "{} #{} ({})".format(self.task, self.id, self.status)
@@ -0,0 +1,261 @@
+import base64
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_EDGE = 20
+PLACEHOLDER_QUALITY = 50
+DHASH_EDGE = 8
+PALETTE_SIZE = 5
+PALETTE_EDGE = 64
+PALETTE_ITERATIONS = 10
+
+FORMAT_EXTENSIONS = {
+    "JPEG": "jpg",
+    "WEBP": "webp",
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class PoolError(RuntimeError):
+    """The image worker pool broke or timed out: a fault of the server, not of the image."""
+
+
+def _placeholder(img):
+    from PIL import Image
+
+    tiny = img.convert("RGB")
+    tiny.thumbnail((PLACEHOLDER_EDGE, PLACEHOLDER_EDGE), Image.BILINEAR)
+    out = io.BytesIO()
+    tiny.save(out, "JPEG", quality=PLACEHOLDER_QUALITY)
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode("ascii")
+
+
+def _dhash(img):
+    """
+    64-bit difference hash: one bit per pair of horizontal neighbours in a 9x8 greyscale
+    thumbnail, set where brightness increases. Resized, recompressed or lightly edited copies of
+    an image land within a few bits of each other. Returned as a signed 64-bit integer.
+    """
+    from PIL import Image
+
+    small = img.convert("L").resize((DHASH_EDGE + 1, DHASH_EDGE), Image.LANCZOS, reducing_gap=3.0)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(DHASH_EDGE):
+        for col in range(DHASH_EDGE):
+            left = pixels[row * (DHASH_EDGE + 1) + col]
+            value = (value << 1) | (left < pixels[row * (DHASH_EDGE + 1) + col + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _palette(img):
+    """
+    Up to PALETTE_SIZE dominant colours, found by k-means over the pixels of a 64x64 copy of the
+    image. Returned largest first as 'rrggbbww' hex entries, ww being the colour's share of the
+    pixels scaled to 0-255.
+    """
+    import numpy as np
+    from PIL import Image
+
+    small = img.copy()
+    small.thumbnail((PALETTE_EDGE, PALETTE_EDGE), Image.BILINEAR)
+    pixels = np.asarray(small.convert("RGB"), dtype=np.float32).reshape(-1, 3)
+
+    # deterministic start: pixels at evenly spaced brightness quantiles
+    by_brightness = pixels[np.argsort(pixels.sum(axis=1), kind="stable")]
+    centres = by_brightness[((np.arange(PALETTE_SIZE) + 0.5) * len(pixels) / PALETTE_SIZE).astype(int)]
+
+    for _ in range(PALETTE_ITERATIONS):
+        labels = ((pixels[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        counts = np.bincount(labels, minlength=PALETTE_SIZE)
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=PALETTE_SIZE)
+                         for c in range(3)], axis=1)
+        filled = counts > 0
+        moved = centres.copy()
+        moved[filled] = sums[filled] / counts[filled, None]
+        if np.allclose(moved, centres, atol=0.5):
+            break
+        centres = moved
+
+    entries = []
+    for i in np.argsort(-counts, kind="stable"):
+        if counts[i]:
+            r, g, b = np.clip(np.rint(centres[i]), 0, 255).astype(int)
+            entries.append("{:02x}{:02x}{:02x}{:02x}".format(r, g, b, round(255 * counts[i] / len(pixels))))
+    return "".join(entries)
+
+
+def flatten(img):
+    """RGB copy of an image for JPEG encoding, with any transparency composited onto white."""
+    from PIL import Image
+
+    if img.mode == "RGB":
+        return img
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def dhash_image(data):
+    """Perceptual hash of an encoded image, decoded at reduced size where the format allows."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as src:
+        # JPEGs can be decoded at 1/2 to 1/8 scale, far more than enough for a 9x8 hash
+        src.draft("RGB", (64, 64))
+        return _dhash(ImageOps.exif_transpose(src))
+
+
+def _describe(img):
+    return {
+        "width": img.width,
+        "height": img.height,
+        "placeholder": _placeholder(img),
+        "perceptual_hash": _dhash(img),
+        "palette": _palette(img),
+    }
+
+
+def _fingerprint(data, src):
+    return {
+        "image_size": len(data),
+        "image_format": src.format or "",
+        "image_hash": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def describe_image(data):
+    """Compute the stored display metadata (dimensions, placeholder) for an existing image."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as src:
+        return _describe(ImageOps.exif_transpose(src))
+
+
+def analyze_stored_image(original, display=None):
+    """
+    Compute all stored metadata for an already uploaded piece: the fingerprint of the original
+    plus the display metadata of its optimized master (or of the original if it has none).
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(original)) as src:
+        result = _fingerprint(original, src)
+        if display is None:
+            result.update(_describe(ImageOps.exif_transpose(src)))
+
+    if display is not None:
+        result.update(describe_image(display))
+    return result
+
+
+def optimize_image(data, max_edge, fmt, quality):
+    """
+    Decode an uploaded image, apply its EXIF orientation, cap its longest edge and re-encode it
+    without any metadata. Runs in a worker process, so it only takes and returns plain data.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as src:
+        img = ImageOps.exif_transpose(src)
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if fmt == "JPEG":
+            img = flatten(img)
+
+        out = io.BytesIO()
+        if fmt == "JPEG":
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            img.save(out, fmt, quality=quality, method=4)
+
+        result = _describe(img)
+        result.update(_fingerprint(data, src))
+        result["data"] = out.getvalue()
+        return result
+
+
+def get_executor():
+    global _executor
+
+    if settings.GALLERY_IMAGE_WORKERS < 1:
+        return None
+
+    # Created on first use so that forked (e.g. preloaded gunicorn) workers each get their own pool.
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.GALLERY_IMAGE_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def discard_executor(executor):
+    """
+    Drop a broken or clogged pool so that the next call to get_executor() starts a new one. Its
+    queued calls are cancelled; workers still busy exit once they finish.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_pool(fn, *args):
+    """
+    Run fn in the image worker pool, or inline if there is none. Exceptions raised by fn come back
+    as they are; a broken pool or a timeout is raised as PoolError, so that callers can tell them
+    apart from a bad image (a timeout is an OSError since Python 3.11).
+    """
+    executor = get_executor()
+    if executor is None:
+        return fn(*args)
+    try:
+        return executor.submit(fn, *args).result(timeout=settings.GALLERY_IMAGE_TIMEOUT)
+    except BrokenProcessPool as e:
+        # a worker died (e.g. killed for using too much memory); the pool will not run anything again
+        logger.error("Image worker pool is broken, starting a new one: %s", e)
+        discard_executor(executor)
+        raise PoolError("image worker pool is broken") from e
+    except FutureTimeoutError as e:
+        # the call cannot be cancelled once running and keeps its worker busy; a few such images
+        # would leave no worker for anything else, so later uploads go to a new pool
+        logger.warning("Image processing timed out, starting a new worker pool")
+        discard_executor(executor)
+        raise PoolError("image processing took over {} seconds".format(settings.GALLERY_IMAGE_TIMEOUT)) from e
+
+
+def process_upload(upload):
+    """
+    Produce the optimized master for an uploaded image. Returns a dict of the processing results:
+    the re-encoded image as an unsaved ContentFile under 'optimized', plus the GalleryPiece
+    metadata fields describing it.
+    """
+    upload.seek(0)
+    data = upload.read()
+    upload.seek(0)
+
+    fmt = settings.GALLERY_IMAGE_FORMAT
+    result = run_in_pool(optimize_image, data, settings.GALLERY_IMAGE_MAX_EDGE, fmt,
+                         settings.GALLERY_IMAGE_QUALITY)
+
+    stem = os.path.splitext(os.path.basename(upload.name))[0]
+    result["optimized"] = ContentFile(result.pop("data"), name="{}.{}".format(stem, FORMAT_EXTENSIONS[fmt]))
+    return result
@@ -0,0 +1,55 @@
+from pilkit.processors import ResizeToFill
+
+# sources are shrunk cheaply to no less than this many times the target size, so the final
+# resample still has enough pixels to antialias from
+REDUCING_GAP = 2
+
+
+def _reduce_factor(size, width, height):
+    return max(1, min(size[0] // (width * REDUCING_GAP), size[1] // (height * REDUCING_GAP)))
+
+
+class Draft:
+    """
+    Has a JPEG decoded at 1/2, 1/4 or 1/8 scale (libjpeg's DCT scaling), the smallest of those
+    that still covers REDUCING_GAP times width x height. A 6000x4000 scan then never exists in
+    memory at full size. Only effective as the first processor, before any pixels are loaded;
+    other formats pass through untouched.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def process(self, img):
+        img.draft(None, (self.width * REDUCING_GAP, self.height * REDUCING_GAP))
+        return img
+
+
+class Reduce:
+    """
+    Box-averages an image by the largest integer factor that still covers REDUCING_GAP times
+    width x height (``Image.reduce``), which is much cheaper than resampling from full size.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def process(self, img):
+        factor = _reduce_factor(img.size, self.width, self.height)
+        if factor == 1:
+            return img
+        if img.mode in ("1", "P"):
+            # palette indices cannot be averaged
+            img = img.convert("RGBA")
+        return img.reduce(factor)
+
+
+class FastResizeToFill(ResizeToFill):
+    """ResizeToFill that decodes and shrinks the source with Draft and Reduce before resampling it."""
+
+    def process(self, img):
+        img = Draft(self.width, self.height).process(img)
+        img = Reduce(self.width, self.height).process(img)
+        return super().process(img)
@@ -0,0 +1,237 @@
+import json
+import logging
+import threading
+import urllib.request
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotFound
+from django.template.loader import render_to_string
+from django.urls import Resolver404, resolve
+from django.utils.module_loading import import_string
+
+from .analytics import record_view
+from .jobs import enqueue, task
+from .media_urls import MODE_SIGNED, attach_piece_urls
+from .models import DailyViewCount, Exhibition, GalleryPiece
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_PATH_PREFIX = "/p/"
+PUBLIC_URL_NAME = "public_exhibition"
+
+PAGE_KEY = "public:page:"
+VERSION_KEY = "public:sk:"
+
+
+def exhibition_key(exhibition_id):
+    return "exhibition-{}".format(exhibition_id)
+
+
+def piece_key(piece_id):
+    return "piece-{}".format(piece_id)
+
+
+def page_timeout():
+    timeout = settings.GALLERY_PUBLIC_PAGE_TIMEOUT
+    if settings.GALLERY_MEDIA_URL_MODE == MODE_SIGNED:
+        # cached pages must not outlive the signed image URLs embedded in them
+        timeout = min(timeout, settings.GALLERY_SIGNED_URL_MARGIN)
+    return timeout
+
+
+class PageCache:
+    """
+    Rendered public pages in a Django cache, tagged with surrogate keys. Every key has a version
+    number; a page stores the versions it was rendered against, and purging a key bumps its
+    version, so exactly the pages carrying that key stop matching. The cache must be shared
+    between processes (JGCACHE_URL) when there are several workers, or the others would keep
+    serving pages that were purged, unpublished or deleted; the settings enforce this.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def versions(self, keys):
+        current = self.cache.get_many([VERSION_KEY + k for k in keys])
+        return [current.get(VERSION_KEY + k, 0) for k in keys]
+
+    def get(self, name):
+        entry = self.cache.get(PAGE_KEY + name)
+        if entry is None:
+            return None
+        content, keys, versions = entry
+        if self.versions(keys) != versions:
+            return None
+        return content, keys
+
+    def set(self, name, content, keys, versions, timeout):
+        self.cache.set(PAGE_KEY + name, (content, keys, versions), timeout)
+
+    def purge(self, keys):
+        for k in keys:
+            try:
+                self.cache.incr(VERSION_KEY + k)
+            except ValueError:
+                self.cache.set(VERSION_KEY + k, 1, None)
+
+
+def get_page_cache():
+    return PageCache(caches[settings.GALLERY_PUBLIC_CACHE])
+
+
+class CachePurger:
+    """Purges pages from the local page cache."""
+
+    def purge(self, keys):
+        get_page_cache().purge(keys)
+
+
+class LocalPurger:
+    """In-process stand-in for a CDN purge API: records every purge request in ``purged``."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.purged = []
+
+    def purge(self, keys):
+        with self.lock:
+            self.purged.append(sorted(keys))
+
+
+@task(priority=1)
+def purge_fastly(keys):
+    request = urllib.request.Request(
+        "https://api.fastly.com/service/{}/purge".format(settings.GALLERY_FASTLY_SERVICE_ID),
+        method="POST",
+        headers={"Fastly-Key": settings.GALLERY_FASTLY_API_TOKEN,
+                 "Surrogate-Key": " ".join(keys),
+                 "Accept": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+
+class FastlyPurger:
+    """
+    Purges pages cached by Fastly by surrogate key (GALLERY_FASTLY_SERVICE_ID/_API_TOKEN). The API
+    call is made by a background job, so requests never wait on it and failed purges are retried.
+    """
+
+    def purge(self, keys):
+        enqueue(purge_fastly, keys)
+
+
+_purgers = None
+
+
+def get_purgers():
+    global _purgers
+    if _purgers is None:
+        _purgers = [import_string(p)() for p in settings.GALLERY_PUBLIC_PURGERS]
+    return _purgers
+
+
+@receiver(setting_changed)
+def reset_purgers(setting, **kwargs):
+    global _purgers
+    if setting == 'GALLERY_PUBLIC_PURGERS':
+        _purgers = None
+
+
+def purge(keys):
+    """Purge the given surrogate keys from every configured cache once the transaction commits."""
+    keys = sorted(set(keys))
+    if not keys:
+        return
+
+    def run():
+        for purger in get_purgers():
+            try:
+                purger.purge(keys)
+            except Exception:
+                # the change is committed already; a stale cache must not turn it into an error
+                logger.exception("%s could not purge %s", type(purger).__name__, " ".join(keys))
+    transaction.on_commit(run)
+
+
+def serve_public_exhibition(token):
+    page_cache = get_page_cache()
+    cached = page_cache.get(token)
+
+    if cached is None:
+        exhib = Exhibition.objects.filter(public_token=token).first()
+        if exhib is None:
+            return HttpResponseNotFound()
+
+        pieces = attach_piece_urls(exhib.gallerypiece_set.order_by("id"), thumbnails=False)
+        keys = [exhibition_key(exhib.id)] + [piece_key(p.id) for p in pieces]
+        # versions are read before rendering, so a purge that lands meanwhile still invalidates
+        versions = page_cache.versions(keys)
+        content = render_to_string("galleryapp/public_exhibition.html", {'exhib': exhib, 'pieces': pieces})
+        page_cache.set(token, content, keys, versions, page_timeout())
+    else:
+        content, keys = cached
+
+    # keys[0] is always the exhibition's own key
+    record_view(DailyViewCount.EXHIBITION, int(keys[0].rpartition("-")[2]))
+
+    response = HttpResponse(content)
+    response["Surrogate-Key"] = " ".join(keys)
+    response["Cache-Control"] = "public, max-age={}, s-maxage={}".format(
+        settings.GALLERY_PUBLIC_BROWSER_TIMEOUT, page_timeout())
+    response["X-Frame-Options"] = "DENY"
+    return response
+
+
+class PublicPageMiddleware:
+    """
+    Answers public exhibition pages before the session, auth, CSRF and messages middleware run:
+    those pages are the same for every visitor and never look at the user.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in ("GET", "HEAD") and request.path_info.startswith(PUBLIC_PATH_PREFIX):
+            try:
+                match = resolve(request.path_info)
+            except Resolver404:
+                return self.get_response(request)
+            if match.url_name == PUBLIC_URL_NAME:
+                return serve_public_exhibition(match.kwargs["token"])
+        return self.get_response(request)
+
+
+@receiver(post_save, sender=Exhibition)
+@receiver(post_delete, sender=Exhibition)
+def purge_exhibition(sender, instance, **kwargs):
+    purge([exhibition_key(instance.id)])
+
+
+@receiver(post_save, sender=GalleryPiece)
+def purge_piece(sender, instance, **kwargs):
+    purge([piece_key(instance.id)])
+
+
+@receiver(pre_delete, sender=GalleryPiece)
+def purge_deleted_piece(sender, instance, **kwargs):
+    # memberships are gone by post_delete, so name the piece's exhibitions now as well
+    exhibition_ids = instance.galleries.filter(public_token__isnull=False).values_list("id", flat=True)
+    purge([piece_key(instance.id)] + [exhibition_key(e) for e in exhibition_ids])
+
+
+@receiver(m2m_changed, sender=GalleryPiece.galleries.through)
+def purge_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if reverse:
+        # instance is an exhibition whose pieces changed
+        purge([exhibition_key(instance.id)])
+    else:
+        exhibition_ids = pk_set if action != "pre_clear" else instance.galleries.values_list("id", flat=True)
+        purge([exhibition_key(e) for e in exhibition_ids])
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_init, pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import GalleryPiece, StorageQuota
+
+# Only the originals users upload (GalleryPiece.image_size) are charged. The files derived from
+# them are not: how many there are, and how large, is up to the site's settings rather than the
+# user, and every one of them is capped by the original's dimensions.
+
+QUOTA_EXCEEDED_MSG = "This upload would take you over your storage quota."
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _within_limit(delta):
+    """Q matching quota rows that have room for ``delta`` more bytes."""
+    default = settings.GALLERY_QUOTA_BYTES
+    custom = Q(limit_bytes__isnull=False, used_bytes__lte=F("limit_bytes") - delta)
+    if not default:
+        return custom | Q(limit_bytes__isnull=True)
+    return custom | Q(limit_bytes__isnull=True, used_bytes__lte=default - delta)
+
+
+def has_room(user, size):
+    """Cheap pre-check used before an upload is processed; charge() has the final say."""
+    quota = StorageQuota.objects.filter(user_id=user.id).first()
+    if quota is None:
+        return not settings.GALLERY_QUOTA_BYTES or size <= settings.GALLERY_QUOTA_BYTES
+    limit = quota.limit_bytes if quota.limit_bytes is not None else settings.GALLERY_QUOTA_BYTES
+    return not limit or quota.used_bytes + size <= limit
+
+
+def charge(user_id, delta, enforce=True):
+    """
+    Add ``delta`` bytes to a user's total in one conditional UPDATE, so concurrent uploads cannot
+    both squeeze under the limit. Raises QuotaExceeded (and changes nothing) if it would not fit.
+    """
+    if delta <= 0:
+        release(user_id, -delta)
+        return
+
+    for _ in range(2):
+        quotas = StorageQuota.objects.filter(user_id=user_id)
+        if enforce:
+            quotas = quotas.filter(_within_limit(delta))
+        if quotas.update(used_bytes=F("used_bytes") + delta):
+            return
+        if StorageQuota.objects.filter(user_id=user_id).exists():
+            raise QuotaExceeded(QUOTA_EXCEEDED_MSG)
+
+        # first upload for this user: create the row and try again
+        try:
+            with transaction.atomic():
+                StorageQuota.objects.create(user_id=user_id)
+        except IntegrityError:
+            pass
+    raise QuotaExceeded(QUOTA_EXCEEDED_MSG)
+
+
+def release(user_id, size):
+    if size:
+        StorageQuota.objects.filter(user_id=user_id).update(used_bytes=Greatest(F("used_bytes") - size, 0))
+
+
+@receiver(post_init, sender=GalleryPiece)
+def remember_charged_size(sender, instance, **kwargs):
+    instance._charged_size = instance.__dict__.get("image_size") or 0
+
+
+@receiver(pre_save, sender=GalleryPiece)
+def charge_piece(sender, instance, update_fields=None, **kwargs):
+    # runs before the image fields' pre_save writes anything to storage, so a rejected upload
+    # never reaches it
+    if update_fields is not None and "image_size" not in update_fields:
+        return
+    old = getattr(instance, "_charged_size", 0) if instance.pk else 0
+    delta = (instance.image_size or 0) - old
+    if delta:
+        # only new uploads are held to the limit; recorded sizes of files already stored (e.g.
+        # from backfill_image_metadata) are always accounted
+        new_upload = bool(instance.image) and not instance.image._committed
+        charge(instance.user_id, delta, enforce=new_upload)
+
+
+@receiver(post_save, sender=GalleryPiece)
+def update_charged_size(sender, instance, **kwargs):
+    instance._charged_size = instance.image_size or 0
+
+
+@receiver(post_delete, sender=GalleryPiece)
+def release_piece(sender, instance, **kwargs):
+    release(instance.user_id, instance.image_size or 0)
@@ -0,0 +1,182 @@
+import functools
+import http
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+RATE_LIMITED_MSG = "Too many requests. Please try again later."
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# local state is pruned of idle keys once it tracks this many
+LOCAL_MAX_KEYS = 10000
+
+
+@functools.lru_cache(maxsize=None)
+def parse_rate(rate):
+    """Parse a rate like '20/m' into (requests, period in seconds)."""
+    count, period = rate.split("/")
+    return int(count), PERIODS[period[0]]
+
+
+def _gcra(tat, now, count, period):
+    """
+    Token bucket as a generic cell rate algorithm: the only state is the theoretical arrival time
+    (tat) of the next request. The bucket holds ``count`` tokens and refills over ``period``.
+    Returns (new tat, 0) if the request is allowed, or (old tat, seconds to wait) if not.
+    """
+    interval = period / count
+    new_tat = max(tat or now, now) + interval
+    allow_at = new_tat - period
+    if now < allow_at:
+        return tat, allow_at - now
+    return new_tat, 0
+
+
+class LocalMemoryStore:
+    """
+    Limiter state in this process only, for running a single worker process. Its concurrency
+    slots only ever fill up with threaded or async workers: a sync worker handles one request at
+    a time. The settings refuse it when there are several workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tats = {}
+        self.active = {}
+
+    def take(self, key, count, period, now):
+        with self.lock:
+            tat, wait = _gcra(self.tats.get(key), now, count, period)
+            self.tats[key] = tat
+            if len(self.tats) > LOCAL_MAX_KEYS:
+                # buckets whose tat has passed are full again, so forgetting them changes nothing
+                self.tats = {k: t for k, t in self.tats.items() if t > now}
+        return wait
+
+    def acquire(self, key, limit):
+        with self.lock:
+            active = self.active.get(key, 0)
+            if active >= limit:
+                return False
+            self.active[key] = active + 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            active = self.active.pop(key, 0) - 1
+            if active > 0:
+                self.active[key] = active
+
+    def reset(self):
+        with self.lock:
+            self.tats.clear()
+            self.active.clear()
+
+
+class CacheStore:
+    """
+    Limiter state in a shared Django cache (GALLERY_RATELIMIT_CACHE), so limits apply across
+    processes and hosts. Concurrency slots use the cache's atomic incr/decr and expire after
+    GALLERY_RATELIMIT_SLOT_TIMEOUT in case a worker dies holding one. Bucket updates are a
+    get then set, so racing requests may occasionally both get the last token.
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.GALLERY_RATELIMIT_CACHE]
+
+    def take(self, key, count, period, now):
+        key = "ratelimit:tat:" + key
+        tat, wait = _gcra(self.cache.get(key), now, count, period)
+        if not wait:
+            self.cache.set(key, tat, timeout=math.ceil(tat - now))
+        return wait
+
+    def acquire(self, key, limit):
+        key = "ratelimit:active:" + key
+        while True:
+            if self.cache.add(key, 1, timeout=settings.GALLERY_RATELIMIT_SLOT_TIMEOUT):
+                active = 1
+                break
+            try:
+                active = self.cache.incr(key)
+                break
+            except ValueError:
+                # the counter expired between add() and incr(): start it again
+                continue
+        if active > limit:
+            self.cache.decr(key)
+            return False
+        return True
+
+    def release(self, key):
+        try:
+            self.cache.decr("ratelimit:active:" + key)
+        except ValueError:
+            pass
+
+    def reset(self):
+        pass
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = import_string(settings.GALLERY_RATELIMIT_STORE)()
+    return _store
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    global _store
+    if setting.startswith('GALLERY_RATELIMIT') or setting == 'CACHES':
+        _store = None
+
+
+def too_many_requests(wait):
+    response = HttpResponse(status=http.HTTPStatus.TOO_MANY_REQUESTS, reason=RATE_LIMITED_MSG)
+    response["Retry-After"] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def rate_limited(scope, concurrent=False, all_methods=False):
+    """
+    Limit a view's unsafe requests per user with the token bucket configured for ``scope`` in
+    GALLERY_RATELIMITS, and, if ``concurrent``, to GALLERY_UPLOAD_CONCURRENCY at a time. With
+    ``all_methods``, safe methods are limited too, for views that change data even on a GET.
+    Anonymous requests are passed through for the view to turn away.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            rate = settings.GALLERY_RATELIMITS.get(scope)
+            safe = request.method in SAFE_METHODS and not all_methods
+            if safe or not (rate or concurrent) or not request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+
+            store = get_store()
+            key = "{}:{}".format(scope, request.user.id)
+            if concurrent and not store.acquire(key, settings.GALLERY_UPLOAD_CONCURRENCY):
+                return too_many_requests(1)
+            try:
+                if rate:
+                    count, period = parse_rate(rate)
+                    wait = store.take(key, count, period, time.time())
+                    if wait:
+                        return too_many_requests(wait)
+                return view(request, *args, **kwargs)
+            finally:
+                if concurrent:
+                    store.release(key)
+        return wrapper
+    return decorator
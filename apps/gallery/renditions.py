@@ -0,0 +1,365 @@
+import contextlib
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: renditions are only coalesced within a process
+    fcntl = None
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from imagekit.cachefiles.backends import CachedFileBackend, CacheFileState
+from imagekit.cachefiles.namers import source_name_as_path
+
+from .jobs import enqueue, task
+from .models import GalleryPiece
+
+# lock files are shared by names hashing alike, so there are never more than this many
+LOCK_BUCKETS = 1024
+LOCK_POLL_INTERVAL = 0.05
+# characters of the source's content hash that go into its rendition names
+CONTENT_HASH_CHARS = 12
+
+
+class RenditionIndex:
+    """
+    LRU index of renditions known to exist in the remote storage. Renditions generated by this
+    host also keep a copy in a local directory; the index is evicted oldest-first once those
+    copies exceed max_bytes, or once it tracks more than max_entries names. A new process (e.g. a
+    recycled worker) rebuilds the index from whatever is already on local disk, so it starts warm.
+    """
+
+    def __init__(self, directory, max_bytes, max_entries):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self._load()
+
+    def _local_path(self, name):
+        return os.path.join(self.directory, os.path.normpath(name).lstrip(os.sep))
+
+    def _load(self):
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # evicted by another process meanwhile
+                    continue
+                found.append((stat.st_mtime, os.path.relpath(path, self.directory), stat.st_size))
+
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.entries and (self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            name, size = self.entries.popitem(last=False)
+            self._forget(name, size)
+
+    def _forget(self, name, size):
+        self.total_bytes -= size
+        if size:
+            try:
+                os.remove(self._local_path(name))
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, name):
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return True
+            return False
+
+    def add(self, name, data=None):
+        """Record that a rendition exists, keeping a local copy of its contents if given."""
+        size = 0
+        if data is not None:
+            path = self._local_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            size = len(data)
+
+        with self.lock:
+            if name in self.entries:
+                size = max(size, self.entries[name])
+                self.total_bytes -= self.entries.pop(name)
+            self.entries[name] = size
+            self.total_bytes += size
+            self._evict()
+
+    def discard(self, name):
+        with self.lock:
+            size = self.entries.pop(name, None)
+            if size is not None:
+                self._forget(name, size)
+
+    def read(self, name):
+        """The contents of the local copy of a rendition, or None if there isn't one."""
+        with self.lock:
+            if not self.entries.get(name):
+                return None
+            self.entries.move_to_end(name)
+        try:
+            with open(self._local_path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            with self.lock:
+                if self.entries.get(name):
+                    self.total_bytes -= self.entries[name]
+                    self.entries[name] = 0
+            return None
+
+
+class SingleFlight:
+    """
+    Per-key locks, so that only one caller at a time does the work for a key. Threads of this
+    process wait on a lock of their own; other processes on the same host are held off with
+    ``flock`` on a lock file in ``directory``.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.keys = {}
+
+    def _lock_path(self, key):
+        bucket = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_BUCKETS
+        return os.path.join(self.directory, "{}.lock".format(bucket))
+
+    @contextlib.contextmanager
+    def acquire(self, key, timeout):
+        """
+        Yields (held, waited): whether the caller got ``key`` within ``timeout`` seconds, and
+        whether it had to wait for someone else to let go of it first.
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            entry = self.keys.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            waited = not entry[0].acquire(blocking=False)
+            if waited and not entry[0].acquire(timeout=timeout):
+                yield False, True
+                return
+            try:
+                with self._file_lock(key, deadline) as (held, file_waited):
+                    yield held, waited or file_waited
+            finally:
+                entry[0].release()
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.keys[key]
+
+    @contextlib.contextmanager
+    def _file_lock(self, key, deadline):
+        if fcntl is None:
+            yield True, False
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._lock_path(key), "a") as f:
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        yield False, True
+                        return
+                    waited = True
+                    time.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield True, waited
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class TieredCacheFileBackend(CachedFileBackend):
+    """
+    imagekit cache file backend that answers existence checks from the local rendition index,
+    so that resolving e.g. ``piece.thumbnail.url`` for a known rendition makes no storage calls.
+    Only unknown renditions fall through to imagekit's cached state and, finally, the remote
+    storage. Contents are read back from the local copies where there are any (see read). Entries never go stale: a rendition's name changes with its source's content (see
+    content_hash_namer), and superseded renditions are deleted by remove_stale_renditions.
+
+    Generation is single-flight: when many requests want the same missing rendition, one of them
+    resizes the source while the others wait up to GALLERY_RENDITION_LOCK_TIMEOUT seconds for
+    it, then carry on without the file (pages show the piece's placeholder meanwhile).
+    """
+
+    def __init__(self):
+        self.index = RenditionIndex(settings.GALLERY_RENDITION_CACHE_DIR,
+                                    settings.GALLERY_RENDITION_CACHE_MAX_BYTES,
+                                    settings.GALLERY_RENDITION_CACHE_MAX_ENTRIES)
+        self.flights = SingleFlight(settings.GALLERY_RENDITION_LOCK_DIR)
+
+    def get_state(self, file, check_if_unknown=True):
+        if file.name in self.index:
+            return CacheFileState.EXISTS
+        state = super().get_state(file, check_if_unknown)
+        if state == CacheFileState.EXISTS:
+            self.index.add(file.name)
+        return state
+
+    def set_state(self, file, state):
+        super().set_state(file, state)
+        if state == CacheFileState.DOES_NOT_EXIST:
+            self.index.discard(file.name)
+
+    def _exists(self, file):
+        return bool(getattr(file, '_file', None)
+                    or (file.name and file.storage.exists(file.name)))
+
+    def generate(self, file, force=False):
+        self.generate_now(file, force=force)
+
+    def generate_now(self, file, force=False):
+        if not force and self.get_state(file) in (CacheFileState.GENERATING, CacheFileState.EXISTS):
+            return
+
+        with self.flights.acquire(file.name, settings.GALLERY_RENDITION_LOCK_TIMEOUT) as (held, waited):
+            if not held:
+                return
+            # whoever held the lock has most likely just generated it
+            if not force and waited and (file.name in self.index or file.storage.exists(file.name)):
+                self.set_state(file, CacheFileState.EXISTS)
+                self.index.add(file.name)
+                return
+
+            self.set_state(file, CacheFileState.GENERATING)
+            try:
+                file._generate()
+            except Exception:
+                self.set_state(file, CacheFileState.DOES_NOT_EXIST)
+                raise
+            self.set_state(file, CacheFileState.EXISTS)
+
+            content = file.file
+            content.seek(0)
+            self.index.add(file.name, content.read())
+            content.seek(0)
+            file.close()
+
+    def read(self, file):
+        """The contents of a generated rendition, from its local copy if there is one."""
+        data = self.index.read(file.name)
+        if data is None:
+            with file.storage.open(file.name, "rb") as f:
+                data = f.read()
+        return data
+
+    def forget(self, name):
+        """Drop a deleted rendition from the local index and from imagekit's shared state cache."""
+        self.index.discard(name)
+        self.cache.delete(self.get_key(_Named(name)))
+
+
+class _Named:
+    def __init__(self, name):
+        self.name = name
+
+
+def get_backend():
+    from imagekit.utils import get_singleton
+    backend = get_singleton(settings.IMAGEKIT_DEFAULT_CACHEFILE_BACKEND, 'cache file backend')
+    return backend if isinstance(backend, TieredCacheFileBackend) else None
+
+
+def read_rendition(file):
+    """The contents of a generated rendition (e.g. ``piece.thumbnail``)."""
+    backend = get_backend()
+    if backend is not None:
+        return backend.read(file)
+    with file.storage.open(file.name, "rb") as f:
+        return f.read()
+
+
+def content_hash_namer(generator):
+    """
+    imagekit namer for renditions of GalleryPiece images: imagekit's own source_name_as_path
+    (CACHE/images/<source without extension>/<spec hash>.<ext>) with the start of the source's
+    content hash in front of the file name. When an image is replaced, even by one stored under
+    the same name (e.g. with S3 overwrites), every process asks for new rendition names at once.
+    """
+    name = source_name_as_path(generator)
+    content_hash = getattr(getattr(generator.source, "instance", None), "image_hash", "")
+    if not content_hash:
+        return name
+    directory, filename = os.path.split(name)
+    return os.path.join(directory, "{}-{}".format(content_hash[:CONTENT_HASH_CHARS], filename))
+
+
+def _matches_content(filename, content_hash):
+    if not content_hash:
+        return "-" not in filename
+    return filename.startswith(content_hash[:CONTENT_HASH_CHARS] + "-")
+
+
+@task(priority=-1)
+def remove_stale_renditions(source_name):
+    """
+    Delete the stored renditions of a source image that no longer match it: all of them once no
+    piece uses the image, otherwise those named for content it has since been replaced with.
+    """
+    directory = os.path.join(settings.IMAGEKIT_CACHEFILE_DIR, os.path.splitext(source_name)[0])
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    current = GalleryPiece.objects.filter(image=source_name).values_list("image_hash", flat=True).first()
+    backend = get_backend()
+    for filename in files:
+        if current is not None and _matches_content(filename, current):
+            continue
+        name = os.path.join(directory, filename)
+        default_storage.delete(name)
+        if backend is not None:
+            backend.forget(name)
+
+
+@receiver(post_init, sender=GalleryPiece)
+def remember_rendition_source(sender, instance, **kwargs):
+    instance._rendition_source = instance.__dict__.get("image") and str(instance.__dict__["image"])
+    instance._rendition_hash = instance.__dict__.get("image_hash")
+
+
+@receiver(post_save, sender=GalleryPiece)
+def remove_replaced_renditions(sender, instance, created, **kwargs):
+    old, old_hash = getattr(instance, "_rendition_source", None), getattr(instance, "_rendition_hash", None)
+    instance._rendition_source = instance.image.name or None
+    instance._rendition_hash = instance.image_hash
+    if created or not old:
+        return
+    # the same name can be reused for new content (e.g. S3 overwrites), so a new hash counts too
+    if old != instance._rendition_source or old_hash != instance.image_hash:
+        transaction.on_commit(lambda: enqueue(remove_stale_renditions, old))
+
+
+@receiver(post_delete, sender=GalleryPiece)
+def remove_deleted_renditions(sender, instance, **kwargs):
+    old = getattr(instance, "_rendition_source", None)
+    if old:
+        transaction.on_commit(lambda: enqueue(remove_stale_renditions, old))
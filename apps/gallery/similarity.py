@@ -0,0 +1,85 @@
+import functools
+
+from django.conf import settings
+
+from .indexes import PieceIndexCache
+from .models import GalleryPiece
+
+
+@functools.lru_cache(maxsize=None)
+def popcount_table():
+    """The number of set bits in every 16-bit value."""
+    import numpy as np
+
+    return np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+
+class SimilarityIndex:
+    """
+    One user's perceptual hashes packed into a NumPy int64 array. A query XORs the hash against
+    every entry and counts the differing bits 16 at a time through a lookup table, so a scan of
+    100k pieces is a few vectorized passes over 800 KB (around a millisecond).
+
+    The ids and hashes are held as one (ids, hashes) tuple that ``update`` replaces whole and never
+    modifies, so that queries, which take no lock, always see a matching pair.
+    """
+
+    def __init__(self, ids, hashes):
+        import numpy as np
+
+        self.arrays = (np.asarray(ids, dtype=np.int64), np.asarray(hashes, dtype=np.int64))
+
+    @classmethod
+    def for_user(cls, user_id):
+        rows = GalleryPiece.objects.filter(user_id=user_id, perceptual_hash__isnull=False) \
+            .order_by().values_list("id", "perceptual_hash")
+        ids, hashes = zip(*rows) if rows else ((), ())
+        return cls(ids, hashes)
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    @staticmethod
+    def distances(hashes, phash):
+        import numpy as np
+
+        popcount = popcount_table()
+        words = np.bitwise_xor(hashes, np.int64(phash)).view(np.uint16)
+        return popcount[words[0::4]] + popcount[words[1::4]] + popcount[words[2::4]] + popcount[words[3::4]]
+
+    def nearest(self, phash, max_distance, limit, exclude=()):
+        """The closest (piece id, distance) pairs within ``max_distance`` bits, closest first."""
+        import numpy as np
+
+        ids, hashes = self.arrays
+        distances = self.distances(hashes, phash)
+        mask = distances <= max_distance
+        if exclude:
+            mask &= ~np.isin(ids, list(exclude))
+        found = np.flatnonzero(mask)
+        found = found[np.argsort(distances[found], kind="stable")][:limit]
+        return [(int(ids[i]), int(distances[i])) for i in found]
+
+    def update(self, piece_id, phash):
+        import numpy as np
+
+        ids, hashes = self.arrays
+        keep = ids != piece_id
+        ids, hashes = ids[keep], hashes[keep]
+        if phash is not None:
+            ids = np.append(ids, np.int64(piece_id))
+            hashes = np.append(hashes, np.int64(phash))
+        self.arrays = (ids, hashes)
+
+
+indexes = PieceIndexCache("similarity", SimilarityIndex, "perceptual_hash")
+
+
+def find_similar(user_id, phash, exclude=()):
+    """The user's pieces that look like an image with the given perceptual hash, closest first."""
+    if phash is None:
+        return []
+    matches = indexes.get(user_id).nearest(phash, settings.GALLERY_SIMILAR_DISTANCE,
+                                           settings.GALLERY_SIMILAR_LIMIT, exclude)
+    pieces = GalleryPiece.objects.in_bulk([piece_id for piece_id, _ in matches])
+    return [(pieces[piece_id], distance) for piece_id, distance in matches if piece_id in pieces]
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.template.loader import get_template, render_to_string
+
+from .jobs import enqueue, task
+from .models import Exhibition, GalleryPiece
+from .renditions import read_rendition
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = "snapshots/"
+MANIFEST_NAME = "manifest.json"
+INDEX_NAME = "index.html"
+PIECE_TEMPLATE = "galleryapp/snapshot/piece.html"
+INDEX_TEMPLATE = "galleryapp/snapshot/index.html"
+STYLE_TEMPLATE = "galleryapp/snapshot/style.css"
+LOCK_KEY = "snapshot:lock:"
+LOCK_TIMEOUT = 600
+
+# bump to force every piece to be re-rendered on the next build
+SNAPSHOT_FORMAT = 1
+
+
+def get_snapshot_storage():
+    """Where bundles are written: GALLERY_SNAPSHOT_ROOT on local disk, or else the media storage."""
+    if settings.GALLERY_SNAPSHOT_ROOT:
+        return FileSystemStorage(location=settings.GALLERY_SNAPSHOT_ROOT)
+    return default_storage
+
+
+def snapshot_prefix(token):
+    prefix = "" if settings.GALLERY_SNAPSHOT_ROOT else SNAPSHOT_DIR
+    return "{}{}/".format(prefix, token)
+
+
+def _sha256(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def _template_fingerprint(name):
+    return _sha256(get_template(name).template.source)
+
+
+def piece_hash(piece, fingerprint):
+    """Hash of everything that goes into a piece's part of the bundle."""
+    display = piece.display_image
+    return _sha256(json.dumps([SNAPSHOT_FORMAT, fingerprint, piece.title, piece.description,
+                               piece.image_hash or piece.image.name, display.name, piece.width,
+                               piece.height, piece.placeholder]))
+
+
+def _read(storage, name):
+    with storage.open(name, "rb") as f:
+        return f.read()
+
+
+def _write(storage, name, data):
+    # storages may rename instead of overwriting an existing file
+    if storage.exists(name):
+        storage.delete(name)
+    storage.save(name, ContentFile(data))
+
+
+def _delete(storage, names):
+    for name in names:
+        if storage.exists(name):
+            storage.delete(name)
+
+
+def load_manifest(storage, prefix):
+    try:
+        return json.loads(_read(storage, prefix + MANIFEST_NAME))
+    except (FileNotFoundError, OSError, ValueError):
+        return {"pieces": {}, "assets": {}}
+
+
+def _build_piece(piece, content_hash, storage, prefix):
+    """Copy a piece's display image and thumbnail into the bundle and render its HTML fragment."""
+    display = piece.display_image
+    ext = os.path.splitext(display.name)[1].lower() or ".jpg"
+    image = "images/{}-{}{}".format(piece.id, content_hash[:12], ext)
+    thumb = "images/{}-{}-thumb.jpg".format(piece.id, content_hash[:12])
+
+    _write(storage, prefix + image, _read(display.storage, display.name))
+    thumbnail = piece.thumbnail
+    thumbnail.generate()
+    try:
+        thumb_data = read_rendition(thumbnail)
+    except FileNotFoundError:
+        # the rendition index can outlive the stored file
+        thumbnail.generate(force=True)
+        thumb_data = read_rendition(thumbnail)
+    _write(storage, prefix + thumb, thumb_data)
+
+    html = render_to_string(PIECE_TEMPLATE, {'piece': piece, 'image': image, 'thumb': thumb})
+    return {"hash": content_hash, "files": [image, thumb], "html": html}
+
+
+def build_snapshot(exhib, storage=None):
+    """
+    Write a public exhibition as a static bundle (index.html, images and hashed assets) that can
+    be served without Django. The bundle is updated incrementally: its manifest records a content
+    hash per piece, and only pieces whose hash changed are copied and re-rendered. Returns counts of
+    the pieces rendered, reused and removed.
+    """
+    storage = storage or get_snapshot_storage()
+    prefix = snapshot_prefix(exhib.public_token)
+    old = load_manifest(storage, prefix)
+    stale = set()
+
+    style = render_to_string(STYLE_TEMPLATE)
+    style_name = "assets/style.{}.css".format(_sha256(style)[:12])
+    if old["assets"].get("style") != style_name:
+        _write(storage, prefix + style_name, style.encode())
+        if old["assets"].get("style"):
+            stale.add(old["assets"]["style"])
+
+    fingerprint = _template_fingerprint(PIECE_TEMPLATE)
+    pieces = {}
+    rendered = reused = 0
+    for piece in exhib.gallerypiece_set.exclude(image="").exclude(image=None).order_by("id"):
+        content_hash = piece_hash(piece, fingerprint)
+        previous = old["pieces"].get(str(piece.id))
+        if previous and previous["hash"] == content_hash:
+            pieces[str(piece.id)] = previous
+            reused += 1
+            continue
+        try:
+            pieces[str(piece.id)] = _build_piece(piece, content_hash, storage, prefix)
+        except (FileNotFoundError, OSError) as e:
+            logger.warning("Snapshot of exhibition %s skipped piece %s: %s", exhib.id, piece.id, e)
+            continue
+        if previous:
+            stale.update(previous["files"])
+        rendered += 1
+
+    removed = [p for p in old["pieces"] if p not in pieces]
+    for piece_id in removed:
+        stale.update(old["pieces"][piece_id]["files"])
+
+    index = render_to_string(INDEX_TEMPLATE, {'exhib': exhib, 'style': style_name,
+                                              'pieces': [pieces[p]["html"] for p in pieces]})
+    index_hash = _sha256(index)
+    if old.get("index") != index_hash:
+        _write(storage, prefix + INDEX_NAME, index.encode())
+
+    manifest = {"exhibition": exhib.id, "index": index_hash, "assets": {"style": style_name}, "pieces": pieces}
+    _write(storage, prefix + MANIFEST_NAME, json.dumps(manifest).encode())
+
+    # files still referenced by the new manifest (e.g. after a revert) must survive
+    keep = {style_name}.union(*(p["files"] for p in pieces.values()))
+    _delete(storage, (prefix + name for name in stale - keep))
+
+    return {"rendered": rendered, "reused": reused, "removed": len(removed)}
+
+
+@task(priority=-1)
+def remove_snapshot(token, storage=None):
+    storage = storage or get_snapshot_storage()
+    prefix = snapshot_prefix(token)
+    manifest = load_manifest(storage, prefix)
+    names = [INDEX_NAME, MANIFEST_NAME] + list(manifest["assets"].values())
+    for piece in manifest["pieces"].values():
+        names += piece["files"]
+    _delete(storage, (prefix + name for name in names))
+
+
+class SnapshotBusy(Exception):
+    pass
+
+
+@task(priority=-1)
+def build_exhibition_snapshot(exhibition_id):
+    # two workers must not write the same bundle at once; the job queue retries the loser later
+    lock = LOCK_KEY + str(exhibition_id)
+    if not cache.add(lock, True, LOCK_TIMEOUT):
+        raise SnapshotBusy("Exhibition {} is already being written".format(exhibition_id))
+    try:
+        exhib = Exhibition.objects.filter(id=exhibition_id, public_token__isnull=False).first()
+        if exhib is not None:
+            build_snapshot(exhib)
+    finally:
+        cache.delete(lock)
+
+
+def schedule_build(exhibition_ids):
+    """Queue bundle rebuilds; a burst of changes to one exhibition before its job starts builds it once."""
+    for exhibition_id in exhibition_ids:
+        enqueue(build_exhibition_snapshot, exhibition_id, dedupe_key="snapshot:{}".format(exhibition_id))
+
+
+def schedule_removal(token):
+    enqueue(remove_snapshot, token)
+
+
+class SnapshotPurger:
+    """Purger that rebuilds the static bundles of the public exhibitions affected by a change."""
+
+    def purge(self, keys):
+        exhibition_ids = set()
+        piece_ids = []
+        for key in keys:
+            kind, _, obj_id = key.partition("-")
+            if kind == "exhibition":
+                exhibition_ids.add(int(obj_id))
+            elif kind == "piece":
+                piece_ids.append(int(obj_id))
+        if piece_ids:
+            exhibition_ids.update(GalleryPiece.galleries.through.objects
+                                  .filter(gallerypiece_id__in=piece_ids, exhibition__public_token__isnull=False)
+                                  .values_list("exhibition_id", flat=True))
+        schedule_build(sorted(exhibition_ids))
+
+
+@receiver(post_init, sender=Exhibition)
+def remember_snapshot_token(sender, instance, **kwargs):
+    instance._snapshot_token = instance.__dict__.get("public_token")
+
+
+@receiver(post_save, sender=Exhibition)
+def publish_snapshot(sender, instance, **kwargs):
+    old, new = getattr(instance, "_snapshot_token", None), instance.public_token
+    instance._snapshot_token = new
+    if not settings.GALLERY_SNAPSHOTS or old == new:
+        return
+    if old:
+        transaction.on_commit(lambda: schedule_removal(old))
+    if new:
+        transaction.on_commit(lambda: schedule_build([instance.id]))
+
+
+@receiver(post_delete, sender=Exhibition)
+def remove_deleted_snapshot(sender, instance, **kwargs):
+    token = getattr(instance, "_snapshot_token", None)
+    if settings.GALLERY_SNAPSHOTS and token:
+        transaction.on_commit(lambda: schedule_removal(token))
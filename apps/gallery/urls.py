@@ -12,9 +12,15 @@ urlpatterns = [
     # ec: /gallery/pieces/new
     path('pieces/new/', views.new_gallery_piece, name='piece_new'),
 
+    # ex: /gallery/pieces/similar
+    path('pieces/similar/', views.similar_pieces, name='piece_similar'),
+
     # ex: /gallery/pieces/5
     path('pieces/<int:piece_id>/', views.piece_detail, name='piece_detail'),
 
+    # ex: /gallery/pieces/5/tiles/12/3_4.jpg
+    path('pieces/<int:piece_id>/tiles/<int:level>/<int:col>_<int:row>.jpg', views.piece_tile, name='piece_tile'),
+
     # ex: /gallery/pieces/5/edit
     path('pieces/<int:piece_id>/edit/', views.edit_gallery_piece, name='piece_edit'),
 
@@ -33,6 +39,12 @@ urlpatterns = [
     # ex: /gallery/exhibitions/5/edit
     path('exhibitions/<int:exhibition_id>/edit/', views.edit_exhibition, name='exhibition_edit'),
 
+    # ex: /gallery/exhibitions/5/publish
+    path('exhibitions/<int:exhibition_id>/publish/', views.publish_exhibition, name='exhibition_publish'),
+
     # ex: /gallery/exhibitions/5/delete
     path('exhibitions/<int:exhibition_id>/delete/', views.delete_exhibition, name='exhibition_delete'),
+
+    # ex: /gallery/export
+    path('export/', views.export_gallery, name='export'),
 ]
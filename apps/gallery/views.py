@@ -1,23 +1,63 @@
 import http
+import mimetypes
+import os
+import secrets
 
+from PIL import Image, UnidentifiedImageError
+from django.conf import settings
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound, HttpResponseBadRequest, \
+    StreamingHttpResponse, FileResponse, HttpResponseNotModified, HttpResponseNotAllowed, JsonResponse
 from django.utils import timezone
-from django.core.exceptions import ValidationError
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.core.exceptions import ValidationError, SuspiciousFileOperation
 from django.contrib import messages
-
-from .models import GalleryPiece, Exhibition
+from django.db import transaction
+
+from .models import GalleryPiece, Exhibition, DailyViewCount
+from .export import stream_user_archive
+from .processing import process_upload, dhash_image, run_in_pool
+from .media_urls import attach_piece_urls, get_resolver
+from .quota import has_room, QuotaExceeded, QUOTA_EXCEEDED_MSG
+from .ratelimit import rate_limited
+from .public import serve_public_exhibition
+from .media import media_visible_to, parse_range, RangeFile, SENDFILE_X_ACCEL, SENDFILE_X_SENDFILE
+from .similarity import find_similar
+from .colors import find_by_color, parse_color
+from .analytics import record_view, recent_views
+from .deepzoom import tile_name, viewer_options
 
 PIECE_IMG_DIR = "piece-images/"
-ALLOWED_IMG_EXTENSIONS = ["jpg", "jpeg", "png"]
+ALLOWED_IMG_EXTENSIONS = ["jpg", "jpeg", "png", "gif"]
 PIECE_TITLE_LEN_MAX = 500
 PIECE_DESC_LEN_MAX = 1000
 EXHIB_TITLE_LEN_MAX = 200
 EXHIB_DESC_LEN_MAX = 1000
 MAX_IMG_SIZE_BYTES = 10000000
+# what Pillow raises for an upload it cannot decode; anything else (a broken or timed out worker
+# pool, a bad GALLERY_IMAGE_FORMAT) is a server fault and is left to become a logged 500
+IMG_DECODE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError)
 
 UNAUTHENTICATED_MSG = "You must be logged in to do that."
-FORBIDDEN_MSG = "You do not have access to this."
+NOT_FOUND_MSG = "That does not exist."
+IMG_PROCESSING_ERROR_MSG = "This image could not be processed."
+INVALID_COLOR_MSG = "Invalid color (expected #rrggbb)"
+SIMILAR_PIECE_MSG = "This looks like \"{}\", which is already in your gallery."
+
+
+def get_owned(model, request, obj_id):
+    """Fetch an object by id in a single query, or None if it does not exist or is not the user's."""
+    return model.objects.filter(id=obj_id, user_id=request.user.id).first()
+
+
+def delete_owned(model, request, obj_id):
+    """
+    Delete an object by id in one ownership-scoped DELETE. Django only loads the row first when
+    cascades or delete signals (e.g. image cleanup) need it. Returns False if nothing was deleted.
+    """
+    deleted, _ = model.objects.filter(id=obj_id, user_id=request.user.id).delete()
+    return deleted > 0
 
 
 def index(request):
@@ -28,7 +68,20 @@ def index(request):
     exhibs_list = Exhibition.objects.filter(user=request.user)
     return render(request=request,
                   template_name="galleryapp/my_gallery_dashboard.html",
-                  context={'pieces': pieces_list, 'exhibs': exhibs_list})
+                  context={'pieces': pieces_list, 'exhibs': exhibs_list,
+                           'top_pieces': most_viewed(DailyViewCount.PIECE, pieces_list),
+                           'top_exhibs': most_viewed(DailyViewCount.EXHIBITION, exhibs_list)})
+
+
+def most_viewed(kind, queryset, limit=10):
+    """The most viewed objects of the last 30 days, with ``recent_views`` set, read from the daily rollups."""
+    views = recent_views(kind, queryset.values("id"))
+    top = sorted(views, key=lambda object_id: -views[object_id])[:limit]
+    objects = queryset.in_bulk(top)
+    for object_id in top:
+        if object_id in objects:
+            objects[object_id].recent_views = views[object_id]
+    return [objects[object_id] for object_id in top if object_id in objects]
 
 
 # Gallery Piece
@@ -38,27 +91,57 @@ def pieces_list_view(request):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    pieces_list = GalleryPiece.objects.filter(user=request.user)
+    color = request.GET.get("color", "")
+    if color:
+        rgb = parse_color(color)
+        if rgb is None:
+            return HttpResponseBadRequest(INVALID_COLOR_MSG)
+        pieces_list = attach_piece_urls(find_by_color(request.user.id, rgb))
+    else:
+        pieces_list = attach_piece_urls(GalleryPiece.objects.filter(user=request.user))
 
     return render(request=request,
                   template_name="galleryapp/gallery_pieces_list.html",
-                  context={'pieces': pieces_list})
+                  context={'pieces': pieces_list, 'color': color})
 
 
 def piece_detail(request, piece_id):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    piece = GalleryPiece.objects.get(id=piece_id)
+    piece = get_owned(GalleryPiece, request, piece_id)
 
-    if not request.user == piece.user:
-        return HttpResponseForbidden(reason=FORBIDDEN_MSG)
+    if piece is None:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
 
+    record_view(DailyViewCount.PIECE, piece.id)
+    attach_piece_urls([piece], thumbnails=False)
     return render(request=request,
                   template_name="galleryapp/gallery_piece_detail.html",
-                  context={'piece': piece})
+                  context={'piece': piece, 'deep_zoom': viewer_options(piece)})
 
 
+def piece_tile(request, piece_id, level, col, row):
+    """
+    Redirect the deep zoom viewer to the media URL of one tile of a piece's pyramid. Only used where
+    the viewer cannot be given a URL for the whole pyramid (see deepzoom.viewer_options).
+    """
+    if not request.user.is_authenticated:
+        return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
+
+    piece = get_owned(GalleryPiece, request, piece_id)
+
+    if piece is None or viewer_options(piece, tile_url=False) is None:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
+
+    name = tile_name(piece.image.name, level, col, row)
+    response = HttpResponseRedirect(get_resolver().resolve([name])[name])
+    # signed URLs are handed out with at least this long left to run
+    response["Cache-Control"] = "private, max-age={}".format(settings.GALLERY_SIGNED_URL_MARGIN)
+    return response
+
+
+@rate_limited('upload', concurrent=True)
 def new_gallery_piece(request):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
@@ -108,6 +191,17 @@ def new_gallery_piece(request):
                 img_error = e.message
                 save = False
 
+            if save and not has_room(request.user, uploaded_img.size):
+                img_error = QUOTA_EXCEEDED_MSG
+                save = False
+
+        if save:
+            try:
+                processed = process_upload(uploaded_img)
+            except IMG_DECODE_ERRORS:
+                img_error = IMG_PROCESSING_ERROR_MSG
+                save = False
+
         if save:
             # construct a new gallery piece with the form data
             created_gallery_piece = GalleryPiece(title=created_title,
@@ -115,12 +209,23 @@ def new_gallery_piece(request):
                                                  pub_date=timezone.now(),
                                                  user=request.user,
                                                  image=uploaded_img)
+            created_gallery_piece.apply_image_metadata(processed)
             created_gallery_piece.clean()
 
-            # save the new gallery piece to the database
-            created_gallery_piece.save()
+            # save the new gallery piece to the database; the quota is charged in the same
+            # transaction, before the image is written to storage
+            try:
+                with transaction.atomic():
+                    created_gallery_piece.save()
+            except QuotaExceeded:
+                img_error = QUOTA_EXCEEDED_MSG
+                save = False
 
+        if save:
             messages.success(request, "Piece created successfully.")
+            for similar, _ in find_similar(request.user.id, created_gallery_piece.perceptual_hash,
+                                           exclude=[created_gallery_piece.id]):
+                messages.warning(request, SIMILAR_PIECE_MSG.format(similar.title))
 
             return HttpResponseRedirect("/gallery/pieces/")
         else:
@@ -136,14 +241,15 @@ def new_gallery_piece(request):
                            'img_error': img_error})
 
 
+@rate_limited('upload', concurrent=True)
 def edit_gallery_piece(request, piece_id):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    piece = GalleryPiece.objects.get(id=piece_id)
+    piece = get_owned(GalleryPiece, request, piece_id)
 
-    if not piece.user == request.user:
-        return HttpResponseForbidden(reason=FORBIDDEN_MSG)
+    if piece is None:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
 
     actual_title = piece.title
     title = piece.title
@@ -199,11 +305,38 @@ def edit_gallery_piece(request, piece_id):
                 img_error = e.message
                 save = False
 
+            if save and not has_room(request.user, img.size - (piece.image_size or 0)):
+                img_error = QUOTA_EXCEEDED_MSG
+                save = False
+
+        if save and img_c:
+            try:
+                processed = process_upload(img)
+            except IMG_DECODE_ERRORS:
+                img_error = IMG_PROCESSING_ERROR_MSG
+                save = False
+
+        if save:
+            # only write the columns that changed, and leave the image (and its storage) alone
+            # unless a new one was uploaded
+            update_fields = []
+            if title_c:
+                piece.title = title
+                update_fields.append('title')
+            if desc_c:
+                piece.description = desc
+                update_fields.append('description')
+            if img_c:
+                piece.image = img
+                update_fields += ['image'] + piece.apply_image_metadata(processed)
+            try:
+                with transaction.atomic():
+                    piece.save(update_fields=update_fields)
+            except QuotaExceeded:
+                img_error = QUOTA_EXCEEDED_MSG
+                save = False
+
         if save:
-            piece.title = title
-            piece.description = desc
-            piece.image = img
-            piece.save()
             messages.success(request, "Changes successfully applied")
 
             actual_title = title
@@ -223,16 +356,44 @@ def edit_gallery_piece(request, piece_id):
                            'img_error': img_error})
 
 
-def delete_gallery_piece(request, piece_id):
+@rate_limited('write')
+def similar_pieces(request):
+    """
+    Check an image before it is uploaded: returns the user's pieces that look like it as JSON.
+    Only a small perceptual hash of the image is computed; nothing is stored.
+    """
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    piece = GalleryPiece.objects.get(id=piece_id)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    if "pieceImage" not in request.FILES:
+        return HttpResponseBadRequest("Required fields not in POST data")
 
-    if not piece.user == request.user:
-        return HttpResponseForbidden(reason=FORBIDDEN_MSG)
+    uploaded_img = request.FILES["pieceImage"]
+    try:
+        validate_gallery_piece_image(uploaded_img)
+        phash = run_in_pool(dhash_image, uploaded_img.read())
+    except ValidationError as e:
+        return HttpResponseBadRequest(e.message)
+    except IMG_DECODE_ERRORS:
+        return HttpResponseBadRequest(IMG_PROCESSING_ERROR_MSG)
 
-    piece.delete()
+    matches = [{'id': piece.id, 'title': piece.title, 'distance': distance,
+                'url': "/gallery/pieces/{}/".format(piece.id)}
+               for piece, distance in find_similar(request.user.id, phash)]
+    return JsonResponse({'matches': matches})
+
+
+# deletes are plain links, so GETs are limited too
+@rate_limited('write', all_methods=True)
+def delete_gallery_piece(request, piece_id):
+    if not request.user.is_authenticated:
+        return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
+
+    if not delete_owned(GalleryPiece, request, piece_id):
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
 
     messages.success(request, "Piece deleted successfully.")
 
@@ -257,16 +418,20 @@ def exhibition_detail(request, exhibition_id):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    exhib = Exhibition.objects.get(id=exhibition_id)
+    exhib = get_owned(Exhibition, request, exhibition_id)
 
-    if not exhib.user == request.user:
-        return HttpResponseForbidden(reason=FORBIDDEN_MSG)
+    if exhib is None:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
 
+    pieces = attach_piece_urls(exhib.gallerypiece_set.all(), thumbnails=False)
+
+    record_view(DailyViewCount.EXHIBITION, exhib.id)
     return render(request=request,
                   template_name='galleryapp/exhibition_detail.html',
-                  context={'exhib': exhib})
+                  context={'exhib': exhib, 'pieces': pieces})
 
 
+@rate_limited('write')
 def new_exhibition(request):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
@@ -323,14 +488,15 @@ def new_exhibition(request):
                            'desc_error': desc_error})
 
 
+@rate_limited('write')
 def edit_exhibition(request, exhibition_id):
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    exhib = Exhibition.objects.get(id=exhibition_id)
+    exhib = get_owned(Exhibition, request, exhibition_id)
 
-    if not exhib.user == request.user:
-        return HttpResponseForbidden(reason=FORBIDDEN_MSG)
+    if exhib is None:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
 
     actual_title = exhib.title
     title = exhib.title
@@ -375,9 +541,14 @@ def edit_exhibition(request, exhibition_id):
                 save = False
 
         if save:
-            exhib.title = title
-            exhib.description = desc
-            exhib.save()
+            update_fields = []
+            if title_c:
+                exhib.title = title
+                update_fields.append('title')
+            if desc_c:
+                exhib.description = desc
+                update_fields.append('description')
+            exhib.save(update_fields=update_fields)
 
             messages.success(request, "Changes successfully applied")
 
@@ -396,22 +567,133 @@ def edit_exhibition(request, exhibition_id):
                            'desc_error': desc_error})
 
 
-def delete_exhibition(request, exhibition_id):
+@rate_limited('write')
+def publish_exhibition(request, exhibition_id):
+    """Toggle an exhibition's public link. A new link is issued each time it is shared."""
     if not request.user.is_authenticated:
         return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
 
-    exhib = Exhibition.objects.get(id=exhibition_id)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    exhib = get_owned(Exhibition, request, exhibition_id)
+
+    if exhib is None:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
+
+    if exhib.public_token:
+        exhib.public_token = None
+        messages.success(request, "Exhibition is now private.")
+    else:
+        exhib.public_token = secrets.token_urlsafe(16)
+        messages.success(request, "Exhibition is now public.")
+    exhib.save(update_fields=['public_token'])
 
-    if not exhib.user == request.user:
-        return HttpResponseForbidden(reason=FORBIDDEN_MSG)
+    return HttpResponseRedirect("/gallery/exhibitions/" + str(exhib.id) + "/")
 
-    exhib.delete()
+
+def public_exhibition(request, token):
+    # normally answered by PublicPageMiddleware before the session and auth middleware run
+    return serve_public_exhibition(token)
+
+
+@rate_limited('write', all_methods=True)
+def delete_exhibition(request, exhibition_id):
+    if not request.user.is_authenticated:
+        return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
+
+    if not delete_owned(Exhibition, request, exhibition_id):
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
 
     messages.success(request, "Exhibition deleted successfully.")
 
     return HttpResponseRedirect("/gallery/exhibitions/")
 
 
+# Export
+
+
+def export_gallery(request):
+    if not request.user.is_authenticated:
+        return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
+
+    response = StreamingHttpResponse(stream_user_archive(request.user), content_type="application/zip")
+    response["Content-Disposition"] = 'attachment; filename="{}-gallery.zip"'.format(request.user.username)
+    return response
+
+
+# Media
+
+
+def serve_media(request, path):
+    """
+    Serve a file from MEDIA_ROOT to the owner of the piece it belongs to, or to anyone if the
+    piece is in a public exhibition. The file is never read into Python: it is handed to the WSGI
+    server's file wrapper (sendfile), or to nginx/Apache with X-Accel-Redirect/X-Sendfile
+    depending on GALLERY_MEDIA_SENDFILE.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
+
+    name = os.path.relpath(full_path, settings.MEDIA_ROOT).replace(os.sep, "/")
+    if not media_visible_to(request.user, name):
+        if not request.user.is_authenticated:
+            return HttpResponse(status=http.HTTPStatus.UNAUTHORIZED, reason=UNAUTHENTICATED_MSG)
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
+
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return HttpResponseNotFound(reason=NOT_FOUND_MSG)
+
+    last_modified = http_date(stat.st_mtime)
+    since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    if since is not None and int(stat.st_mtime) <= since:
+        response = HttpResponseNotModified()
+        response["Last-Modified"] = last_modified
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+    if settings.GALLERY_MEDIA_SENDFILE == SENDFILE_X_ACCEL:
+        # nginx handles ranges and conditional requests for the internal location itself
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.GALLERY_MEDIA_ACCEL_PREFIX + name
+        response["Last-Modified"] = last_modified
+        return response
+    if settings.GALLERY_MEDIA_SENDFILE == SENDFILE_X_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = full_path
+        response["Last-Modified"] = last_modified
+        return response
+
+    size = stat.st_size
+    start, end = 0, size - 1
+    status = http.HTTPStatus.OK
+    if "Range" in request.headers:
+        try:
+            requested = parse_range(request.headers["Range"], size)
+        except ValueError:
+            response = HttpResponse(status=http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            response["Content-Range"] = "bytes */{}".format(size)
+            return response
+        if requested is not None:
+            start, end = requested
+            status = http.HTTPStatus.PARTIAL_CONTENT
+
+    f = open(full_path, "rb")
+    f.seek(start)
+    response = FileResponse(RangeFile(f, end - start + 1), status=status, content_type=content_type)
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["Last-Modified"] = last_modified
+    if status == http.HTTPStatus.PARTIAL_CONTENT:
+        response["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+    return response
+
+
 # Form validation methods
 
 
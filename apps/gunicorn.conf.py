@@ -0,0 +1,109 @@
+"""
+Gunicorn configuration, read automatically when gunicorn is started from this directory.
+
+Sizing and worker model come from environment variables:
+    JGWORKER_CLASS  sync (default), gthread or uvicorn (needs the uvicorn package)
+    JGWORKERS       worker processes (default depends on the worker class and CPU count); more
+                    than one needs a shared cache in JGCACHE_URL
+    JGTHREADS       threads per gthread worker (default 4)
+    JGMAX_REQUESTS  requests a worker serves before it is recycled (default 1000, 0 to disable)
+"""
+import os
+import time
+
+MB = 1024 * 1024
+
+WORKER_CLASSES = {
+    'sync': 'sync',
+    'gthread': 'gthread',
+    'uvicorn': 'uvicorn.workers.UvicornWorker',
+}
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_workers(kind, cpus):
+    if kind == 'sync':
+        # sync workers block on I/O (storage, database), so oversubscribe the CPUs
+        return 2 * cpus + 1
+    # gthread and uvicorn workers overlap I/O themselves; one per CPU keeps image processing and
+    # template rendering from fighting over cores
+    return cpus + 1
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+worker_kind = os.environ.get('JGWORKER_CLASS', 'sync')
+if worker_kind not in WORKER_CLASSES:
+    raise RuntimeError("Invalid JGWORKER_CLASS specified. Choose one of {}".format(list(WORKER_CLASSES)))
+
+if worker_kind == 'uvicorn':
+    wsgi_app = 'joshuasgallery_server.asgi:application'
+else:
+    wsgi_app = 'joshuasgallery_server.wsgi:application'
+
+bind = os.environ.get('JGBIND', '0.0.0.0:8000')
+worker_class = WORKER_CLASSES[worker_kind]
+workers = int(os.environ.get('JGWORKERS', default_workers(worker_kind, cpu_count())))
+threads = int(os.environ.get('JGTHREADS', 4)) if worker_kind == 'gthread' else 1
+# the settings refuse per-process caches when there are several workers (see JGCACHE_URL)
+os.environ['JGWORKERS'] = str(workers)
+
+# uploads may spend up to GALLERY_IMAGE_TIMEOUT (60s) being processed
+timeout = 90
+graceful_timeout = 30
+keepalive = 5
+
+# Pillow's and Python's allocators rarely hand decoded image memory back to the OS, so recycle
+# workers periodically; the jitter keeps them from all restarting at once.
+max_requests = int(os.environ.get('JGMAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+# Load the application once in the master and fork warmed-up workers that share it (see
+# GALLERY_PRELOAD).
+preload_app = True
+os.environ.setdefault('JGPRELOAD', '1')
+
+# heartbeat files on tmpfs, so a slow disk cannot make workers look hung
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('JGLOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    server.log.info("Master ready (%s x %s, %.1f MB RSS)", workers, worker_class, rss_mb())
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    # write buffered view counts out on a timer, even while the worker is idle (see gallery.analytics)
+    from gallery.analytics import start_flushing
+    start_flushing()
+    worker.log.info("Worker %s booted in %.1f ms (%.1f MB RSS)",
+                    worker.pid, (time.monotonic() - worker.forked_at) * 1000, rss_mb())
+
+
+def worker_exit(server, worker):
+    # write out the view counts buffered in this worker (see gallery.analytics)
+    from gallery.analytics import flush_views
+    flush_views()
+    server.log.info("Worker %s exiting after %s requests (%.1f MB RSS)",
+                    worker.pid, worker.nr, rss_mb())
@@ -0,0 +1,31 @@
+import gc
+import os
+
+from django.conf import settings
+
+
+def iter_template_names():
+    for directory in settings.TEMPLATES[0]['DIRS']:
+        for root, _, files in os.walk(directory):
+            for f in files:
+                if f.endswith(".html"):
+                    yield os.path.relpath(os.path.join(root, f), directory).replace(os.sep, "/")
+
+
+def warm_up():
+    """
+    Do the work a worker would otherwise repeat on its first requests: import every view module
+    via the URLconf, register Pillow's format plugins and compile the project templates (kept by
+    the cached template loader when DEBUG is off). Then freeze everything allocated so far, so the
+    garbage collector never writes to those pages in forked workers and they stay shared.
+    """
+    from django.template.loader import get_template
+    from django.urls import get_resolver
+    from PIL import Image
+
+    get_resolver().url_patterns
+    Image.init()
+    for name in iter_template_names():
+        get_template(name)
+
+    gc.freeze()
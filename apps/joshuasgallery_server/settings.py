@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -88,6 +89,7 @@ CRISPY_TEMPLATE_PACK = 'bootstrap5'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'gallery.public.PublicPageMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -159,16 +161,259 @@ if ENV == ENV_LOCAL:
     MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
     MEDIA_URL = '/media/'
 elif ENV == ENV_DEV:
-    DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+    DEFAULT_FILE_STORAGE = 'joshuasgallery_server.storage.GalleryS3Storage'
     AWS_STORAGE_BUCKET_NAME = 'bucket-jg-dev'
     AWS_S3_REGION_NAME = 'us-east-1'
 elif ENV == ENV_PROD:
-    DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+    DEFAULT_FILE_STORAGE = 'joshuasgallery_server.storage.GalleryS3Storage'
     AWS_STORAGE_BUCKET_NAME = 'bucket-jg-prod'
     AWS_S3_REGION_NAME = 'us-east-1'
 else:
     raise RuntimeError("No media storage location defined for ENV '{}'".format(ENV))
 
+# S3 transfer tuning (used by GalleryS3Storage)
+# GalleryS3Storage shares one client, and so one pool of AWS_S3_MAX_POOL_CONNECTIONS keep-alive
+# connections, between all threads of a process. The multipart defaults are boto3's own; change
+# them only after measuring with `manage.py bench_storage`.
+AWS_S3_MULTIPART_THRESHOLD = int(os.environ.get('JGS3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+AWS_S3_MULTIPART_CHUNKSIZE = int(os.environ.get('JGS3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024))
+AWS_S3_MAX_CONCURRENCY = int(os.environ.get('JGS3_MAX_CONCURRENCY', 10))
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.environ.get('JGS3_MAX_POOL_CONNECTIONS', 20))
+
+# Caching
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Set JGCACHE_URL to a redis:// (or rediss://) URL, or to memcached://<host>:<port> (needs the
+# pymemcache package), to share the cache between processes. Without it each process has its own
+# cache, which is only correct for a single worker: public pages, piece index versions and rate
+# limits must be seen by every worker, so settings refuse to load with a per-process cache once
+# JGWORKERS (exported by gunicorn.conf.py) is above 1.
+LOCMEM_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+CACHE_URL = os.environ.get('JGCACHE_URL', '')
+if CACHE_URL.startswith(('redis://', 'rediss://')):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+elif CACHE_URL.startswith('memcached://'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': CACHE_URL[len('memcached://'):],
+        }
+    }
+elif not CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': LOCMEM_CACHE,
+            'LOCATION': 'joshuasgallery',
+        }
+    }
+else:
+    raise RuntimeError("Invalid JGCACHE_URL specified. Use a redis://, rediss:// or memcached:// URL")
+
+GALLERY_WORKERS = int(os.environ.get('JGWORKERS', 1))
+
+
+def require_shared_cache(setting, alias):
+    if GALLERY_WORKERS > 1 and CACHES[alias]['BACKEND'] == LOCMEM_CACHE:
+        raise RuntimeError("{} must be a cache shared by all {} workers. Set JGCACHE_URL.".format(
+            setting, GALLERY_WORKERS))
+
+# Sessions and messages
+# Choose the session backend with JGSESSION. 'db' (Django's default) reads every session from the
+# database; 'cached_db' serves session reads from the cache and only falls back to the database on
+# a miss, and needs a shared cache (JGCACHE_URL) so that a logout reaches every worker;
+# 'signed_cookies' keeps the (small) session payload in the client cookie and never touches the
+# database.
+SESSION_BACKEND_CACHED_DB = 'cached_db'
+SESSION_BACKEND_SIGNED_COOKIES = 'signed_cookies'
+SESSION_BACKEND_DB = 'db'
+SESSION_ENGINES = {
+    SESSION_BACKEND_CACHED_DB: 'django.contrib.sessions.backends.cached_db',
+    SESSION_BACKEND_SIGNED_COOKIES: 'django.contrib.sessions.backends.signed_cookies',
+    SESSION_BACKEND_DB: 'django.contrib.sessions.backends.db',
+}
+
+SESSION_BACKEND = os.environ.get('JGSESSION', SESSION_BACKEND_DB)
+if SESSION_BACKEND not in SESSION_ENGINES:
+    raise RuntimeError("Invalid JGSESSION specified. Choose one of {}".format(list(SESSION_ENGINES)))
+if SESSION_BACKEND == SESSION_BACKEND_CACHED_DB and CACHES['default']['BACKEND'] == LOCMEM_CACHE:
+    raise RuntimeError("JGSESSION '{}' needs a shared cache. Set JGCACHE_URL.".format(SESSION_BACKEND_CACHED_DB))
+SESSION_ENGINE = SESSION_ENGINES[SESSION_BACKEND]
+
+# Flash messages live in their own signed cookie so they never cause a session write.
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# Uploaded image processing
+# Every upload is kept as-is and an optimized master (auto-oriented, metadata stripped, longest
+# edge capped, recompressed) is produced by a pool of worker processes. Set JGIMAGE_WORKERS=0 to
+# process inline in the request thread.
+GALLERY_IMAGE_MAX_EDGE = int(os.environ.get('JGIMAGE_MAX_EDGE', 2560))
+GALLERY_IMAGE_FORMAT = os.environ.get('JGIMAGE_FORMAT', 'JPEG')
+GALLERY_IMAGE_QUALITY = 85
+GALLERY_IMAGE_WORKERS = int(os.environ.get('JGIMAGE_WORKERS', 2))
+GALLERY_IMAGE_TIMEOUT = 60
+
+# Image renditions (thumbnails)
+# Renditions known to exist are tracked in an LRU index, so resolving a rendition's URL does not
+# need to ask the media storage. Generated renditions are also copied to GALLERY_RENDITION_CACHE_DIR
+# on local disk, evicted oldest-first past GALLERY_RENDITION_CACHE_MAX_BYTES; new worker processes
+# rebuild the index from it, and snapshot builds read renditions from it instead of the storage.
+# Rendition names include the source's content hash, so replacing an image changes them in every
+# process; the old files are deleted by a background job.
+# Missing renditions are generated by one worker at a time (coordinated through lock files in
+# GALLERY_RENDITION_LOCK_DIR); the others wait up to GALLERY_RENDITION_LOCK_TIMEOUT seconds.
+IMAGEKIT_DEFAULT_CACHEFILE_BACKEND = 'gallery.renditions.TieredCacheFileBackend'
+IMAGEKIT_SPEC_CACHEFILE_NAMER = 'gallery.renditions.content_hash_namer'
+GALLERY_RENDITION_CACHE_DIR = os.environ.get(
+    'JGRENDITION_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'joshuasgallery-renditions'))
+GALLERY_RENDITION_CACHE_MAX_BYTES = int(os.environ.get('JGRENDITION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+GALLERY_RENDITION_CACHE_MAX_ENTRIES = 100000
+GALLERY_RENDITION_LOCK_DIR = os.environ.get(
+    'JGRENDITION_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'joshuasgallery-locks'))
+GALLERY_RENDITION_LOCK_TIMEOUT = 5
+
+# Deep zoom
+# Originals whose longest edge exceeds GALLERY_DEEP_ZOOM_MIN_EDGE (by default, those the optimized
+# master had to shrink) are also cut into a Deep Zoom tile pyramid by a background job, and the
+# piece page shows them in a viewer that only fetches the tiles in view. It fetches them straight
+# from the media URLs in the 'cdn' and unsigned 'storage' modes (see GALLERY_MEDIA_URL_MODE); with
+# signed URLs each tile goes through a view that redirects to its signed URL.
+GALLERY_DEEP_ZOOM = os.environ.get('JGDEEP_ZOOM', '1') == '1'
+GALLERY_DEEP_ZOOM_MIN_EDGE = int(os.environ.get('JGDEEP_ZOOM_MIN_EDGE', GALLERY_IMAGE_MAX_EDGE))
+
+# Animated images
+# Animated GIF uploads are transcoded by a background job into an animated WebP and, when ffmpeg
+# (JGFFMPEG) is installed, an H.264 MP4, each kept only if smaller than what it replaces. Pages
+# offer them ahead of the GIF, so each browser loads the smallest format it can play.
+GALLERY_ANIMATIONS = os.environ.get('JGANIMATIONS', '1') == '1'
+GALLERY_ANIMATION_QUALITY = 75
+GALLERY_ANIMATION_TIMEOUT = 300
+GALLERY_FFMPEG = os.environ.get('JGFFMPEG', 'ffmpeg')
+
+# Piece indexes
+# Near-duplicate and colour search run against per-user NumPy indexes held in each process, for
+# the GALLERY_INDEX_MAX_USERS most recently active users. Processes learn of changes through
+# version numbers in GALLERY_INDEX_CACHE, which must be shared between workers (see JGCACHE_URL).
+GALLERY_INDEX_CACHE = 'default'
+GALLERY_INDEX_MAX_USERS = 256
+require_shared_cache('GALLERY_INDEX_CACHE', GALLERY_INDEX_CACHE)
+
+# Near-duplicate detection
+# Every piece gets a 64-bit perceptual hash; uploads that come within GALLERY_SIMILAR_DISTANCE
+# differing bits of one of the user's existing pieces are flagged as possible duplicates.
+GALLERY_SIMILAR_DISTANCE = int(os.environ.get('JGSIMILAR_DISTANCE', 10))
+GALLERY_SIMILAR_LIMIT = 5
+
+# Colour search
+# Every piece gets a small palette of dominant colours. /gallery/pieces/?color=%23aabbcc lists the
+# pieces with a palette colour within GALLERY_COLOR_DISTANCE (CIE76 delta E) of the requested one,
+# closest first.
+GALLERY_COLOR_DISTANCE = int(os.environ.get('JGCOLOR_DISTANCE', 20))
+
+# View counts
+# Piece and exhibition views are counted in memory by each worker and added to the daily
+# DailyViewCount rollups in one batched upsert every GALLERY_VIEWCOUNT_FLUSH_INTERVAL seconds (or
+# once GALLERY_VIEWCOUNT_MAX_PENDING counters are waiting), from a background thread in gunicorn
+# workers and as the next request starts elsewhere. Workers flush on a graceful exit, so recycling
+# loses nothing and a crash loses at most one interval.
+GALLERY_VIEWCOUNT_FLUSH_INTERVAL = int(os.environ.get('JGVIEWCOUNT_FLUSH_INTERVAL', 10))
+GALLERY_VIEWCOUNT_MAX_PENDING = 1000
+
+# Background jobs
+# Slow work is queued as gallery.models.Job rows and run by `manage.py runworker` (run it next to
+# the web server, e.g. in a second container). Failed jobs are retried up to their max_attempts
+# with exponential backoff from GALLERY_JOB_RETRY_DELAY seconds. A running job's worker renews its
+# lease every GALLERY_JOB_HEARTBEAT seconds; jobs whose lease is not renewed for GALLERY_JOB_TIMEOUT
+# seconds are assumed lost and queued again. Finished jobs are kept for GALLERY_JOB_RETENTION days.
+GALLERY_JOB_CONCURRENCY = int(os.environ.get('JGJOB_CONCURRENCY', 2))
+GALLERY_JOB_MODE = os.environ.get('JGJOB_MODE', 'thread')
+GALLERY_JOB_POLL_INTERVAL = 1.0
+GALLERY_JOB_RETRY_DELAY = 10
+GALLERY_JOB_MAX_RETRY_DELAY = 3600
+GALLERY_JOB_HEARTBEAT = 30
+GALLERY_JOB_TIMEOUT = 120
+GALLERY_JOB_RETENTION = 7
+
+# Media URLs
+# How list pages build media URLs in bulk: 'storage' asks the storage backend, 'cdn' joins names
+# onto JGMEDIA_CDN_URL without signing, 'signed' presigns S3 URLs and reuses them until
+# GALLERY_SIGNED_URL_MARGIN seconds before they expire.
+GALLERY_MEDIA_URL_MODE = os.environ.get('JGMEDIA_URL_MODE', 'storage')
+GALLERY_MEDIA_CDN_URL = os.environ.get('JGMEDIA_CDN_URL', '')
+GALLERY_SIGNED_URL_MARGIN = 300
+
+# Public exhibitions
+# Shared exhibitions are served at /p/<token>/ by gallery.public.PublicPageMiddleware, ahead of the
+# session and auth middleware. Rendered pages are cached in GALLERY_PUBLIC_CACHE, which must be
+# shared between workers (see JGCACHE_URL), and tagged with surrogate keys; edits purge the
+# affected keys through every purger in GALLERY_PUBLIC_PURGERS. Add 'gallery.public.FastlyPurger' (with
+# JGFASTLY_SERVICE_ID and JGFASTLY_API_TOKEN) when the pages sit behind Fastly; its API calls are
+# made by the job worker (manage.py runworker), which retries failed purges.
+GALLERY_PUBLIC_CACHE = 'default'
+GALLERY_PUBLIC_PAGE_TIMEOUT = 3600
+GALLERY_PUBLIC_BROWSER_TIMEOUT = 60
+GALLERY_PUBLIC_PURGERS = ['gallery.public.CachePurger']
+GALLERY_FASTLY_SERVICE_ID = os.environ.get('JGFASTLY_SERVICE_ID', '')
+GALLERY_FASTLY_API_TOKEN = os.environ.get('JGFASTLY_API_TOKEN', '')
+require_shared_cache('GALLERY_PUBLIC_CACHE', GALLERY_PUBLIC_CACHE)
+
+# Static snapshots
+# Public exhibitions are also written out as static bundles (index.html, images and hashed assets)
+# that any web server or bucket can serve without Django: to JGSNAPSHOT_ROOT/<token>/ when set, or
+# else to snapshots/<token>/ in the media storage. Bundles are built by background jobs when an
+# exhibition is published and rebuilt incrementally after edits; `manage.py snapshot_exhibitions`
+# rebuilds them on demand.
+GALLERY_SNAPSHOTS = os.environ.get('JGSNAPSHOTS', '1') == '1'
+GALLERY_SNAPSHOT_ROOT = os.environ.get('JGSNAPSHOT_ROOT', '')
+if GALLERY_SNAPSHOTS:
+    GALLERY_PUBLIC_PURGERS.append('gallery.snapshot.SnapshotPurger')
+
+# Storage quotas
+# Default number of bytes of original images each user may upload (0 for no limit); files derived
+# from them (masters, renditions, tiles, animations) are not counted. Per-user limits can be set
+# on their StorageQuota in the admin. Totals are kept up to date on every save and delete; run
+# reconcile_quotas to recompute them from the pieces' recorded sizes.
+GALLERY_QUOTA_BYTES = int(os.environ.get('JGQUOTA_BYTES', 1024 * 1024 * 1024))
+
+# Rate limiting
+# Token buckets per user for the gallery's write views ('20/m' allows a burst of 20 and refills
+# 20 a minute), and at most GALLERY_UPLOAD_CONCURRENCY uploads being processed per user at once.
+# With JGCACHE_URL set the state is shared by all workers through GALLERY_RATELIMIT_CACHE;
+# otherwise it is kept in the one worker process, whose upload slots only fill up if it is a
+# threaded (gthread) or async (uvicorn) worker.
+RATELIMIT_LOCAL_STORE = 'gallery.ratelimit.LocalMemoryStore'
+GALLERY_RATELIMIT_STORE = os.environ.get(
+    'JGRATELIMIT_STORE', 'gallery.ratelimit.CacheStore' if CACHE_URL else RATELIMIT_LOCAL_STORE)
+GALLERY_RATELIMIT_CACHE = 'default'
+GALLERY_RATELIMIT_SLOT_TIMEOUT = 300
+GALLERY_RATELIMITS = {
+    'upload': os.environ.get('JGRATELIMIT_UPLOAD', '20/m'),
+    'write': os.environ.get('JGRATELIMIT_WRITE', '60/m'),
+}
+GALLERY_UPLOAD_CONCURRENCY = int(os.environ.get('JGUPLOAD_CONCURRENCY', 2))
+if GALLERY_RATELIMIT_STORE == RATELIMIT_LOCAL_STORE and GALLERY_WORKERS > 1:
+    raise RuntimeError("JGRATELIMIT_STORE '{}' only limits one of the {} workers. Set JGCACHE_URL.".format(
+        RATELIMIT_LOCAL_STORE, GALLERY_WORKERS))
+require_shared_cache('GALLERY_RATELIMIT_CACHE', GALLERY_RATELIMIT_CACHE)
+
+# Media serving (local storage)
+# Media on local disk is served by gallery.views.serve_media, which checks piece ownership and
+# then hands the file off: 'django' streams it with the WSGI server's sendfile support, 'x-accel'
+# redirects nginx to the internal location GALLERY_MEDIA_ACCEL_PREFIX (aliased to MEDIA_ROOT) and
+# 'x-sendfile' passes the absolute path to Apache/lighttpd.
+GALLERY_SERVE_MEDIA = ENV == ENV_LOCAL
+GALLERY_MEDIA_SENDFILE = os.environ.get('JGMEDIA_SENDFILE', 'django')
+GALLERY_MEDIA_ACCEL_PREFIX = os.environ.get('JGMEDIA_ACCEL_PREFIX', '/protected-media/')
+
+# Startup
+# Set JGPRELOAD=1 when the WSGI application is loaded once in a parent process before forking
+# workers (gunicorn --preload): wsgi.py then imports views, compiles templates and freezes the GC
+# heap up front so workers start warm and share that memory copy-on-write.
+GALLERY_PRELOAD = os.environ.get('JGPRELOAD', '0') == '1'
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
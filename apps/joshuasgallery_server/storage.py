@@ -0,0 +1,81 @@
+import threading
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import setting
+
+MB = 1024 * 1024
+
+
+class GalleryS3Storage(S3Boto3Storage):
+    """
+    S3 storage with one connection pool per worker process.
+
+    The stock storage gives every thread its own boto3 resource, and so its own client and
+    connection pool: each new thread (a gthread worker's, or an upload's) starts with cold
+    connections. Here every thread's resource wraps the same (thread-safe) client, so keep-alive
+    connections are reused across threads and requests; that reuse, and the pool size
+    (AWS_S3_MAX_POOL_CONNECTIONS), are what this class changes by default. The multipart
+    settings default to boto3's own TransferConfig values and are only exposed for tuning
+    (compare them with ``manage.py bench_storage``).
+    """
+
+    def __init__(self, **settings):
+        super().__init__(**settings)
+
+        self.config = self.config.merge(Config(
+            max_pool_connections=self.max_pool_connections,
+            tcp_keepalive=True,
+        ))
+        self._transfer_config = TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=self.max_concurrency,
+            use_threads=self.use_threads,
+        )
+        self._shared_lock = threading.Lock()
+        self._shared_resource = None
+
+    def get_default_settings(self):
+        defaults = super().get_default_settings()
+        defaults.update({
+            'multipart_threshold': setting('AWS_S3_MULTIPART_THRESHOLD', 8 * MB),
+            'multipart_chunksize': setting('AWS_S3_MULTIPART_CHUNKSIZE', 8 * MB),
+            'max_concurrency': setting('AWS_S3_MAX_CONCURRENCY', 10),
+            'max_pool_connections': setting('AWS_S3_MAX_POOL_CONNECTIONS', 20),
+        })
+        return defaults
+
+    def __getstate__(self):
+        # locks and boto3 resources cannot be pickled; the copy makes its own
+        state = super().__getstate__()
+        state.pop('_shared_lock', None)
+        state.pop('_shared_resource', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._shared_lock = threading.Lock()
+        self._shared_resource = None
+
+    @property
+    def connection(self):
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None:
+            with self._shared_lock:
+                if self._shared_resource is None:
+                    self._shared_resource = self._create_session().resource(
+                        's3',
+                        region_name=self.region_name,
+                        use_ssl=self.use_ssl,
+                        endpoint_url=self.endpoint_url,
+                        config=self.config,
+                        verify=self.verify,
+                    )
+            # resources are not thread-safe, but their clients are: give each thread its own
+            # resource around the shared client
+            shared = self._shared_resource
+            connection = type(shared)(client=shared.meta.client)
+            self._connections.connection = connection
+        return connection
@@ -16,9 +16,9 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 from django.conf import settings
-from django.conf.urls.static import static
 
 from . import views
+from gallery import views as gallery_views
 
 urlpatterns = [
     path('', views.homepage, name="homepage"),
@@ -26,8 +26,9 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('register/', views.register_request, name="register"),
     path('login/', views.login_request, name="login"),
-    path('logout/', views.logout_request, name="logout")
+    path('logout/', views.logout_request, name="logout"),
+    path('p/<str:token>/', gallery_views.public_exhibition, name="public_exhibition"),
 ]
 
-if settings.ENV == settings.ENV_LOCAL:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+if settings.GALLERY_SERVE_MEDIA:
+    urlpatterns.append(path(settings.MEDIA_URL.lstrip('/') + '<path:path>', gallery_views.serve_media, name="media"))
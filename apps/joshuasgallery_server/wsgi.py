@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'joshuasgallery_server.settings')
 
 application = get_wsgi_application()
+
+# With gunicorn --preload this module is imported once in the master, so warm up there and let the
+# forked workers share the result copy-on-write.
+from django.conf import settings  # noqa: E402
+
+if settings.GALLERY_PRELOAD:
+    from .preload import warm_up
+
+    warm_up()
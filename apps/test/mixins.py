@@ -0,0 +1,53 @@
+import shutil
+import tempfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.utils import timezone
+
+from gallery.jobs import work
+from gallery.models import GalleryPiece
+
+
+class Stop:
+    def is_set(self):
+        return False
+
+
+def run_jobs():
+    """Run every queued job that is due, as a worker would, then return."""
+    work("w", Stop(), 0, burst=True)
+
+
+def read_image(name):
+    with open("test/images/" + name, "rb") as fp:
+        return fp.read()
+
+
+class PieceTestMixin:
+    """
+    For TestCases that store pieces: the class gets its own MEDIA_ROOT, removed when it is done,
+    and tests need to set ``self.user`` before calling create_piece.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        media_settings.enable()
+        cls.addClassCleanup(media_settings.disable)
+        super().setUpClass()
+
+    def create_piece(self, name="woody.jpg", data=None, **fields):
+        """Create a piece of the named test image, or of ``data``, and run the jobs it queues."""
+        fields.setdefault("title", "x")
+        fields.setdefault("user", self.user)
+        if data is None:
+            data = read_image(name)
+        with self.captureOnCommitCallbacks(execute=True):
+            piece = GalleryPiece.objects.create(pub_date=timezone.now(), image=SimpleUploadedFile(name, data),
+                                                **fields)
+        run_jobs()
+        piece.refresh_from_db()
+        return piece
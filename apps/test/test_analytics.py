@@ -0,0 +1,141 @@
+import datetime
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from gallery.analytics import ViewCounter, flush_due_views, flush_views, record_view, recent_views
+from gallery.models import DailyViewCount, Exhibition, GalleryPiece
+from gallery.views import exhibition_detail, index
+from test.test_views import middleware
+
+PIECE = DailyViewCount.PIECE
+EXHIBITION = DailyViewCount.EXHIBITION
+
+
+def views_of(kind, object_id):
+    return {c.date: c.views for c in DailyViewCount.objects.filter(kind=kind, object_id=object_id)}
+
+
+class ViewCounterTest(TestCase):
+    def test_flush_upserts_daily_rollups(self):
+        counter = ViewCounter()
+        for _ in range(3):
+            counter.record(PIECE, 1)
+        counter.record(EXHIBITION, 1)
+
+        with self.assertNumQueries(3):
+            # savepoint, one upsert, release
+            self.assertEqual(2, counter.flush())
+
+        counter.record(PIECE, 1)
+        counter.flush()
+
+        today = timezone.localdate()
+        self.assertEqual({today: 4}, views_of(PIECE, 1))
+        self.assertEqual({today: 1}, views_of(EXHIBITION, 1))
+        self.assertEqual(0, counter.flush())
+
+    def test_large_flush_is_batched(self):
+        counter = ViewCounter()
+        for object_id in range(1200):
+            counter.record(PIECE, object_id)
+
+        self.assertEqual(1200, counter.flush())
+        self.assertEqual(1200, DailyViewCount.objects.count())
+
+    def test_failed_flush_keeps_counts(self):
+        counter = ViewCounter()
+        counter.record(PIECE, 1)
+
+        with mock.patch("gallery.analytics.upsert_counts", side_effect=RuntimeError), \
+                self.assertLogs("gallery.analytics", "ERROR"):
+            self.assertEqual(0, counter.flush())
+        counter.record(PIECE, 1)
+        counter.flush()
+
+        self.assertEqual({timezone.localdate(): 2}, views_of(PIECE, 1))
+
+    def test_due(self):
+        counter = ViewCounter()
+        with override_settings(GALLERY_VIEWCOUNT_FLUSH_INTERVAL=3600, GALLERY_VIEWCOUNT_MAX_PENDING=2):
+            self.assertFalse(counter.due())
+            counter.record(PIECE, 1)
+            self.assertFalse(counter.due())
+            counter.record(PIECE, 2)
+            self.assertTrue(counter.due())
+        with override_settings(GALLERY_VIEWCOUNT_FLUSH_INTERVAL=0):
+            self.assertTrue(counter.due())
+
+    def test_recent_views(self):
+        today = timezone.localdate()
+        DailyViewCount.objects.bulk_create([
+            DailyViewCount(kind=PIECE, object_id=1, date=today, views=5),
+            DailyViewCount(kind=PIECE, object_id=1, date=today - datetime.timedelta(days=29), views=2),
+            DailyViewCount(kind=PIECE, object_id=1, date=today - datetime.timedelta(days=30), views=100),
+            DailyViewCount(kind=EXHIBITION, object_id=1, date=today, views=7),
+        ])
+        self.assertEqual({1: 7}, recent_views(PIECE, [1, 2]))
+
+
+class FlushThreadTest(SimpleTestCase):
+    @override_settings(GALLERY_VIEWCOUNT_FLUSH_INTERVAL=3600, GALLERY_VIEWCOUNT_MAX_PENDING=2)
+    def test_flushes_without_requests(self):
+        counter = ViewCounter()
+        flushed = threading.Event()
+
+        with mock.patch("gallery.analytics.upsert_counts", side_effect=lambda counts: flushed.set()):
+            counter.start()
+            counter.start()
+            counter.record(PIECE, 1)
+            counter.record(PIECE, 2)
+            # a full buffer wakes the thread long before the interval is up
+            self.assertTrue(flushed.wait(5))
+
+        self.assertTrue(counter.running)
+
+
+class ViewCountViewsTest(TestCase):
+    def setUp(self):
+        flush_views()
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+
+    def get(self, view, *args):
+        request = self.factory.get("/")
+        request.user = self.user
+        with middleware(request):
+            return view(request, *args)
+
+    def test_detail_views_counted(self):
+        exhib = Exhibition.objects.create(title="Toys", description="d", user=self.user)
+
+        self.get(exhibition_detail, exhib.id)
+        self.get(exhibition_detail, exhib.id)
+        self.get(exhibition_detail, exhib.id + 1)
+        flush_views()
+
+        self.assertEqual({timezone.localdate(): 2}, views_of(EXHIBITION, exhib.id))
+        self.assertEqual({}, views_of(EXHIBITION, exhib.id + 1))
+
+    @override_settings(GALLERY_VIEWCOUNT_FLUSH_INTERVAL=0)
+    def test_flushed_as_next_request_starts(self):
+        record_view(PIECE, 1)
+
+        flush_due_views()
+
+        self.assertEqual({timezone.localdate(): 1}, views_of(PIECE, 1))
+
+    def test_dashboard_reads_rollups(self):
+        piece = GalleryPiece.objects.create(title="Woody", pub_date=timezone.now(), user=self.user)
+        other = GalleryPiece.objects.create(title="Buzz", pub_date=timezone.now(), user=self.user)
+        DailyViewCount.objects.create(kind=PIECE, object_id=piece.id, date=timezone.localdate(), views=3)
+        DailyViewCount.objects.create(kind=PIECE, object_id=other.id, date=timezone.localdate(), views=9)
+
+        response = self.get(index)
+
+        self.assertContains(response, "Woody")
+        content = response.content.decode()
+        self.assertLess(content.index("Buzz"), content.index("Woody"))
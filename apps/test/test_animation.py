@@ -0,0 +1,116 @@
+import io
+from unittest import mock
+
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from gallery.animation import transcode_mp4, transcode_webp
+from gallery.media import media_visible_to
+from gallery.models import GalleryPiece
+from gallery.views import piece_detail
+from test.mixins import PieceTestMixin, read_image, run_jobs
+from test.test_views import middleware
+
+
+def fake_ffmpeg(size):
+    """Stands in for subprocess.run of ffmpeg, writing ``size`` bytes to the output file."""
+    def run(args, **kwargs):
+        with open(args[-1], "wb") as f:
+            f.write(b"\0" * size)
+    return run
+
+
+class TranscodeTest(SimpleTestCase):
+    def test_webp(self):
+        webp = transcode_webp(read_image("dragon.gif"), 75)
+
+        with Image.open(io.BytesIO(webp)) as img:
+            self.assertEqual("WEBP", img.format)
+            self.assertEqual(17, img.n_frames)
+            self.assertEqual((1042, 722), img.size)
+        self.assertLess(len(webp), len(read_image("dragon.gif")))
+
+    def test_still_image(self):
+        out = io.BytesIO()
+        Image.new("RGB", (10, 10)).save(out, "GIF")
+        self.assertIsNone(transcode_webp(out.getvalue(), 75))
+
+    def test_mp4_without_ffmpeg(self):
+        self.assertIsNone(transcode_mp4(read_image("dragon.gif"), "/nonexistent/ffmpeg", 10))
+
+    def test_mp4(self):
+        with mock.patch("gallery.animation.shutil.which", return_value="/usr/bin/ffmpeg"), \
+                mock.patch("gallery.animation.subprocess.run", side_effect=fake_ffmpeg(10)) as run:
+            self.assertEqual(b"\0" * 10, transcode_mp4(read_image("dragon.gif"), "ffmpeg", 10))
+        self.assertEqual("/usr/bin/ffmpeg", run.call_args.args[0][0])
+
+
+@override_settings(GALLERY_ANIMATIONS=True, GALLERY_DEEP_ZOOM=False, GALLERY_PUBLIC_PURGERS=[])
+class AnimationTest(PieceTestMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+
+    def create_piece(self, name="dragon.gif", **fields):
+        return super().create_piece(name, **fields)
+
+    def test_transcoded(self):
+        with mock.patch("gallery.animation.shutil.which", return_value=None):
+            piece = self.create_piece()
+
+        self.assertTrue(piece.animated_webp.name.endswith(".webp"))
+        self.assertFalse(piece.animated_mp4)
+        self.assertTrue(default_storage.exists(piece.animated_webp.name))
+        self.assertTrue(media_visible_to(self.user, piece.animated_webp.name))
+
+    def test_mp4_kept_only_if_smaller(self):
+        with mock.patch("gallery.animation.shutil.which", return_value="/usr/bin/ffmpeg"), \
+                mock.patch("gallery.animation.subprocess.run", side_effect=fake_ffmpeg(1000)):
+            piece = self.create_piece()
+        self.assertTrue(piece.animated_mp4.name.endswith(".mp4"))
+
+        with mock.patch("gallery.animation.shutil.which", return_value="/usr/bin/ffmpeg"), \
+                mock.patch("gallery.animation.subprocess.run", side_effect=fake_ffmpeg(10 ** 7)):
+            piece = self.create_piece()
+        self.assertTrue(piece.animated_webp)
+        self.assertFalse(piece.animated_mp4)
+
+    def test_still_images_not_transcoded(self):
+        piece = self.create_piece("woody.jpg")
+        self.assertFalse(piece.animated_webp)
+
+    def test_replaced_and_deleted(self):
+        with mock.patch("gallery.animation.shutil.which", return_value=None):
+            piece = self.create_piece()
+        webp = piece.animated_webp.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            piece.image = SimpleUploadedFile("woody.jpg", read_image("woody.jpg"))
+            piece.save(update_fields=["image"])
+        run_jobs()
+
+        self.assertFalse(GalleryPiece.objects.get(id=piece.id).animated_webp)
+        self.assertFalse(default_storage.exists(webp))
+
+        with mock.patch("gallery.animation.shutil.which", return_value=None):
+            piece = self.create_piece()
+        webp = piece.animated_webp.name
+        with self.captureOnCommitCallbacks(execute=True):
+            piece.delete()
+        run_jobs()
+        self.assertFalse(default_storage.exists(webp))
+
+    def test_detail_page_offers_smaller_formats(self):
+        with mock.patch("gallery.animation.shutil.which", return_value=None):
+            piece = self.create_piece()
+
+        request = RequestFactory().get("/gallery/pieces/{}/".format(piece.id))
+        request.user = self.user
+        middleware(request)
+        response = piece_detail(request, piece.id)
+
+        self.assertContains(response, '<source srcset="{}" type="image/webp">'.format(piece.animated_webp.url))
+        self.assertContains(response, 'src="{}"'.format(piece.image.url))
+        self.assertNotContains(response, "video/mp4")
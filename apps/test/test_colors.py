@@ -0,0 +1,96 @@
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from gallery.colors import ColorIndex, indexes, parse_color, parse_palette, _encode
+from gallery.processing import _palette
+from gallery.views import pieces_list_view
+from test.mixins import PieceTestMixin
+from test.test_views import middleware
+
+RED = "ff0000"
+BLUE = "0000ff"
+
+
+class PaletteTest(SimpleTestCase):
+    def test_dominant_colors(self):
+        img = Image.new("RGB", (400, 100), (255, 0, 0))
+        img.paste((0, 0, 255), (300, 0, 400, 100))
+
+        entries = parse_palette(_palette(img))
+
+        self.assertEqual((255, 0, 0), entries[0][0])
+        self.assertAlmostEqual(0.75, entries[0][1], delta=0.02)
+        for expected, actual in zip((0, 0, 255), entries[1][0]):
+            self.assertAlmostEqual(expected, actual, delta=5)
+
+    def test_parse_color(self):
+        self.assertEqual((170, 187, 204), parse_color("#aabbcc"))
+        self.assertEqual((170, 187, 204), parse_color("AABBCC"))
+        self.assertIsNone(parse_color("#abc"))
+        self.assertIsNone(parse_color("red"))
+
+
+class ColorIndexTest(SimpleTestCase):
+    def index(self, palettes):
+        encoded = [_encode(p) for p in palettes.values()]
+        return ColorIndex(list(palettes), [b for b, _ in encoded], [s for _, s in encoded])
+
+    def test_search_ranks_by_distance_and_coverage(self):
+        index = self.index({1: BLUE + "ff", 2: BLUE + "e0" + RED + "1f", 3: RED + "c0" + BLUE + "3f",
+                            4: "f00a0a" + "ff", 5: "b4323c" + "ff"})
+
+        # 4 lands in the same bin as pure red and covers more of its piece than 3 does
+        self.assertEqual([4, 3, 2], [piece_id for piece_id, _ in index.search((255, 0, 0), 20)])
+        self.assertEqual([], self.index({}).search((255, 0, 0), 20))
+
+    def test_update(self):
+        index = self.index({1: BLUE + "ff"})
+        index.update(2, RED + "ff")
+        index.update(1, RED + "ff")
+        self.assertEqual([1, 2], sorted(piece_id for piece_id, _ in index.search((255, 0, 0), 5)))
+        index.update(1, "")
+        self.assertEqual(1, len(index))
+
+    def test_update_replaces_arrays(self):
+        index = self.index({1: BLUE + "ff"})
+        ids, bins, shares = index.arrays
+        index.update(1, RED + "ff")
+
+        # a search that already read the old arrays still sees them unchanged
+        self.assertEqual([1], list(ids))
+        self.assertEqual([1], [piece_id for piece_id, _ in index.search((255, 0, 0), 5)])
+        self.assertEqual(1, len(ColorIndex(ids, bins, shares).search((0, 0, 255), 5)))
+
+
+@override_settings(GALLERY_DEEP_ZOOM=False)
+class ColorSearchViewTest(PieceTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+        self.red = self.create_piece(title="Poppies", palette=RED + "c0" + BLUE + "3f")
+        self.blue = self.create_piece(title="Sea", palette=BLUE + "ff")
+
+    def get(self, color):
+        request = self.factory.get("/gallery/pieces/", {"color": color})
+        request.user = self.user
+        with middleware(request):
+            return pieces_list_view(request)
+
+    def test_filter_by_color(self):
+        response = self.get("#ff0000")
+        self.assertContains(response, "Poppies")
+        self.assertNotContains(response, "Sea")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.blue.palette = "fa0505ff"
+            self.blue.save(update_fields=["palette"])
+
+        response = self.get("#ff0000")
+        self.assertContains(response, "Sea")
+        self.assertEqual(2, len(indexes.get(self.user.id)))
+
+    def test_invalid_color(self):
+        self.assertEqual(400, self.get("nope").status_code)
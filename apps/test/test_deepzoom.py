@@ -0,0 +1,147 @@
+import os
+from unittest import mock
+
+from PIL import Image
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template.defaultfilters import escapejs
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from gallery.deepzoom import descriptor_name, max_level, tile_box, tile_name, tile_names, viewer_options
+from gallery.media import media_visible_to
+from gallery.models import GalleryPiece, Job
+from gallery.views import piece_detail, piece_tile
+from test.mixins import PieceTestMixin, read_image, run_jobs
+from test.test_views import middleware
+
+
+class PyramidLayoutTest(SimpleTestCase):
+    def test_levels(self):
+        self.assertEqual(0, max_level(1, 1))
+        self.assertEqual(11, max_level(1500, 1000))
+        self.assertEqual(11, max_level(2048, 10))
+
+    def test_tile_box(self):
+        self.assertEqual((0, 0, 255, 255), tile_box(1000, 600, 0, 0))
+        self.assertEqual((253, 507, 509, 600), tile_box(1000, 600, 1, 2))
+
+    def test_tile_names(self):
+        names = list(tile_names("piece-images/a.jpg", 600, 300))
+        # 3x2 tiles at full size, 2x1 at half size, then a single tile for each of levels 8 to 0
+        self.assertEqual(6 + 2 + 9, len(names))
+        self.assertEqual("deepzoom/piece-images/a_files/10/0_0.jpg", names[0])
+        self.assertEqual("deepzoom/piece-images/a_files/0/0_0.jpg", names[-1])
+
+
+@override_settings(GALLERY_DEEP_ZOOM=True, GALLERY_DEEP_ZOOM_MIN_EDGE=1000, GALLERY_PUBLIC_PURGERS=[])
+class DeepZoomTest(PieceTestMixin, TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+
+    def test_build(self):
+        piece = self.create_piece()  # 1500x1500
+
+        self.assertEqual((1500, 1500), (piece.deep_zoom_width, piece.deep_zoom_height))
+        with default_storage.open(descriptor_name(piece.image.name)) as f:
+            self.assertIn(b'<Size Width="1500" Height="1500"/>', f.read())
+        for name in tile_names(piece.image.name, 1500, 1500):
+            self.assertTrue(default_storage.exists(name), name)
+
+        with default_storage.open(tile_name(piece.image.name, 11, 5, 5)) as f:
+            self.assertEqual((1500 - 5 * 254 + 1, 1500 - 5 * 254 + 1), Image.open(f).size)
+        with default_storage.open(tile_name(piece.image.name, 0, 0, 0)) as f:
+            self.assertEqual((1, 1), Image.open(f).size)
+
+    @override_settings(GALLERY_DEEP_ZOOM_MIN_EDGE=2000)
+    def test_small_image_skipped(self):
+        piece = self.create_piece()
+
+        self.assertIsNone(piece.deep_zoom_width)
+        self.assertFalse(default_storage.exists(descriptor_name(piece.image.name)))
+
+    def test_replaced_and_deleted(self):
+        piece = self.create_piece()
+        old = piece.image.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            piece.image = SimpleUploadedFile("scream.jpg", read_image("scream.jpg"))
+            piece.save(update_fields=["image"])
+        self.assertIsNone(GalleryPiece.objects.get(id=piece.id).deep_zoom_width)
+        run_jobs()
+
+        piece.refresh_from_db()
+        self.assertEqual((2000, 2000), (piece.deep_zoom_width, piece.deep_zoom_height))
+        self.assertFalse(default_storage.exists(descriptor_name(old)))
+        self.assertFalse(default_storage.exists(tile_name(old, 0, 0, 0)))
+
+        new = piece.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            piece.delete()
+        run_jobs()
+        self.assertFalse(default_storage.exists(descriptor_name(new)))
+        self.assertFalse(default_storage.exists(tile_name(new, 11, 0, 0)))
+        self.assertFalse(Job.objects.exclude(status=Job.DONE).exists())
+
+    def test_viewer_and_tiles(self):
+        piece = self.create_piece()
+
+        request = self.factory.get("/gallery/pieces/{}/".format(piece.id))
+        request.user = self.user
+        middleware(request)
+        response = piece_detail(request, piece.id)
+        self.assertContains(response, "deep-zoom-viewer")
+        # tiles are fetched straight from the media URLs
+        self.assertContains(response, '"{}" + level'.format(
+            escapejs(default_storage.url(tile_name(piece.image.name, 0, 0, 0)).rpartition("0/")[0])))
+        self.assertNotContains(response, "/tiles/")
+
+        request = self.factory.get("/gallery/pieces/{}/tiles/11/0_0.jpg".format(piece.id))
+        request.user = self.user
+        response = piece_tile(request, piece.id, 11, 0, 0)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(default_storage.url(tile_name(piece.image.name, 11, 0, 0)), response.url)
+
+        other = User.objects.create_user(username="other", password="top_secret")
+        request.user = other
+        self.assertEqual(404, piece_tile(request, piece.id, 11, 0, 0).status_code)
+        request.user = AnonymousUser()
+        self.assertEqual(401, piece_tile(request, piece.id, 11, 0, 0).status_code)
+
+    @override_settings(GALLERY_MEDIA_URL_MODE="cdn", GALLERY_MEDIA_CDN_URL="https://cdn.example.com")
+    def test_cdn_tile_url(self):
+        piece = self.create_piece()
+
+        self.assertEqual("https://cdn.example.com/deepzoom/{}_files/".format(os.path.splitext(piece.image.name)[0]),
+                         viewer_options(piece)["tile_url"])
+
+    def test_tile_view_without_tile_url(self):
+        piece = self.create_piece()
+
+        with mock.patch("gallery.deepzoom.get_resolver") as get_resolver:
+            get_resolver.return_value.resolve_prefix.return_value = None
+            request = self.factory.get("/gallery/pieces/{}/".format(piece.id))
+            request.user = self.user
+            middleware(request)
+            self.assertContains(piece_detail(request, piece.id),
+                                '"/gallery/pieces/{}/tiles/" + level'.format(piece.id))
+
+    def test_tiles_visible_to_owner_only(self):
+        piece = self.create_piece()
+        tile = tile_name(piece.image.name, 11, 0, 0)
+        other = User.objects.create_user(username="other", password="top_secret")
+
+        self.assertTrue(media_visible_to(self.user, tile))
+        self.assertTrue(media_visible_to(self.user, descriptor_name(piece.image.name)))
+        self.assertFalse(media_visible_to(other, tile))
+
+    @override_settings(GALLERY_DEEP_ZOOM_MIN_EDGE=2000)
+    def test_no_viewer_without_pyramid(self):
+        piece = self.create_piece()
+
+        request = self.factory.get("/gallery/pieces/{}/".format(piece.id))
+        request.user = self.user
+        middleware(request)
+        self.assertNotContains(piece_detail(request, piece.id), "deep-zoom-viewer")
+        self.assertEqual(404, piece_tile(request, piece.id, 0, 0, 0).status_code)
@@ -0,0 +1,109 @@
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+from django.core.files.storage import FileSystemStorage
+from django.test import RequestFactory, TestCase, override_settings
+from django.contrib.auth.models import AnonymousUser, User
+
+from gallery.export import stream_user_archive, iter_storage_chunks, _Prefetcher
+from gallery.views import export_gallery, new_gallery_piece
+from gallery.models import GalleryPiece, Exhibition
+from test.test_views import middleware
+
+MEDIA_ROOT = tempfile.mktemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class GalleryExportTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        self.anonUser = AnonymousUser()
+
+        for name in ["woody.jpg", "scream.jpg"]:
+            with open("test/images/" + name, "rb") as fp:
+                test_post_data = {'placeholder': "PLACEHOLDER",
+                                  'pieceTitle': name,
+                                  'pieceDescription': "desc",
+                                  'pieceImage': fp}
+                request = self.factory.post("/gallery/pieces/new", test_post_data)
+                request.user = self.user
+
+                with middleware(request):
+                    new_gallery_piece(request)
+
+        self.exhib = Exhibition.objects.create(title="Show", description="", user=self.user)
+        self.piece = GalleryPiece.objects.get(title="woody.jpg")
+        self.piece.galleries.add(self.exhib)
+
+    def test_export_archive(self):
+        request = self.factory.get("/gallery/export")
+        request.user = self.user
+
+        response = export_gallery(request)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/zip", response["Content-Type"])
+
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        manifest = json.loads(archive.read("manifest.json"))
+
+        self.assertEqual(2, len(manifest["pieces"]))
+        self.assertEqual([{"id": self.exhib.id, "title": "Show", "description": ""}],
+                         manifest["exhibitions"])
+        self.assertEqual([{"piece": self.piece.id, "exhibition": self.exhib.id}],
+                         manifest["memberships"])
+
+        for p in manifest["pieces"]:
+            piece = GalleryPiece.objects.get(id=p["id"])
+            with piece.image.open("rb") as f:
+                self.assertEqual(f.read(), archive.read(p["image"]))
+
+    def test_export_small_chunks(self):
+        archive_bytes = b"".join(stream_user_archive(self.user, chunk_size=4096, prefetch=2, depth=1))
+        archive = zipfile.ZipFile(io.BytesIO(archive_bytes))
+
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(3, len(archive.namelist()))
+
+    def test_iter_storage_chunks(self):
+        storage = FileSystemStorage(location=MEDIA_ROOT)
+        chunks = list(iter_storage_chunks(storage, self.piece.image.name, chunk_size=1000))
+
+        self.assertTrue(all(len(c) == 1000 for c in chunks[:-1]))
+        self.assertEqual(self.piece.image.size, sum(len(c) for c in chunks))
+
+    def test_abandoned_prefetch_releases_readers(self):
+        storage = FileSystemStorage(location=MEDIA_ROOT)
+        # one chunk fills the queue, so the reader is left waiting to queue the end marker
+        prefetcher = _Prefetcher(storage, [self.piece.image.name], self.piece.image.size, prefetch=1, depth=1)
+        prefetcher._fill()
+        q = prefetcher.pending[0][1]
+        while not q.full():
+            time.sleep(0.01)
+        prefetcher.close()
+
+        shutdown = threading.Thread(target=prefetcher.executor.shutdown)
+        shutdown.start()
+        shutdown.join(timeout=5)
+        self.assertFalse(shutdown.is_alive())
+
+    def test_export_anonymous_user(self):
+        request = self.factory.get("/gallery/export")
+        request.user = self.anonUser
+
+        response = export_gallery(request)
+
+        self.assertEqual(401, response.status_code)
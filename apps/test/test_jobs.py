@@ -0,0 +1,199 @@
+import datetime
+import io
+import time
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from gallery.jobs import claim, enqueue, prune, requeue_stale, run_job, task, work
+from gallery.models import Job
+
+CALLS = []
+
+
+@task
+def record(value, suffix=""):
+    CALLS.append(value + suffix)
+
+
+@task(priority=5)
+def urgent(value):
+    CALLS.append(value)
+
+
+@task(max_attempts=2)
+def broken():
+    raise RuntimeError("boom")
+
+
+@task
+def slow(seconds):
+    time.sleep(seconds)
+
+
+class Stop:
+    def is_set(self):
+        return False
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        CALLS.clear()
+
+    def test_run(self):
+        job = enqueue(record, "a", suffix="!")
+
+        self.assertEqual(Job.QUEUED, job.status)
+        claimed = claim("w1")
+        self.assertEqual((job.id, Job.RUNNING, "w1", 1), (claimed.id, claimed.status, claimed.locked_by, claimed.attempts))
+        self.assertIsNone(claim("w2"))
+
+        self.assertTrue(run_job(claimed))
+        self.assertEqual(["a!"], CALLS)
+        self.assertEqual(Job.DONE, Job.objects.get(id=job.id).status)
+
+    def test_priority_and_schedule(self):
+        enqueue(record, "later", delay=60)
+        enqueue(record, "first")
+        enqueue(record, "second")
+        enqueue(urgent, "urgent")
+
+        work("w", Stop(), 0, burst=True)
+
+        self.assertEqual(["urgent", "first", "second"], CALLS)
+        self.assertEqual(1, Job.objects.filter(status=Job.QUEUED).count())
+
+    def test_dedupe(self):
+        job = enqueue(record, "a", dedupe_key="k")
+        self.assertEqual(job, enqueue(record, "b", dedupe_key="k"))
+        self.assertEqual(1, Job.objects.count())
+
+        claim("w")
+        # a running job no longer holds the key: what changes while it runs needs another run
+        self.assertIsNone(Job.objects.get(id=job.id).dedupe_key)
+        self.assertNotEqual(job, enqueue(record, "c", dedupe_key="k"))
+
+    def test_dedupe_key_taken_twice(self):
+        save = Job.save
+        conflicts = []
+
+        def conflicting_save(job, *args, **kwargs):
+            # another job takes the key, and is claimed before it can be returned, twice over
+            if len(conflicts) < 2:
+                conflicts.append(job)
+                raise IntegrityError("UNIQUE constraint failed: gallery_job.dedupe_key")
+            return save(job, *args, **kwargs)
+
+        with mock.patch.object(Job, "save", conflicting_save):
+            job = enqueue(record, "a", dedupe_key="k")
+
+        self.assertEqual(2, len(conflicts))
+        self.assertEqual("k", Job.objects.get(id=job.id).dedupe_key)
+
+    def test_requeued_job_outcome_left_to_new_attempt(self):
+        enqueue(record, "a")
+        first = claim("w1")
+        # the lease ran out and another worker took the job
+        Job.objects.filter(id=first.id).update(status=Job.QUEUED)
+        second = claim("w2")
+
+        self.assertTrue(run_job(first))
+        self.assertEqual((Job.RUNNING, "w2"), Job.objects.values_list("status", "locked_by").get(id=first.id))
+        self.assertTrue(run_job(second))
+        self.assertEqual(Job.DONE, Job.objects.get(id=first.id).status)
+
+    def test_retry_with_backoff(self):
+        job = enqueue(broken)
+
+        with self.assertLogs("gallery.jobs", "WARNING"):
+            self.assertFalse(run_job(claim("w")))
+        job.refresh_from_db()
+        self.assertEqual(Job.QUEUED, job.status)
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_at, timezone.now() + datetime.timedelta(seconds=5))
+
+        Job.objects.filter(id=job.id).update(run_at=timezone.now())
+        with self.assertLogs("gallery.jobs", "WARNING"):
+            run_job(claim("w"))
+        job.refresh_from_db()
+        self.assertEqual((Job.FAILED, 2), (job.status, job.attempts))
+
+    def test_retry_takes_back_dedupe_key(self):
+        job = enqueue(broken, dedupe_key="k")
+
+        with self.assertLogs("gallery.jobs", "WARNING"):
+            run_job(claim("w"))
+
+        self.assertEqual((Job.QUEUED, "k"), Job.objects.values_list("status", "dedupe_key").get(id=job.id))
+        self.assertEqual(job, enqueue(broken, dedupe_key="k"))
+
+    def test_retry_superseded_by_newer_job(self):
+        job = enqueue(broken, dedupe_key="k")
+        claimed = claim("w")
+        newer = enqueue(broken, dedupe_key="k")
+
+        with self.assertLogs("gallery.jobs", "WARNING"):
+            run_job(claimed)
+
+        job.refresh_from_db()
+        self.assertEqual((Job.FAILED, None), (job.status, job.dedupe_key))
+        self.assertIn("Not retried", job.last_error)
+        self.assertEqual("k", Job.objects.get(id=newer.id).dedupe_key)
+
+    def test_unknown_task_not_retried(self):
+        job = Job.objects.create(task="os.system", args=["true"], run_at=timezone.now())
+
+        with self.assertLogs("gallery.jobs", "WARNING"):
+            run_job(claim("w"))
+        self.assertEqual(Job.FAILED, Job.objects.get(id=job.id).status)
+
+    @override_settings(GALLERY_JOB_TIMEOUT=60, GALLERY_JOB_RETENTION=7)
+    def test_maintenance(self):
+        long_ago = timezone.now() - datetime.timedelta(days=30)
+        stale = enqueue(record, "a")
+        claim("w")
+        Job.objects.filter(id=stale.id).update(locked_at=long_ago)
+        done = enqueue(record, "b")
+        Job.objects.filter(id=done.id).update(status=Job.DONE, finished_at=long_ago)
+
+        self.assertEqual(1, requeue_stale())
+        self.assertEqual(Job.QUEUED, Job.objects.get(id=stale.id).status)
+        self.assertEqual(1, prune())
+        self.assertFalse(Job.objects.filter(id=done.id).exists())
+
+    @override_settings(GALLERY_JOB_TIMEOUT=60)
+    def test_stale_job_takes_back_dedupe_key(self):
+        stale = enqueue(record, "a", dedupe_key="k")
+        claim("w")
+        Job.objects.filter(id=stale.id).update(locked_at=timezone.now() - datetime.timedelta(days=1))
+
+        self.assertEqual(1, requeue_stale())
+        self.assertEqual((Job.QUEUED, "k"), Job.objects.values_list("status", "dedupe_key").get(id=stale.id))
+
+
+class RunWorkerTest(TransactionTestCase):
+    def setUp(self):
+        CALLS.clear()
+
+    @override_settings(GALLERY_JOB_HEARTBEAT=0.05, GALLERY_JOB_TIMEOUT=0.2)
+    def test_heartbeat_keeps_long_job(self):
+        enqueue(slow, 0.5)
+        job = claim("w")
+
+        self.assertTrue(run_job(job))
+        renewed = Job.objects.get(id=job.id)
+        self.assertEqual(Job.DONE, renewed.status)
+        self.assertGreater(renewed.locked_at, job.locked_at + datetime.timedelta(seconds=0.3))
+
+    def test_runworker_burst(self):
+        for value in "abcde":
+            enqueue(record, value)
+
+        with mock.patch("gallery.management.commands.runworker.MAINTENANCE_INTERVAL", 0.1):
+            call_command("runworker", "--burst", "--concurrency", "2", stdout=io.StringIO())
+
+        self.assertEqual(list("abcde"), sorted(CALLS))
+        self.assertEqual(5, Job.objects.filter(status=Job.DONE).count())
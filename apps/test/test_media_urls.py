@@ -0,0 +1,69 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from gallery.media_urls import MediaURLResolver, MODE_CDN, MODE_SIGNED, MODE_STORAGE
+
+
+class FakeS3Storage:
+    bucket_name = "bucket-jg-test"
+
+    def __init__(self):
+        self.bucket = mock.Mock()
+        self.bucket.meta.client.generate_presigned_url.side_effect = \
+            lambda op, Params, ExpiresIn: "https://s3/{}?sig={}".format(Params["Key"], ExpiresIn)
+        self.url = mock.Mock(side_effect=lambda n: "/media/" + n)
+
+    def _normalize_name(self, name):
+        return name
+
+
+class MediaURLResolverTest(SimpleTestCase):
+    def setUp(self):
+        self.storage = FakeS3Storage()
+        self.names = ["piece-images/a.jpg", "piece-images/b c.jpg", "piece-images/a.jpg"]
+
+    def test_cdn_mode_does_not_sign(self):
+        resolver = MediaURLResolver(self.storage, MODE_CDN, cdn_url="https://cdn.example.com/")
+
+        urls = resolver.resolve(self.names)
+
+        self.assertEqual({"piece-images/a.jpg": "https://cdn.example.com/piece-images/a.jpg",
+                          "piece-images/b c.jpg": "https://cdn.example.com/piece-images/b%20c.jpg"}, urls)
+        self.storage.bucket.meta.client.generate_presigned_url.assert_not_called()
+        self.storage.url.assert_not_called()
+
+    def test_storage_mode(self):
+        resolver = MediaURLResolver(self.storage, MODE_STORAGE)
+
+        urls = resolver.resolve(self.names)
+
+        self.assertEqual("/media/piece-images/a.jpg", urls["piece-images/a.jpg"])
+        self.assertEqual(2, self.storage.url.call_count)
+
+    def test_resolve_prefix(self):
+        self.assertEqual("https://cdn.example.com/deepzoom/a%20b_files/",
+                         MediaURLResolver(self.storage, MODE_CDN, cdn_url="https://cdn.example.com")
+                         .resolve_prefix("deepzoom/a b_files/"))
+        self.assertEqual("/media/deepzoom/a_files/",
+                         MediaURLResolver(self.storage, MODE_STORAGE).resolve_prefix("deepzoom/a_files/"))
+        self.assertIsNone(MediaURLResolver(self.storage, MODE_SIGNED).resolve_prefix("deepzoom/a_files/"))
+
+        self.storage.querystring_auth = True
+        self.assertIsNone(MediaURLResolver(self.storage, MODE_STORAGE).resolve_prefix("deepzoom/a_files/"))
+
+    def test_signed_urls_cached_until_near_expiry(self):
+        resolver = MediaURLResolver(self.storage, MODE_SIGNED, expire=3600, margin=300)
+        sign = self.storage.bucket.meta.client.generate_presigned_url
+
+        with mock.patch("gallery.media_urls.time.monotonic", return_value=1000):
+            first = resolver.resolve(self.names)
+        self.assertEqual(2, sign.call_count)
+
+        with mock.patch("gallery.media_urls.time.monotonic", return_value=1000 + 3299):
+            self.assertEqual(first, resolver.resolve(self.names))
+        self.assertEqual(2, sign.call_count)
+
+        with mock.patch("gallery.media_urls.time.monotonic", return_value=1000 + 3301):
+            resolver.resolve(self.names)
+        self.assertEqual(4, sign.call_count)
@@ -0,0 +1,186 @@
+import base64
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from pilkit.processors import ResizeToFill
+
+from gallery.models import GalleryPiece
+from gallery.processing import optimize_image, describe_image, get_executor, run_in_pool, PoolError, \
+    PLACEHOLDER_EDGE
+from gallery.processors import Draft, FastResizeToFill, Reduce
+
+MEDIA_ROOT = tempfile.mktemp()
+
+
+def make_jpeg(size, orientation=None):
+    img = Image.new("RGB", size, (200, 10, 10))
+    exif = Image.Exif()
+    exif[0x010F] = "PhoneMaker"
+    if orientation is not None:
+        exif[0x0112] = orientation
+    out = io.BytesIO()
+    img.save(out, "JPEG", exif=exif.tobytes())
+    return out.getvalue()
+
+
+class OptimizeImageTest(SimpleTestCase):
+    def test_caps_longest_edge(self):
+        result = optimize_image(make_jpeg((4000, 1000)), 1000, "JPEG", 85)
+
+        with Image.open(io.BytesIO(result["data"])) as img:
+            self.assertEqual((1000, 250), img.size)
+
+    def test_small_image_not_upscaled(self):
+        result = optimize_image(make_jpeg((300, 200)), 1000, "JPEG", 85)
+
+        with Image.open(io.BytesIO(result["data"])) as img:
+            self.assertEqual((300, 200), img.size)
+
+    def test_auto_orients_and_strips_metadata(self):
+        # orientation 6 means the camera was rotated 90 degrees clockwise
+        result = optimize_image(make_jpeg((400, 100), orientation=6), 1000, "JPEG", 85)
+
+        with Image.open(io.BytesIO(result["data"])) as img:
+            self.assertEqual((100, 400), img.size)
+            self.assertEqual(0, len(img.getexif()))
+            self.assertTrue(img.info.get("progressive"))
+
+    def test_webp(self):
+        result = optimize_image(make_jpeg((400, 100)), 1000, "WEBP", 80)
+
+        with Image.open(io.BytesIO(result["data"])) as img:
+            self.assertEqual("WEBP", img.format)
+
+    def test_transparent_png_to_jpeg(self):
+        img = Image.new("RGBA", (50, 50), (0, 0, 0, 0))
+        out = io.BytesIO()
+        img.save(out, "PNG")
+
+        result = optimize_image(out.getvalue(), 1000, "JPEG", 85)
+
+        with Image.open(io.BytesIO(result["data"])) as img:
+            self.assertEqual("RGB", img.mode)
+            self.assertEqual((255, 255, 255), img.getpixel((0, 0)))
+
+    def test_placeholder_and_dimensions(self):
+        result = optimize_image(make_jpeg((4000, 1000)), 1000, "JPEG", 85)
+
+        self.assertEqual((1000, 250), (result["width"], result["height"]))
+        self.assertTrue(result["placeholder"].startswith("data:image/jpeg;base64,"))
+        self.assertLess(len(result["placeholder"]), 1000)
+
+    def test_describe_existing_image(self):
+        result = describe_image(make_jpeg((400, 100), orientation=6))
+
+        self.assertEqual((100, 400), (result["width"], result["height"]))
+
+        img = Image.open(io.BytesIO(base64.b64decode(result["placeholder"].split(",", 1)[1])))
+        self.assertEqual(PLACEHOLDER_EDGE, max(img.size))
+
+    def test_fingerprint(self):
+        data = make_jpeg((40, 10))
+        result = optimize_image(data, 1000, "JPEG", 85)
+
+        self.assertEqual(len(data), result["image_size"])
+        self.assertEqual("JPEG", result["image_format"])
+        self.assertEqual(hashlib.sha256(data).hexdigest(), result["image_hash"])
+
+
+@override_settings(GALLERY_IMAGE_WORKERS=1)
+class RunInPoolTest(SimpleTestCase):
+    def test_broken_pool_replaced(self):
+        executor = get_executor()
+        # the worker exits without a result, breaking the pool
+        with self.assertLogs("gallery.processing", "ERROR"):
+            self.assertRaises(PoolError, run_in_pool, os._exit, 1)
+
+        self.assertIsNot(executor, get_executor())
+        self.assertEqual(1, run_in_pool(abs, -1))
+
+    def test_timed_out_pool_replaced(self):
+        executor = get_executor()
+        with override_settings(GALLERY_IMAGE_TIMEOUT=0.5), self.assertLogs("gallery.processing", "WARNING"):
+            self.assertRaises(PoolError, run_in_pool, time.sleep, 5)
+
+        self.assertIsNot(executor, get_executor())
+        self.assertEqual(1, run_in_pool(abs, -1))
+
+    def test_decode_errors_passed_through(self):
+        self.assertRaises(OSError, run_in_pool, describe_image, b"not an image")
+
+
+class ProcessorsTest(SimpleTestCase):
+    def test_draft_decodes_jpeg_at_reduced_scale(self):
+        with Image.open("test/images/scream.jpg") as img:  # 2000x2000
+            self.assertEqual((250, 250), Draft(100, 50).process(img).size)
+
+    def test_reduce(self):
+        img = Image.new("RGB", (1000, 1000))
+        self.assertEqual((200, 200), Reduce(100, 50).process(img).size)
+        self.assertEqual((150, 150), Reduce(100, 50).process(Image.new("RGB", (150, 150))).size)
+
+    def test_reduce_palette_image(self):
+        with Image.open("test/images/dragon.gif") as img:  # 1042x722
+            reduced = Reduce(100, 50).process(img)
+        self.assertEqual("RGBA", reduced.mode)
+        self.assertEqual((209, 145), reduced.size)
+
+    def test_fast_resize_matches_stock(self):
+        for name in ("scream.jpg", "woody.jpg", "dragon.gif"):
+            with Image.open("test/images/" + name) as img:
+                stock = ResizeToFill(100, 50).process(img).convert("RGB")
+            with Image.open("test/images/" + name) as img:
+                fast = FastResizeToFill(100, 50).process(img).convert("RGB")
+
+            self.assertEqual((100, 50), fast.size)
+            diff = sum(abs(a - b) for p, q in zip(stock.getdata(), fast.getdata()) for a, b in zip(p, q))
+            self.assertLess(diff / (100 * 50 * 3), 12, name)
+
+    def test_bench_thumbnails(self):
+        images = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, images, ignore_errors=True)
+        with open(os.path.join(images, "red.jpg"), "wb") as f:
+            f.write(make_jpeg((800, 600)))
+
+        out = io.StringIO()
+        call_command("bench_thumbnails", images=images, iterations=1, upscale=2, stdout=out)
+
+        self.assertIn("1600x1200", out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, GALLERY_IMAGE_WORKERS=0)
+class BackfillImageMetadataTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_backfill(self):
+        user = User.objects.create_user(username="jacob", password="top_secret")
+        data = make_jpeg((400, 100), orientation=6)
+        pieces = [GalleryPiece.objects.create(title=str(i), pub_date=timezone.now(), user=user,
+                                              image=SimpleUploadedFile("p.jpg", data))
+                  for i in range(5)]
+
+        call_command("backfill_image_metadata", workers=2, stdout=io.StringIO())
+
+        for piece in pieces:
+            piece.refresh_from_db()
+            self.assertEqual((100, 400), (piece.width, piece.height))
+            self.assertEqual(len(data), piece.image_size)
+            self.assertEqual("JPEG", piece.image_format)
+            self.assertEqual(hashlib.sha256(data).hexdigest(), piece.image_hash)
+            self.assertTrue(piece.placeholder)
+            self.assertIsNotNone(piece.perceptual_hash)
+            self.assertTrue(piece.palette)
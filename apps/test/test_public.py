@@ -0,0 +1,135 @@
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, TestCase, override_settings
+from django.utils import timezone
+
+from gallery.models import GalleryPiece, Exhibition, Job
+from gallery.public import get_purgers, exhibition_key, piece_key
+from test.mixins import run_jobs
+
+MEDIA_ROOT = tempfile.mktemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, GALLERY_VIEWCOUNT_FLUSH_INTERVAL=3600,
+                   GALLERY_PUBLIC_PURGERS=['gallery.public.CachePurger', 'gallery.public.LocalPurger'])
+class PublicExhibitionTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+        with open("test/images/woody.jpg", "rb") as fp:
+            self.piece = GalleryPiece.objects.create(title="Woody", pub_date=timezone.now(), user=self.user,
+                                                     image=SimpleUploadedFile("woody.jpg", fp.read()))
+        self.exhib = Exhibition.objects.create(title="Toys", description="d", user=self.user,
+                                               public_token="tok1")
+        self.other = Exhibition.objects.create(title="Other", description="d", user=self.user,
+                                               public_token="tok2")
+        self.piece.galleries.add(self.exhib)
+        self.local_purger = get_purgers()[1]
+
+    def test_publish(self):
+        private = Exhibition.objects.create(title="Private", description="d", user=self.user)
+        self.client.force_login(self.user)
+
+        self.client.post("/gallery/exhibitions/{}/publish/".format(private.id))
+        private.refresh_from_db()
+        self.assertTrue(private.public_token)
+        self.assertEqual(200, Client().get("/p/{}/".format(private.public_token)).status_code)
+
+        self.client.post("/gallery/exhibitions/{}/publish/".format(private.id))
+        private.refresh_from_db()
+        self.assertIsNone(private.public_token)
+
+    def test_private_exhibition_not_found(self):
+        self.assertEqual(404, self.client.get("/p/nope/").status_code)
+
+    def test_public_page_cached(self):
+        response = self.client.get("/p/tok1/")
+
+        self.assertContains(response, "Toys")
+        self.assertContains(response, "Woody")
+        self.assertEqual("exhibition-{} piece-{}".format(self.exhib.id, self.piece.id), response["Surrogate-Key"])
+        self.assertNotIn("sessionid", response.cookies)
+
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get("/p/tok1/"), "Toys")
+
+    def test_edit_purges_only_affected_pages(self):
+        self.client.get("/p/tok1/")
+        self.client.get("/p/tok2/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exhib.title = "Renamed"
+            self.exhib.save(update_fields=["title"])
+
+        self.assertIn([exhibition_key(self.exhib.id)], self.local_purger.purged)
+        self.assertContains(self.client.get("/p/tok1/"), "Renamed")
+        with self.assertNumQueries(0):
+            self.client.get("/p/tok2/")
+
+    def test_piece_edit_purges(self):
+        self.client.get("/p/tok1/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.piece.title = "Buzz"
+            self.piece.save(update_fields=["title"])
+
+        self.assertIn([piece_key(self.piece.id)], self.local_purger.purged)
+        self.assertContains(self.client.get("/p/tok1/"), "Buzz")
+
+    def test_membership_change_purges(self):
+        self.client.get("/p/tok2/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.piece.galleries.add(self.other)
+
+        self.assertIn([exhibition_key(self.other.id)], self.local_purger.purged)
+        self.assertContains(self.client.get("/p/tok2/"), "Woody")
+
+    @override_settings(GALLERY_PUBLIC_PURGERS=['gallery.public.FastlyPurger'])
+    def test_fastly_purged_in_background(self):
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.read.return_value = json.dumps({"status": "ok"}).encode()
+        with mock.patch("gallery.public.urllib.request.urlopen", return_value=response) as urlopen:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.exhib.title = "Renamed"
+                self.exhib.save(update_fields=["title"])
+            urlopen.assert_not_called()
+            self.assertTrue(Job.objects.filter(task="gallery.public.purge_fastly").exists())
+
+            run_jobs()
+
+        request = urlopen.call_args.args[0]
+        self.assertEqual(exhibition_key(self.exhib.id), request.get_header("Surrogate-key"))
+        self.assertFalse(Job.objects.exclude(status=Job.DONE).exists())
+
+    def test_failed_purge_logged(self):
+        with mock.patch.object(type(get_purgers()[0]), "purge", side_effect=OSError("down")), \
+                self.assertLogs("gallery.public", "ERROR"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.exhib.title = "Renamed"
+                self.exhib.save(update_fields=["title"])
+        # the purgers after the failing one still run
+        self.assertIn([exhibition_key(self.exhib.id)], self.local_purger.purged)
+
+    def test_public_media(self):
+        response = self.client.get("/media/" + self.piece.image.name)
+        self.assertEqual(200, response.status_code)
+        response.close()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.piece.galleries.clear()
+
+        self.assertEqual(401, self.client.get("/media/" + self.piece.image.name).status_code)
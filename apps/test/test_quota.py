@@ -0,0 +1,94 @@
+import io
+import os
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+
+from gallery.models import GalleryPiece, StorageQuota
+from gallery.quota import QuotaExceeded, QUOTA_EXCEEDED_MSG, charge
+from gallery.views import new_gallery_piece
+from test.mixins import PieceTestMixin
+from test.test_views import middleware
+
+
+def used_bytes(user):
+    return StorageQuota.objects.get(user=user).used_bytes
+
+
+# the uploads are not real images, so nothing that decodes them may run
+@override_settings(GALLERY_QUOTA_BYTES=1000, GALLERY_DEEP_ZOOM=False)
+class StorageQuotaTest(PieceTestMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+
+    def create_piece(self, size):
+        return super().create_piece("p.jpg", b"x" * size, image_size=size)
+
+    def test_create_edit_delete(self):
+        piece = self.create_piece(300)
+        self.create_piece(200)
+        self.assertEqual(500, used_bytes(self.user))
+
+        piece.image = SimpleUploadedFile("q.jpg", b"x" * 100)
+        piece.image_size = 100
+        piece.save(update_fields=["image", "image_size"])
+        self.assertEqual(300, used_bytes(self.user))
+
+        # title-only edits don't touch the quota
+        piece.title = "y"
+        piece.save(update_fields=["title"])
+        self.assertEqual(300, used_bytes(self.user))
+
+        GalleryPiece.objects.filter(id=piece.id).delete()
+        self.assertEqual(200, used_bytes(self.user))
+
+    def test_over_quota_not_stored(self):
+        self.create_piece(900)
+        stored = os.listdir(os.path.join(self.media_root, "piece-images"))
+
+        with self.assertRaises(QuotaExceeded):
+            self.create_piece(200)
+
+        self.assertEqual(900, used_bytes(self.user))
+        self.assertEqual(1, GalleryPiece.objects.count())
+        self.assertEqual(stored, os.listdir(os.path.join(self.media_root, "piece-images")))
+
+    def test_per_user_limit(self):
+        StorageQuota.objects.create(user=self.user, limit_bytes=5000)
+
+        self.create_piece(2000)
+
+        self.assertEqual(2000, used_bytes(self.user))
+
+    def test_unenforced_charge(self):
+        charge(self.user.id, 5000, enforce=False)
+
+        self.assertEqual(5000, used_bytes(self.user))
+
+    def test_new_piece_over_quota(self):
+        self.create_piece(900)
+
+        with open("test/images/woody.jpg", "rb") as fp:
+            request = RequestFactory().post("/gallery/pieces/new", {'pieceTitle': "title",
+                                                                    'pieceDescription': "desc",
+                                                                    'pieceImage': fp})
+        request.user = self.user
+
+        with middleware(request):
+            response = new_gallery_piece(request)
+
+        self.assertContains(response, QUOTA_EXCEEDED_MSG)
+        self.assertEqual(1, GalleryPiece.objects.count())
+
+    def test_reconcile(self):
+        other = User.objects.create_user(username="bob", password="top_secret")
+        self.create_piece(300)
+        self.create_piece(200)
+        StorageQuota.objects.filter(user=self.user).update(used_bytes=12345)
+
+        call_command("reconcile_quotas", workers=1, batch_size=1, stdout=io.StringIO())
+
+        self.assertEqual(500, used_bytes(self.user))
+        self.assertEqual(0, used_bytes(other))
@@ -0,0 +1,135 @@
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from gallery.ratelimit import rate_limited, get_store, parse_rate, LocalMemoryStore, CacheStore
+
+RATELIMITS = {'upload': '3/m'}
+
+
+@rate_limited('upload')
+def upload_view(request):
+    return HttpResponse("ok")
+
+
+@rate_limited('upload', all_methods=True)
+def delete_view(request):
+    return HttpResponse("ok")
+
+
+class ParseRateTest(SimpleTestCase):
+    def test_parse_rate(self):
+        self.assertEqual((20, 60), parse_rate("20/m"))
+        self.assertEqual((5, 3600), parse_rate("5/hour"))
+
+
+@override_settings(GALLERY_RATELIMITS=RATELIMITS, GALLERY_UPLOAD_CONCURRENCY=1)
+class RateLimitTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+        get_store().reset()
+
+    def post(self, view, user=None):
+        request = self.factory.post("/gallery/pieces/new")
+        request.user = user or self.user
+        return view(request)
+
+    def test_burst_then_limited(self):
+        for _ in range(3):
+            self.assertEqual(200, self.post(upload_view).status_code)
+
+        response = self.post(upload_view)
+
+        self.assertEqual(429, response.status_code)
+        self.assertEqual("20", response["Retry-After"])
+
+    def test_per_user(self):
+        other = User.objects.create_user(username="bob", password="top_secret")
+        for _ in range(3):
+            self.post(upload_view)
+
+        self.assertEqual(200, self.post(upload_view, other).status_code)
+
+    def test_get_and_anonymous_not_limited(self):
+        for _ in range(5):
+            request = self.factory.get("/gallery/pieces/new")
+            request.user = self.user
+            self.assertEqual(200, upload_view(request).status_code)
+            self.assertEqual(200, self.post(upload_view, AnonymousUser()).status_code)
+
+    def test_all_methods(self):
+        for _ in range(3):
+            request = self.factory.get("/gallery/pieces/1/delete/")
+            request.user = self.user
+            self.assertEqual(200, delete_view(request).status_code)
+
+        self.assertEqual(429, delete_view(request).status_code)
+
+    def test_concurrent_uploads(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        @rate_limited('upload', concurrent=True)
+        def slow_view(request):
+            started.set()
+            finish.wait(5)
+            return HttpResponse("ok")
+
+        first = threading.Thread(target=self.post, args=(slow_view,))
+        first.start()
+        started.wait(5)
+
+        response = self.post(slow_view)
+        finish.set()
+        first.join()
+
+        self.assertEqual(429, response.status_code)
+        self.assertEqual(200, self.post(slow_view).status_code)
+
+    @override_settings(GALLERY_RATELIMITS={})
+    def test_concurrent_uploads_without_rate(self):
+        self.test_concurrent_uploads()
+
+    @override_settings(GALLERY_RATELIMIT_STORE='gallery.ratelimit.CacheStore')
+    def test_cache_store(self):
+        self.assertIsInstance(get_store(), CacheStore)
+        get_store().cache.clear()
+
+        for _ in range(3):
+            self.assertEqual(200, self.post(upload_view).status_code)
+        self.assertEqual(429, self.post(upload_view).status_code)
+
+        self.assertTrue(get_store().acquire("upload:1", 1))
+        self.assertFalse(get_store().acquire("upload:1", 1))
+        get_store().release("upload:1")
+        self.assertTrue(get_store().acquire("upload:1", 1))
+
+    @override_settings(GALLERY_RATELIMIT_STORE='gallery.ratelimit.CacheStore')
+    def test_cache_store_slot_expires_before_incr(self):
+        store = get_store()
+        store.cache.clear()
+        store.cache.set("ratelimit:active:upload:1", 0)
+
+        def expired(key, *args, **kwargs):
+            # the counter is gone by the time of the incr, as if it expired right after add()
+            store.cache.delete(key)
+            raise ValueError("Key '{}' not found".format(key))
+
+        with mock.patch.object(store.cache, "incr", side_effect=expired) as incr:
+            self.assertTrue(store.acquire("upload:1", 1))
+        self.assertEqual(1, incr.call_count)
+        self.assertFalse(store.acquire("upload:1", 1))
+
+
+class LocalMemoryStoreTest(SimpleTestCase):
+    def test_refill(self):
+        store = LocalMemoryStore()
+        for _ in range(2):
+            self.assertEqual(0, store.take("k", 2, 60, 1000.0))
+
+        self.assertAlmostEqual(30, store.take("k", 2, 60, 1000.0))
+        self.assertEqual(0, store.take("k", 2, 60, 1030.0))
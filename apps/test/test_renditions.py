@@ -0,0 +1,248 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from imagekit.cachefiles import ImageCacheFile
+
+from gallery.jobs import work
+from gallery.models import GalleryPiece
+from gallery.renditions import RenditionIndex, SingleFlight, TieredCacheFileBackend
+
+MEDIA_ROOT = tempfile.mktemp()
+RENDITION_DIR = tempfile.mktemp()
+LOCK_DIR = tempfile.mktemp()
+
+
+class RenditionIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_size_based_eviction(self):
+        index = RenditionIndex(self.dir, max_bytes=25, max_entries=100)
+        index.add("a.jpg", b"x" * 10)
+        index.add("b.jpg", b"x" * 10)
+        self.assertIn("a.jpg", index)  # a is now the most recently used
+        index.add("c.jpg", b"x" * 10)
+
+        self.assertIn("a.jpg", index)
+        self.assertNotIn("b.jpg", index)
+        self.assertIn("c.jpg", index)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "b.jpg")))
+        self.assertEqual(20, index.total_bytes)
+
+    def test_entry_limit(self):
+        index = RenditionIndex(self.dir, max_bytes=100, max_entries=2)
+        for name in ("a.jpg", "b.jpg", "c.jpg"):
+            index.add(name)
+
+        self.assertNotIn("a.jpg", index)
+        self.assertEqual(2, len(index.entries))
+
+    def test_rebuilt_from_disk(self):
+        RenditionIndex(self.dir, max_bytes=100, max_entries=100).add("CACHE/a.jpg", b"abc")
+
+        index = RenditionIndex(self.dir, max_bytes=100, max_entries=100)
+
+        self.assertIn("CACHE/a.jpg", index)
+        self.assertEqual(3, index.total_bytes)
+        self.assertEqual(b"abc", index.read("CACHE/a.jpg"))
+
+    def test_read_after_eviction_elsewhere(self):
+        index = RenditionIndex(self.dir, max_bytes=100, max_entries=100)
+        index.add("a.jpg", b"abc")
+        # another process sharing the directory evicts the copy
+        os.remove(os.path.join(self.dir, "a.jpg"))
+
+        self.assertIsNone(index.read("a.jpg"))
+        self.assertIn("a.jpg", index)
+        self.assertEqual(0, index.total_bytes)
+
+    def test_discard(self):
+        index = RenditionIndex(self.dir, max_bytes=100, max_entries=100)
+        index.add("a.jpg", b"abc")
+        index.discard("a.jpg")
+        index.discard("b.jpg")
+
+        self.assertNotIn("a.jpg", index)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "a.jpg")))
+
+
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_held_across_instances(self):
+        # a second instance stands in for another process: only the lock file is shared
+        with SingleFlight(self.dir).acquire("a.jpg", 1) as (held, waited):
+            self.assertEqual((True, False), (held, waited))
+            with SingleFlight(self.dir).acquire("a.jpg", 0.1) as (held, waited):
+                self.assertEqual((False, True), (held, waited))
+
+        with SingleFlight(self.dir).acquire("a.jpg", 0.1) as (held, waited):
+            self.assertTrue(held)
+
+    def test_threads_wait_their_turn(self):
+        flights = SingleFlight(self.dir)
+        results = []
+
+        def hold():
+            with flights.acquire("a.jpg", 5) as flight:
+                results.append(flight)
+                time.sleep(0.1)
+
+        threads = [threading.Thread(target=hold) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(3, len(results))
+        self.assertTrue(all(held for held, _ in results))
+        self.assertEqual(2, sum(waited for _, waited in results))
+        self.assertEqual({}, flights.keys)
+
+
+class Stop:
+    def is_set(self):
+        return False
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, GALLERY_RENDITION_CACHE_DIR=RENDITION_DIR,
+                   GALLERY_RENDITION_LOCK_DIR=LOCK_DIR)
+class TieredCacheFileBackendTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(RENDITION_DIR, ignore_errors=True)
+        shutil.rmtree(LOCK_DIR, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.backend = TieredCacheFileBackend()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+        with open("test/images/woody.jpg", "rb") as fp:
+            self.piece = GalleryPiece.objects.create(title="x", pub_date=timezone.now(), user=self.user,
+                                                     image=SimpleUploadedFile("woody.jpg", fp.read()),
+                                                     image_hash="a" * 64)
+
+    def thumbnail(self):
+        return ImageCacheFile(self.piece.thumbnail.generator, cachefile_backend=self.backend)
+
+    def test_url_without_storage_calls(self):
+        thumb = self.thumbnail()
+        thumb.url
+        self.assertIn(thumb.name, self.backend.index)
+        self.assertTrue(self.backend.index.read(thumb.name))
+
+        storage = thumb.storage
+        with mock.patch.object(storage, "exists") as exists, mock.patch.object(storage, "save") as save:
+            self.thumbnail().url
+
+        exists.assert_not_called()
+        save.assert_not_called()
+
+    def test_read_from_local_copy(self):
+        thumb = self.thumbnail()
+        thumb.generate()
+
+        with mock.patch.object(thumb.storage, "open") as open_:
+            data = self.backend.read(self.thumbnail())
+        open_.assert_not_called()
+        with default_storage.open(thumb.name) as f:
+            self.assertEqual(f.read(), data)
+
+        # a new worker process starts with what is on local disk
+        self.assertIn(thumb.name, TieredCacheFileBackend().index)
+
+    def test_name_includes_content_hash(self):
+        name = self.thumbnail().name
+
+        self.assertTrue(name.startswith("CACHE/images/{}/aaaaaaaaaaaa-".format(
+            os.path.splitext(self.piece.image.name)[0])), name)
+        self.piece.image_hash = ""
+        self.assertNotIn("-", os.path.basename(self.thumbnail().name))
+
+    def test_replaced_renditions_deleted(self):
+        old = self.thumbnail()
+        old.generate()
+
+        # new content under the same name, as with S3 overwrites
+        with self.captureOnCommitCallbacks(execute=True):
+            self.piece.image_hash = "b" * 64
+            self.piece.save()
+        new = self.thumbnail()
+        new.generate()
+        work("w", Stop(), 0, burst=True)
+
+        self.assertNotEqual(old.name, new.name)
+        self.assertFalse(default_storage.exists(old.name))
+        self.assertTrue(default_storage.exists(new.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.piece.delete()
+        work("w", Stop(), 0, burst=True)
+        self.assertFalse(default_storage.exists(new.name))
+
+    def test_concurrent_requests_generate_once(self):
+        generate = ImageCacheFile._generate
+        calls = []
+
+        def slow_generate(file):
+            calls.append(file.name)
+            time.sleep(0.2)
+            generate(file)
+
+        with mock.patch.object(ImageCacheFile, "_generate", slow_generate):
+            threads = [threading.Thread(target=lambda: self.thumbnail().generate()) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertIn(calls[0], self.backend.index)
+
+    def test_waits_for_another_process(self):
+        thumb = self.thumbnail()
+
+        def generate_elsewhere():
+            # another worker process, sharing only the storage and the lock files
+            with SingleFlight(LOCK_DIR).acquire(thumb.name, 1):
+                started.set()
+                time.sleep(0.2)
+                self.thumbnail()._generate()
+
+        started = threading.Event()
+        elsewhere = threading.Thread(target=generate_elsewhere)
+        elsewhere.start()
+        started.wait()
+        with mock.patch.object(thumb, "_generate") as generate:
+            thumb.generate()
+        elsewhere.join()
+
+        generate.assert_not_called()
+        self.assertIn(thumb.name, self.backend.index)
+
+    @override_settings(GALLERY_RENDITION_LOCK_TIMEOUT=0.1)
+    def test_gives_up_after_timeout(self):
+        thumb = self.thumbnail()
+        with SingleFlight(LOCK_DIR).acquire(thumb.name, 1):
+            with mock.patch.object(thumb, "_generate") as generate:
+                thumb.generate()
+
+        generate.assert_not_called()
+        self.assertNotIn(thumb.name, self.backend.index)
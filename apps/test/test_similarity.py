@@ -0,0 +1,125 @@
+import io
+import json
+
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.messages import get_messages
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from gallery.processing import dhash_image
+from gallery.similarity import SimilarityIndex, find_similar, indexes
+from gallery.views import new_gallery_piece, similar_pieces
+from test.mixins import PieceTestMixin, read_image
+from test.test_views import middleware
+
+
+def resized_jpeg(data, scale, quality=70):
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB").resize((int(img.width * scale), int(img.height * scale)))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def hamming(a, b):
+    return bin((a ^ b) & (2 ** 64 - 1)).count("1")
+
+
+class PerceptualHashTest(SimpleTestCase):
+    def test_resized_copy_is_close(self):
+        woody = read_image("woody.jpg")
+        self.assertLessEqual(hamming(dhash_image(woody), dhash_image(resized_jpeg(woody, 0.3))), 4)
+
+    def test_different_images_are_far(self):
+        self.assertGreater(hamming(dhash_image(read_image("woody.jpg")), dhash_image(read_image("scream.jpg"))), 10)
+
+
+class SimilarityIndexTest(SimpleTestCase):
+    def test_nearest(self):
+        index = SimilarityIndex([1, 2, 3, 4], [0b1011, -1, 0b1000, 0])
+
+        self.assertEqual([(4, 0), (3, 1), (1, 3)], index.nearest(0, 3, 10))
+        self.assertEqual([(4, 0), (3, 1)], index.nearest(0, 3, 2))
+        self.assertEqual([(3, 1), (1, 3)], index.nearest(0, 3, 10, exclude=[4]))
+        self.assertEqual([(2, 0)], index.nearest(-1, 0, 10))
+
+    def test_update(self):
+        index = SimilarityIndex([1], [0])
+        index.update(2, 1)
+        index.update(1, -1)
+        self.assertEqual([(2, 0)], index.nearest(1, 0, 10))
+        index.update(2, None)
+        self.assertEqual(1, len(index))
+
+    def test_update_replaces_arrays(self):
+        index = SimilarityIndex([1, 2], [0, 1])
+        ids, hashes = index.arrays
+        index.update(1, -1)
+
+        # a query that already read the old arrays still sees them unchanged
+        self.assertEqual([1, 2], list(ids))
+        self.assertEqual([0, 1], list(hashes))
+        self.assertEqual([2, 1], list(index.arrays[0]))
+
+    def test_empty(self):
+        self.assertEqual([], SimilarityIndex([], []).nearest(0, 64, 10))
+
+
+@override_settings(GALLERY_IMAGE_WORKERS=0, GALLERY_DEEP_ZOOM=False)
+class FindSimilarTest(PieceTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+        self.woody = read_image("woody.jpg")
+        self.piece = self.create_piece("Woody", self.woody)
+        self.create_piece("Scream", read_image("scream.jpg"))
+
+    def create_piece(self, title, data):
+        return super().create_piece("p.jpg", data, title=title, perceptual_hash=dhash_image(data))
+
+    def test_find_similar(self):
+        matches = find_similar(self.user.id, dhash_image(resized_jpeg(self.woody, 0.5)))
+        self.assertEqual([self.piece], [piece for piece, _ in matches])
+
+        other = User.objects.create_user(username="other", password="top_secret")
+        self.assertEqual([], find_similar(other.id, self.piece.perceptual_hash))
+
+    def test_index_patched_on_change(self):
+        index = indexes.get(self.user.id)
+
+        copy = self.create_piece("Copy", resized_jpeg(self.woody, 0.5))
+        with self.assertNumQueries(0):
+            self.assertIs(index, indexes.get(self.user.id))
+        self.assertEqual(3, len(index))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.delete()
+        self.assertEqual(2, len(indexes.get(self.user.id)))
+
+    def test_similar_pieces_view(self):
+        request = self.factory.post("/gallery/pieces/similar/",
+                                    {"pieceImage": SimpleUploadedFile("w.jpg", resized_jpeg(self.woody, 0.5))})
+        request.user = self.user
+
+        with middleware(request):
+            response = similar_pieces(request)
+
+        matches = json.loads(response.content)["matches"]
+        self.assertEqual([self.piece.id], [m["id"] for m in matches])
+
+    def test_upload_warns_about_duplicate(self):
+        request = self.factory.post("/gallery/pieces/new/",
+                                    {"pieceTitle": "Again", "pieceDescription": "",
+                                     "pieceImage": SimpleUploadedFile("again.jpg", resized_jpeg(self.woody, 0.5))})
+        request.user = self.user
+
+        with middleware(request):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = new_gallery_piece(request)
+
+        self.assertEqual(302, response.status_code)
+        self.assertIn('This looks like "Woody", which is already in your gallery.',
+                      [str(m) for m in get_messages(request)])
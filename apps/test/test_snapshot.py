@@ -0,0 +1,140 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import Client, TestCase, override_settings
+from django.utils import timezone
+
+from gallery.models import GalleryPiece, Exhibition
+from gallery.snapshot import SnapshotPurger, build_snapshot, remove_snapshot, load_manifest, get_snapshot_storage
+
+MEDIA_ROOT = tempfile.mktemp()
+SNAPSHOT_ROOT = tempfile.mktemp()
+
+
+def bundle_files(token):
+    root = os.path.join(SNAPSHOT_ROOT, token)
+    return sorted(os.path.relpath(os.path.join(d, f), root) for d, _, files in os.walk(root) for f in files)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, GALLERY_SNAPSHOT_ROOT=SNAPSHOT_ROOT, GALLERY_PUBLIC_PURGERS=[])
+class SnapshotTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(SNAPSHOT_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        shutil.rmtree(SNAPSHOT_ROOT, ignore_errors=True)
+        self.user = User.objects.create_user(username="jacob", password="top_secret")
+        self.exhib = Exhibition.objects.create(title="Toys", description="d", user=self.user, public_token="tok")
+        self.pieces = []
+        for title in ("Woody", "Buzz"):
+            with open("test/images/woody.jpg", "rb") as fp:
+                piece = GalleryPiece.objects.create(title=title, pub_date=timezone.now(), user=self.user,
+                                                    image=SimpleUploadedFile("woody.jpg", fp.read()))
+            piece.galleries.add(self.exhib)
+            self.pieces.append(piece)
+
+    def manifest(self):
+        return load_manifest(get_snapshot_storage(), "tok/")
+
+    def test_build(self):
+        self.assertEqual({"rendered": 2, "reused": 0, "removed": 0}, build_snapshot(self.exhib))
+
+        files = bundle_files("tok")
+        self.assertIn("index.html", files)
+        self.assertIn("manifest.json", files)
+        self.assertEqual(1, len([f for f in files if f.startswith("assets/style.")]))
+        self.assertEqual(4, len([f for f in files if f.startswith("images/")]))
+
+        with open(os.path.join(SNAPSHOT_ROOT, "tok", "index.html")) as f:
+            index = f.read()
+        self.assertIn("Woody", index)
+        self.assertIn("Buzz", index)
+        for name in self.manifest()["pieces"][str(self.pieces[0].id)]["files"]:
+            self.assertIn('"{}"'.format(name), index)
+
+    def test_rebuild_is_incremental(self):
+        build_snapshot(self.exhib)
+        index_mtime = os.stat(os.path.join(SNAPSHOT_ROOT, "tok", "index.html")).st_mtime_ns
+
+        self.assertEqual({"rendered": 0, "reused": 2, "removed": 0}, build_snapshot(self.exhib))
+        self.assertEqual(index_mtime, os.stat(os.path.join(SNAPSHOT_ROOT, "tok", "index.html")).st_mtime_ns)
+
+        old_files = self.manifest()["pieces"][str(self.pieces[0].id)]["files"]
+        self.pieces[0].title = "Sheriff"
+        self.pieces[0].save(update_fields=["title"])
+
+        self.assertEqual({"rendered": 1, "reused": 1, "removed": 0}, build_snapshot(self.exhib))
+        files = bundle_files("tok")
+        for name in old_files:
+            self.assertNotIn(name, files)
+        with open(os.path.join(SNAPSHOT_ROOT, "tok", "index.html")) as f:
+            self.assertIn("Sheriff", f.read())
+
+    def test_removed_piece(self):
+        build_snapshot(self.exhib)
+        old_files = self.manifest()["pieces"][str(self.pieces[1].id)]["files"]
+
+        self.pieces[1].galleries.remove(self.exhib)
+
+        self.assertEqual({"rendered": 0, "reused": 1, "removed": 1}, build_snapshot(self.exhib))
+        files = bundle_files("tok")
+        for name in old_files:
+            self.assertNotIn(name, files)
+
+    def test_remove_snapshot(self):
+        build_snapshot(self.exhib)
+        remove_snapshot("tok")
+        self.assertEqual([], bundle_files("tok"))
+
+    def test_command(self):
+        Exhibition.objects.create(title="Private", description="d", user=self.user)
+        out = io.StringIO()
+        call_command("snapshot_exhibitions", stdout=out)
+        self.assertIn("2 pieces rendered", out.getvalue())
+
+        out = io.StringIO()
+        call_command("snapshot_exhibitions", "--full", stdout=out)
+        self.assertIn("2 pieces rendered, 0 reused", out.getvalue())
+
+    @override_settings(GALLERY_SNAPSHOT_ROOT="")
+    def test_served_from_media(self):
+        build_snapshot(self.exhib)
+
+        response = Client().get("/media/snapshots/tok/index.html")
+        self.assertEqual(200, response.status_code)
+        response.close()
+
+        Exhibition.objects.filter(id=self.exhib.id).update(public_token=None)
+        self.assertEqual(401, Client().get("/media/snapshots/tok/index.html").status_code)
+
+    @override_settings(GALLERY_SNAPSHOTS=True)
+    def test_publish_hooks(self):
+        exhib = Exhibition.objects.create(title="Private", description="d", user=self.user)
+
+        with mock.patch("gallery.snapshot.schedule_build") as schedule_build, \
+                self.captureOnCommitCallbacks(execute=True):
+            exhib.public_token = "new"
+            exhib.save(update_fields=["public_token"])
+        schedule_build.assert_called_once_with([exhib.id])
+
+        with mock.patch("gallery.snapshot.schedule_removal") as schedule_removal, \
+                self.captureOnCommitCallbacks(execute=True):
+            exhib.public_token = None
+            exhib.save(update_fields=["public_token"])
+        schedule_removal.assert_called_once_with("new")
+
+    def test_purger_rebuilds_affected_exhibitions(self):
+        Exhibition.objects.create(title="Other", description="d", user=self.user, public_token="tok2")
+
+        with mock.patch("gallery.snapshot.schedule_build") as schedule_build:
+            SnapshotPurger().purge(["piece-{}".format(self.pieces[0].id)])
+        schedule_build.assert_called_once_with([self.exhib.id])
@@ -0,0 +1,119 @@
+import gc
+import os
+import runpy
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from gallery.management.commands.profile_startup import parse_importtime, aggregate
+from joshuasgallery_server.preload import warm_up, iter_template_names
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       100 |        100 |     PIL._version
+import time:      2000 |       2100 |   PIL
+import time:       300 |       2400 | PIL.Image
+import time:        50 |         50 | gallery
+""".splitlines()
+
+
+class ProfileStartupTest(SimpleTestCase):
+    def test_parse_importtime(self):
+        entries = parse_importtime(IMPORTTIME)
+
+        self.assertEqual(("PIL._version", 100, 100, 2), entries[0])
+        self.assertEqual(("PIL.Image", 300, 2400, 0), entries[2])
+
+    def test_aggregate(self):
+        self.assertEqual([("PIL", 2400, 3), ("gallery", 50, 1)], aggregate(parse_importtime(IMPORTTIME)))
+
+
+class PreloadTest(SimpleTestCase):
+    def tearDown(self):
+        gc.unfreeze()
+
+    def test_warm_up(self):
+        self.assertIn("galleryapp/homepage.html", list(iter_template_names()))
+
+        warm_up()
+
+        self.assertGreater(gc.get_freeze_count(), 0)
+
+
+class GunicornConfTest(SimpleTestCase):
+    def load(self, **env):
+        with mock.patch.dict(os.environ, env):
+            return runpy.run_path("gunicorn.conf.py")
+
+    def test_sync_defaults(self):
+        conf = self.load(JGWORKER_CLASS="sync")
+
+        self.assertEqual(2 * conf["cpu_count"]() + 1, conf["workers"])
+        self.assertEqual(1, conf["threads"])
+        self.assertEqual(100, conf["max_requests_jitter"])
+        self.assertEqual("joshuasgallery_server.wsgi:application", conf["wsgi_app"])
+
+    def test_gthread(self):
+        conf = self.load(JGWORKER_CLASS="gthread", JGWORKERS="3", JGTHREADS="8")
+
+        self.assertEqual(("gthread", 3, 8), (conf["worker_class"], conf["workers"], conf["threads"]))
+
+    def test_uvicorn(self):
+        conf = self.load(JGWORKER_CLASS="uvicorn")
+
+        self.assertEqual("uvicorn.workers.UvicornWorker", conf["worker_class"])
+        self.assertEqual("joshuasgallery_server.asgi:application", conf["wsgi_app"])
+
+    def test_invalid_worker_class(self):
+        with self.assertRaises(RuntimeError):
+            self.load(JGWORKER_CLASS="eventlet")
+
+    def test_exports_worker_count(self):
+        with mock.patch.dict(os.environ, {"JGWORKER_CLASS": "gthread", "JGWORKERS": "3"}):
+            runpy.run_path("gunicorn.conf.py")
+            self.assertEqual("3", os.environ["JGWORKERS"])
+
+
+class SettingsTest(SimpleTestCase):
+    def load(self, **env):
+        with mock.patch.dict(os.environ, dict({"JGENV": "local"}, **env)):
+            return runpy.run_path("joshuasgallery_server/settings.py")
+
+    def test_per_process_cache_by_default(self):
+        conf = self.load(JGWORKERS="1")
+
+        self.assertEqual(conf["LOCMEM_CACHE"], conf["CACHES"]["default"]["BACKEND"])
+
+    def test_shared_cache(self):
+        conf = self.load(JGCACHE_URL="redis://cache:6379/0", JGWORKERS="5")
+        self.assertEqual({"BACKEND": "django.core.cache.backends.redis.RedisCache",
+                          "LOCATION": "redis://cache:6379/0"}, conf["CACHES"]["default"])
+
+        conf = self.load(JGCACHE_URL="memcached://cache:11211", JGWORKERS="5")
+        self.assertEqual("cache:11211", conf["CACHES"]["default"]["LOCATION"])
+
+    def test_several_workers_need_shared_cache(self):
+        # public pages and piece indexes would go stale in the workers that did not make a change
+        with self.assertRaisesRegex(RuntimeError, "must be a cache shared by all 5 workers"):
+            self.load(JGWORKERS="5")
+
+    def test_shared_rate_limits(self):
+        conf = self.load(JGCACHE_URL="redis://cache:6379/0", JGWORKERS="5")
+        self.assertEqual("gallery.ratelimit.CacheStore", conf["GALLERY_RATELIMIT_STORE"])
+
+        with self.assertRaisesRegex(RuntimeError, "JGRATELIMIT_STORE"):
+            self.load(JGCACHE_URL="redis://cache:6379/0", JGWORKERS="5",
+                      JGRATELIMIT_STORE="gallery.ratelimit.LocalMemoryStore")
+
+    def test_invalid_cache_url(self):
+        with self.assertRaises(RuntimeError):
+            self.load(JGCACHE_URL="locmem://")
+
+    def test_sessions_in_database_by_default(self):
+        self.assertEqual("django.contrib.sessions.backends.db", self.load()["SESSION_ENGINE"])
+
+    def test_cached_sessions_need_shared_cache(self):
+        with self.assertRaisesRegex(RuntimeError, "JGCACHE_URL"):
+            self.load(JGSESSION="cached_db")
+
+        conf = self.load(JGSESSION="cached_db", JGCACHE_URL="redis://cache:6379/0")
+        self.assertEqual("django.contrib.sessions.backends.cached_db", conf["SESSION_ENGINE"])
@@ -0,0 +1,37 @@
+import pickle
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+from joshuasgallery_server.storage import GalleryS3Storage
+
+
+@override_settings(AWS_S3_MULTIPART_THRESHOLD=16 * 1024 * 1024, AWS_S3_MAX_POOL_CONNECTIONS=32)
+class GalleryS3StorageTest(SimpleTestCase):
+    def setUp(self):
+        self.storage = GalleryS3Storage(bucket_name="bucket-jg-test", region_name="us-east-1",
+                                        access_key="key", secret_key="secret")
+
+    def test_transfer_config(self):
+        self.assertEqual(16 * 1024 * 1024, self.storage._transfer_config.multipart_threshold)
+        self.assertEqual(32, self.storage.config.max_pool_connections)
+
+    def test_client_shared_across_threads(self):
+        connections = []
+        threads = [threading.Thread(target=lambda: connections.append(self.storage.connection))
+                   for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(3, len({id(c) for c in connections}))
+        self.assertEqual(1, len({id(c.meta.client) for c in connections}))
+
+    def test_pickle(self):
+        self.storage.connection
+        storage = pickle.loads(pickle.dumps(self.storage))
+
+        self.assertIsNone(storage._shared_resource)
+        self.assertEqual(32, storage.config.max_pool_connections)
+        self.assertIsNot(self.storage.connection.meta.client, storage.connection.meta.client)
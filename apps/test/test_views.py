@@ -1,29 +1,43 @@
 import contextlib
+import os
 import shutil
 import tempfile
+from unittest import mock
 
 from django.contrib.messages.middleware import MessageMiddleware
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import AnonymousUser, User
 
 # noinspection PyUnresolvedReferences
 from gallery.views import *
 # noinspection PyUnresolvedReferences
+from gallery.media import media_visible_to
+from gallery.processing import PoolError
 from gallery.models import GalleryPiece
+from gallery.ratelimit import get_store
 
 EXHIB_TITLE_MAX_LEN = 200
 EXHIB_DESC_MAX_LEN = 1000
 
 NON_AUTHENTICATED_STATUS_CODE = 401
-FORBIDDEN_STATUS_CODE = 403
+NOT_FOUND_STATUS_CODE = 404
 
 MEDIA_ROOT = tempfile.mktemp()
 
 
+def update_statements(ctx):
+    return [q['sql'] for q in ctx.captured_queries if q['sql'].startswith("UPDATE")]
+
+
 @contextlib.contextmanager
 def middleware(request):
     """Annotate a request object with a session"""
+    # each simulated request starts with fresh rate limits, as tests reuse user ids
+    get_store().reset()
     s_middleware = SessionMiddleware(get_response=1)
     s_middleware.process_request(request)
     request.session.save()
@@ -35,7 +49,13 @@ def middleware(request):
     yield request
 
 
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class GalleryPieceListTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
     def setUp(self):
         self.factory = RequestFactory()
         self.user = User.objects.create_user(
@@ -43,6 +63,21 @@ class GalleryPieceListTest(TestCase):
         )
         self.anonUser = AnonymousUser()
 
+    def test_piece_list_with_pieces(self):
+        with open("test/images/woody.jpg", "rb") as fp:
+            piece = GalleryPiece.objects.create(title="x", pub_date=timezone.now(), user=self.user,
+                                                image=SimpleUploadedFile("woody.jpg", fp.read()),
+                                                placeholder="data:image/jpeg;base64,AAAA")
+
+        request = self.factory.get("/gallery/pieces")
+        request.user = self.user
+
+        with middleware(request):
+            response = pieces_list_view(request)
+
+        self.assertContains(response, piece.placeholder)
+        self.assertContains(response, 'width="100" height="50"')
+
     def test_piece_list(self):
         request = self.factory.get("/gallery/pieces")
         request.user = self.user
@@ -113,8 +148,28 @@ class GalleryPieceCreateTest(TestCase):
             self.assertEqual(self.user, p.user)
             self.assertEqual(self.good_title, p.title)
             self.assertEqual(self.good_desc, p.description)
+            self.assertTrue(p.optimized.name.endswith(".jpg"))
             self.assertEquals(1, len(all_pieces))
 
+    def test_create_piece_gif(self):
+        with open("test/images/dragon.gif", "rb") as fp:
+            test_post_data = {'placeholder': "PLACEHOLDER",
+                              'pieceTitle': self.good_title,
+                              'pieceDescription': self.good_desc,
+                              'pieceImage': fp}
+            request = self.factory.post("/gallery/pieces/new", test_post_data)
+
+            request.user = self.user
+
+            with middleware(request):
+                response = new_gallery_piece(request)
+
+        self.assertEqual(302, response.status_code)
+
+        piece = GalleryPiece.objects.get()
+        self.assertEqual("GIF", piece.image_format)
+        self.assertTrue(piece.optimized.name.endswith(".jpg"))
+
     def test_create_piece_anonymous_user(self):
         with open("test/images/woody.jpg", "rb") as fp:
             test_post_data = {'placeholder': "PLACEHOLDER",
@@ -188,7 +243,7 @@ class GalleryPieceCreateTest(TestCase):
             test_post_data = {'placeholder': "PLACEHOLDER",
                               'pieceTitle': self.good_title,
                               'pieceDescription': self.good_desc,
-                              'pieceImage': fp}
+                              'pieceImage': SimpleUploadedFile("dragon.bmp", fp.read())}
 
             request = self.factory.post("/gallery/pieces/new", test_post_data)
 
@@ -200,6 +255,35 @@ class GalleryPieceCreateTest(TestCase):
         self.assertEquals(200, response.status_code)
         self.assertEquals(0, len(GalleryPiece.objects.all()))
 
+    def test_create_piece_undecodable_image(self):
+        test_post_data = {'placeholder': "PLACEHOLDER",
+                          'pieceTitle': self.good_title,
+                          'pieceDescription': self.good_desc,
+                          'pieceImage': SimpleUploadedFile("woody.jpg", b"not a jpeg")}
+        request = self.factory.post("/gallery/pieces/new", test_post_data)
+
+        request.user = self.user
+
+        with middleware(request):
+            response = new_gallery_piece(request)
+
+        self.assertContains(response, IMG_PROCESSING_ERROR_MSG)
+        self.assertEquals(0, len(GalleryPiece.objects.all()))
+
+    def test_create_piece_pool_failure_not_hidden(self):
+        with open("test/images/woody.jpg", "rb") as fp:
+            test_post_data = {'placeholder': "PLACEHOLDER",
+                              'pieceTitle': self.good_title,
+                              'pieceDescription': self.good_desc,
+                              'pieceImage': fp}
+            request = self.factory.post("/gallery/pieces/new", test_post_data)
+
+            request.user = self.user
+
+            with middleware(request), mock.patch("gallery.views.process_upload", side_effect=PoolError("broken")):
+                self.assertRaises(PoolError, new_gallery_piece, request)
+        self.assertEquals(0, len(GalleryPiece.objects.all()))
+
 
 @override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class GalleryPieceDetailTest(TestCase):
@@ -259,7 +343,36 @@ class GalleryPieceDetailTest(TestCase):
         with middleware(request):
             response = piece_detail(request, self.piece_id)
 
-        self.assertEqual(FORBIDDEN_STATUS_CODE, response.status_code)
+        self.assertEqual(NOT_FOUND_STATUS_CODE, response.status_code)
+
+    def test_piece_detail_placeholder(self):
+        request = self.factory.get("/gallery/pieces/" + str(self.piece_id))
+        request.user = self.user
+
+        with middleware(request):
+            response = piece_detail(request, self.piece_id)
+
+        self.assertContains(response, self.piece.placeholder)
+        self.assertContains(response, 'width="{}" height="{}"'.format(self.piece.width, self.piece.height))
+        self.assertContains(response, 'loading="lazy"')
+
+    def test_piece_detail_missing(self):
+        request = self.factory.get("/gallery/pieces/" + str(self.piece_id + 1))
+        request.user = self.user
+
+        with middleware(request):
+            response = piece_detail(request, self.piece_id + 1)
+
+        self.assertEqual(NOT_FOUND_STATUS_CODE, response.status_code)
+
+    def test_piece_detail_single_query(self):
+        request = self.factory.get("/gallery/pieces/" + str(self.piece_id))
+        request.user = self.user
+
+        with self.assertNumQueries(1):
+            piece = get_owned(GalleryPiece, request, self.piece_id)
+
+        self.assertEqual(self.piece, piece)
 
 
 @override_settings(MEDIA_ROOT=MEDIA_ROOT)
@@ -334,7 +447,7 @@ class GalleryPieceDeleteTest(TestCase):
         with middleware(request):
             response = delete_gallery_piece(request, self.piece_id)
 
-        self.assertEqual(FORBIDDEN_STATUS_CODE, response.status_code)
+        self.assertEqual(NOT_FOUND_STATUS_CODE, response.status_code)
 
         self.assertEqual(1, len(GalleryPiece.objects.all()))
 
@@ -396,6 +509,25 @@ class GalleryPieceEditTest(TestCase):
         self.assertEquals(new_desc, edited_piece.description)
         self.assertTrue("scream" in edited_piece.image.url)
 
+    def test_edit_title_only(self):
+        test_post_data = {'placeholder': "PLACEHOLDER",
+                          'pieceTitle': "New title!",
+                          'pieceDescription': self.good_desc}
+        request = self.factory.post("/gallery/pieces/" + str(self.piece_id) + "/edit", test_post_data)
+
+        request.user = self.user
+
+        with middleware(request), CaptureQueriesContext(connection) as ctx:
+            response = edit_gallery_piece(request, self.piece_id)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(['UPDATE "gallery_gallerypiece" SET "title" = \'New title!\' '
+                           'WHERE "gallery_gallerypiece"."id" = ' + str(self.piece_id)],
+                          update_statements(ctx))
+        edited_piece = GalleryPiece.objects.all()[0]
+        self.assertEquals("New title!", edited_piece.title)
+        self.assertEquals(self.img_url, edited_piece.image.url)
+
     def test_edit_bad_title(self):
         self.assert_initial_values(self.piece)
 
@@ -451,7 +583,7 @@ class GalleryPieceEditTest(TestCase):
             test_post_data = {'placeholder': "PLACEHOLDER",
                               'pieceTitle': new_title,
                               'pieceDescription': new_desc,
-                              'pieceImage': fp}
+                              'pieceImage': SimpleUploadedFile("dragon.bmp", fp.read())}
             request = self.factory.post("/gallery/pieces/" + str(self.piece_id) + "/edit", test_post_data)
 
             request.user = self.user
@@ -522,7 +654,7 @@ class GalleryPieceEditTest(TestCase):
             with middleware(request):
                 response = edit_gallery_piece(request, self.piece_id)
 
-        self.assertEquals(FORBIDDEN_STATUS_CODE, response.status_code)
+        self.assertEquals(NOT_FOUND_STATUS_CODE, response.status_code)
         edited_piece = GalleryPiece.objects.all()[0]
         self.assert_initial_values(edited_piece)
 
@@ -676,7 +808,7 @@ class ExhibitionDetailTest(TestCase):
 
         response = exhibition_detail(request, self.exhib_id)
 
-        self.assertEquals(FORBIDDEN_STATUS_CODE, response.status_code)
+        self.assertEquals(NOT_FOUND_STATUS_CODE, response.status_code)
 
 
 class ExhibitionDeleteTest(TestCase):
@@ -733,7 +865,18 @@ class ExhibitionDeleteTest(TestCase):
         with middleware(request):
             response = delete_exhibition(request, self.exhib_id)
 
-        self.assertEquals(FORBIDDEN_STATUS_CODE, response.status_code)
+        self.assertEquals(NOT_FOUND_STATUS_CODE, response.status_code)
+
+        self.assertEquals(1, len(Exhibition.objects.all()))
+
+    def test_delete_exhibition_missing(self):
+        request = self.factory.get("/gallery/exhibitions/" + str(self.exhib_id + 1) + "/delete")
+        request.user = self.user
+
+        with middleware(request):
+            response = delete_exhibition(request, self.exhib_id + 1)
+
+        self.assertEquals(NOT_FOUND_STATUS_CODE, response.status_code)
 
         self.assertEquals(1, len(Exhibition.objects.all()))
 
@@ -779,6 +922,21 @@ class ExhibitionEditTest(TestCase):
         self.assertEquals(new_title, edited_exhib.title)
         self.assertEquals(new_desc, edited_exhib.description)
 
+    def test_edit_exhibition_description_only(self):
+        test_post_data = {'placeholder': "PLACEHOLDER",
+                          'exhibTitle': self.good_title,
+                          'exhibDesc': "New description!"}
+
+        request = self.factory.post("/gallery/exhibitions/" + str(self.exhib_id) + "/edit", test_post_data)
+        request.user = self.user
+        with middleware(request), CaptureQueriesContext(connection) as ctx:
+            response = edit_exhibition(request, self.exhib_id)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(['UPDATE "gallery_exhibition" SET "description" = \'New description!\' '
+                           'WHERE "gallery_exhibition"."id" = ' + str(self.exhib_id)],
+                          update_statements(ctx))
+
     def test_edit_exhibition_anonymous_user(self):
         new_title = "New title!"
         new_desc = "New description!"
@@ -812,7 +970,7 @@ class ExhibitionEditTest(TestCase):
         with middleware(request):
             response = edit_exhibition(request, self.exhib_id)
 
-        self.assertEquals(FORBIDDEN_STATUS_CODE, response.status_code)
+        self.assertEquals(NOT_FOUND_STATUS_CODE, response.status_code)
         edited_exhib = Exhibition.objects.all()[0]
         self.assertEquals(self.good_title, edited_exhib.title)
         self.assertEquals(self.good_desc, edited_exhib.description)
@@ -852,3 +1010,98 @@ class ExhibitionEditTest(TestCase):
         edited_exhib = Exhibition.objects.all()[0]
         self.assertEquals(self.good_title, edited_exhib.title)
         self.assertEquals(self.good_desc, edited_exhib.description)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, GALLERY_MEDIA_SENDFILE="django")
+class MediaServeTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        self.other_user = User.objects.create_user(
+            username="bob", email="bob@…", password="top_secret"
+        )
+        with open("test/images/woody.jpg", "rb") as fp:
+            self.data = fp.read()
+        self.piece = GalleryPiece.objects.create(title="x", pub_date=timezone.now(), user=self.user,
+                                                 image=SimpleUploadedFile("woody.jpg", self.data))
+
+    def get(self, user, **headers):
+        request = self.factory.get("/media/" + self.piece.image.name, **headers)
+        request.user = user
+        return serve_media(request, self.piece.image.name)
+
+    def test_serve_media(self):
+        response = self.get(self.user)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(response["Content-Length"], str(len(self.data)))
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        response.close()
+
+    def test_serve_media_range(self):
+        response = self.get(self.user, HTTP_RANGE="bytes=10-19")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/{}".format(len(self.data)))
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        response.close()
+
+        response = self.get(self.user, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), self.data[-5:])
+        response.close()
+
+    def test_serve_media_bad_range(self):
+        response = self.get(self.user, HTTP_RANGE="bytes={}-".format(len(self.data)))
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */{}".format(len(self.data)))
+
+    def test_serve_media_not_modified(self):
+        last_modified = self.get(self.user)["Last-Modified"]
+        response = self.get(self.user, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_serve_media_x_accel(self):
+        with self.settings(GALLERY_MEDIA_SENDFILE="x-accel"):
+            response = self.get(self.user)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/" + self.piece.image.name)
+        self.assertEqual(response.content, b"")
+
+    def test_serve_media_other_user(self):
+        response = self.get(self.other_user)
+
+        self.assertEqual(response.status_code, NOT_FOUND_STATUS_CODE)
+
+    def test_renditions_not_shared_between_similar_names(self):
+        stem = os.path.splitext(self.piece.image.name)[0]
+        other = GalleryPiece.objects.create(title="x", pub_date=timezone.now(), user=self.other_user,
+                                            image=SimpleUploadedFile(os.path.basename(stem) + ".x.jpg", self.data))
+        self.assertEqual(stem + ".x.jpg", other.image.name)
+
+        for name in ("CACHE/images/{}/abc.jpg", "deepzoom/{}.dzi", "deepzoom/{}_files/0/0_0.jpg"):
+            self.assertTrue(media_visible_to(self.user, name.format(stem)))
+            self.assertFalse(media_visible_to(self.other_user, name.format(stem)))
+            self.assertTrue(media_visible_to(self.other_user, name.format(stem + ".x")))
+
+    def test_serve_media_outside_media_root(self):
+        request = self.factory.get("/media/../settings.py")
+        request.user = self.user
+        response = serve_media(request, "../settings.py")
+
+        self.assertEqual(response.status_code, NOT_FOUND_STATUS_CODE)
+
+    def test_serve_media_not_logged_in(self):
+        response = self.get(AnonymousUser())
+
+        self.assertEqual(response.status_code, NON_AUTHENTICATED_STATUS_CODE)